@@ -0,0 +1,108 @@
+import asyncio
+import json
+import logging
+import re
+
+from asgiref.sync import sync_to_async
+from celery import states
+from core.models import WorkflowRun
+from core.workflow import get_task_status
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger('dict_config_logger')
+
+# Path of the event stream of a task, next to the polling endpoint
+# api/xia-workflow/status/<task id>/
+EVENTS_PATH = re.compile(r'^/api/xia-workflow/events/(?P<task_id>[^/]+)/?$')
+
+
+def read_task_status(task_id):
+    """get_task_status releasing the database connection it used, a stream
+    outlives the connection age Django checks between requests"""
+    try:
+        return get_task_status(task_id)
+    finally:
+        close_old_connections()
+
+
+def is_status_final(status):
+    """Whether a task status will not change anymore: the workflow run of
+    the task finished, or the task is done and runs no workflow run or
+    failed
+
+    In 'dag' mode the workflow task is done as soon as it dispatched the
+    first stages, its run only finishes with the last stage.
+    """
+    run = status.get('run')
+    if run is None or status['task_status'] in states.PROPAGATE_STATES:
+        return status['task_status'] in states.READY_STATES
+    return run['status'] in (WorkflowRun.STATUS.succeeded,
+                             WorkflowRun.STATUS.failed)
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client of the stream went away"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def stream_task_status(task_id, receive, send):
+    """Send the status of the task as a Server-Sent Event every time it
+    changes, until the workflow run of the task finished, the task is
+    done when it runs none, or the client disconnects"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # nginx would hold the events back until its buffer is full
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    previous = None
+    quiet = 0.0
+    try:
+        while not disconnected.done():
+            body = await sync_to_async(read_task_status)(task_id)
+            if body != previous:
+                await send({'type': 'http.response.body',
+                            'body': b'data: ' + body.encode('utf-8') +
+                            b'\n\n', 'more_body': True})
+                previous = body
+                quiet = 0.0
+                if is_status_final(json.loads(body)):
+                    break
+            elif quiet >= settings.XIA_EVENTS_HEARTBEAT:
+                await send({'type': 'http.response.body',
+                            'body': b': keep-alive\n\n', 'more_body': True})
+                quiet = 0.0
+            await asyncio.wait([disconnected],
+                               timeout=settings.XIA_EVENTS_INTERVAL)
+            quiet += settings.XIA_EVENTS_INTERVAL
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+
+
+def route_task_events(application):
+    """ASGI application streaming the status of a task from
+    api/xia-workflow/events/<task id>/ and handing every other request to
+    the Django application"""
+
+    async def router(scope, receive, send):
+        match = None
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = EVENTS_PATH.match(scope['path'])
+        if match is None:
+            await application(scope, receive, send)
+            return
+        logger.info('Streaming status of task ' + match.group('task_id'))
+        await stream_task_status(match.group('task_id'), receive, send)
+
+    return router
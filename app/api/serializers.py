@@ -0,0 +1,35 @@
+from core.models import ConfigurationRun, StageRun, WorkflowRun
+from rest_framework import serializers
+
+# Resources recorded for stages and XSR configurations of a run
+RUN_METRICS_FIELDS = ('wall_time', 'records_fetched', 'records_changed',
+                      'records_written', 'http_bytes', 'query_count',
+                      'peak_rss')
+
+
+class ConfigurationRunSerializer(serializers.ModelSerializer):
+    """Serializes the extraction of one XSR configuration in a stage"""
+
+    class Meta:
+        model = ConfigurationRun
+        fields = ('xsr_configuration', 'Transcript_API') + RUN_METRICS_FIELDS
+
+
+class StageRunSerializer(serializers.ModelSerializer):
+    """Serializes the checkpoint of a workflow stage"""
+    configurations = ConfigurationRunSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = StageRun
+        fields = ('stage', 'status', 'started', 'finished', 'error') + \
+            RUN_METRICS_FIELDS + ('configurations',)
+
+
+class WorkflowRunSerializer(serializers.ModelSerializer):
+    """Serializes a workflow run with the state of each of its stages"""
+    stages = StageRunSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = WorkflowRun
+        fields = ('id', 'status', 'created', 'modified', 'finished',
+                  'profile', 'stages')
@@ -0,0 +1,412 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from unittest.mock import patch
+
+from api.events import route_task_events
+from asgiref.sync import async_to_sync
+from core.metrics import ContainerMetricsCollector
+from core.models import WorkflowRun
+from core.workflow import (WORKFLOW_STAGES, WORKFLOW_TASK,
+                           create_workflow_run, update_workflow_status)
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings, tag
+from django.urls import reverse
+from openlxp_xia_ace_project.celery import app as celery_app
+from rest_framework.test import APIClient
+
+# Budget of a cold web process importing the WSGI application and its URLs
+WEB_IMPORT_SECONDS = 3
+WEB_IMPORT_RSS = 128 * 1024 * 1024
+# Modules only the celery workers need
+WORKER_MODULES = [
+    'core.tasks', 'numpy', 'pandas',
+    'openlxp_notifications.management.commands.trigger_status_update',
+    'openlxp_xia.management.commands.transform_source_metadata',
+]
+# ru_maxrss would carry the peak of the test runner over exec, the peak
+# resident memory of the process itself is read from /proc instead
+WEB_IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import openlxp_xia_ace_project.wsgi
+from django.urls import get_resolver
+get_resolver().url_patterns
+seconds = time.perf_counter() - started
+with open('/proc/self/status') as status:
+    rss = [int(line.split()[1]) * 1024 for line in status
+           if line.startswith('VmHWM:')][0]
+print(json.dumps([seconds, rss,
+                  [name for name in sys.argv[1:] if name in sys.modules]]))
+"""
+
+
+@tag('unit')
+@override_settings(CELERY_BROKER_URL='memory://')
+class ViewTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        caches['status'].clear()
+        # tasks sent by the tests go to the in-memory broker rather than
+        # through the connection pools of the configured one
+        for target, name in ((celery_app, '_pool'),
+                             (celery_app.amqp, '_producer_pool')):
+            patcher = patch.object(target, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.purge_broker)
+
+    def purge_broker(self):
+        with celery_app.connection_for_write() as conn:
+            for queue in (celery_app.conf.task_default_queue,
+                          settings.XIA_WORKFLOW_QUEUE):
+                try:
+                    conn.default_channel.queue_purge(queue)
+                except conn.channel_errors:
+                    pass
+
+    def take_task(self):
+        """Name and arguments of the next workflow run a worker would
+        receive"""
+        with celery_app.connection_for_read() as conn:
+            message = conn.default_channel.basic_get(
+                settings.XIA_WORKFLOW_QUEUE, no_ack=True)
+        return message.headers['task'], message.decode()[0]
+
+    def test_xia_workflow(self):
+        """Test triggering the workflow creates a run"""
+        with patch('api.views.celery_app.send_task') as mock_send:
+            response = self.client.get(reverse('api:xia_workflow'))
+
+        self.assertEqual(response.status_code, 202)
+        mock_send.assert_called_once_with(
+            WORKFLOW_TASK, (response.data['run_id'],),
+            task_id=response.data['task_id'])
+        self.assertTrue(WorkflowRun.objects.filter(
+            pk=response.data['run_id'],
+            task_id=response.data['task_id']).exists())
+
+    def test_xia_workflow_in_progress(self):
+        """Test triggers during a run return that run"""
+        with patch('api.views.celery_app.send_task') as mock_send:
+            first = self.client.get(reverse('api:xia_workflow'))
+            second = self.client.get(reverse('api:xia_workflow'))
+
+            self.assertEqual(second.status_code, 202)
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(mock_send.call_count, 1)
+            self.assertEqual(WorkflowRun.objects.count(), 1)
+
+            # the lock is released once the run finished
+            run = WorkflowRun.objects.get(pk=first.data['run_id'])
+            run.stages.update(status='succeeded')
+            update_workflow_status(run)
+            third = self.client.get(reverse('api:xia_workflow'))
+
+        self.assertNotEqual(third.data['run_id'], first.data['run_id'])
+        self.assertEqual(mock_send.call_count, 2)
+
+    @override_settings(XIA_WORKFLOW_MAX_QUEUED=2)
+    def test_xia_workflow_queue_full(self):
+        """Test triggers are refused while too many tasks wait for a
+        worker, including runs sent by celery beat"""
+        first = self.client.get(reverse('api:xia_workflow'))
+        run = WorkflowRun.objects.get(pk=first.data['run_id'])
+        run.stages.update(status='succeeded')
+        update_workflow_status(run)
+        # scheduled runs only take the lock once a worker started them
+        celery_app.send_task(WORKFLOW_TASK)
+
+        response = self.client.get(reverse('api:xia_workflow'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(WorkflowRun.objects.count(), 1)
+
+        self.assertEqual(self.take_task(), (WORKFLOW_TASK, [run.pk]))
+        # stage and configuration tasks wait on the default queue
+        for _ in range(3):
+            celery_app.send_task('workflow_extract_configuration_for_xia')
+        response_after = self.client.get(reverse('api:xia_workflow'))
+
+        self.assertEqual(response_after.status_code, 202)
+        self.assertEqual(WorkflowRun.objects.count(), 2)
+
+    @override_settings(XIA_WORKFLOW_MAX_QUEUED=1)
+    def test_xia_workflow_queue_full_in_progress(self):
+        """Test triggers hand out the run in progress whatever waits for a
+        worker, and do not keep the lock they are refused"""
+        first = self.client.get(reverse('api:xia_workflow'))
+        celery_app.send_task('workflow_stage_for_xia')
+
+        second = self.client.get(reverse('api:xia_workflow'))
+        run = WorkflowRun.objects.get(pk=first.data['run_id'])
+        run.stages.update(status='succeeded')
+        update_workflow_status(run)
+        third = self.client.get(reverse('api:xia_workflow'))
+        self.take_task()
+        fourth = self.client.get(reverse('api:xia_workflow'))
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(third.status_code, 429)
+        self.assertEqual(fourth.status_code, 202)
+        self.assertNotEqual(fourth.data['run_id'], first.data['run_id'])
+
+    @override_settings(XIA_WORKFLOW_MAX_QUEUED=1)
+    def test_xia_workflow_send_failed(self):
+        """Test a run whose task could not be sent is marked failed and
+        releases the lock"""
+        client = APIClient(raise_request_exception=False)
+
+        with patch('api.views.celery_app.send_task') as mock_send:
+            mock_send.side_effect = OSError('broker unavailable')
+            response = client.get(reverse('api:xia_workflow'))
+            mock_send.side_effect = None
+            response_after = self.client.get(reverse('api:xia_workflow'))
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(WorkflowRun.objects.order_by('pk').first().status,
+                         'failed')
+        self.assertEqual(response_after.status_code, 202)
+
+    def test_xia_workflow_resume(self):
+        """Test resuming a run only resets its incomplete stages"""
+        run = create_workflow_run()
+        run.stages.filter(stage='extract').update(status='succeeded')
+        run.stages.filter(stage='load').update(status='failed')
+
+        with patch('api.views.celery_app.send_task'):
+            response = self.client.get(reverse('api:xia_workflow'),
+                                       {'resume': run.pk})
+
+        self.assertEqual(response.data['run_id'], run.pk)
+        run.refresh_from_db()
+        self.assertEqual(run.task_id, response.data['task_id'])
+        self.assertEqual(run.stages.get(stage='extract').status,
+                         'succeeded')
+        self.assertEqual(run.stages.get(stage='load').status, 'pending')
+
+    def test_xia_workflow_run(self):
+        """Test the state of every stage of a run is exposed"""
+        run = create_workflow_run()
+
+        response = self.client.get(reverse('api:xia_workflow_run',
+                                           args=[run.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual([stage['stage'] for stage in response.data['stages']],
+                         list(WORKFLOW_STAGES))
+
+    def test_xia_workflow_run_missing(self):
+        """Test unknown runs are not found"""
+        response = self.client.get(reverse('api:xia_workflow_run',
+                                           args=[1]))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_xia_workflow_runs(self):
+        """Test the most recent runs are listed with their metrics"""
+        runs = [create_workflow_run() for _ in range(3)]
+        runs[-1].stages.filter(stage='extract').update(wall_time=1.5,
+                                                       records_written=10)
+
+        response = self.client.get(reverse('api:xia_workflow_runs'),
+                                   {'limit': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([run['id'] for run in response.data],
+                         [runs[2].pk, runs[1].pk])
+        extract = response.data[0]['stages'][1]
+        self.assertEqual((extract['stage'], extract['wall_time'],
+                          extract['records_written']),
+                         ('extract', 1.5, 10))
+
+    def test_metrics(self):
+        """Test metrics are exposed in the Prometheus text format"""
+        run = create_workflow_run()
+        run.stages.filter(stage='extract').update(status='running')
+
+        response = self.client.get(reverse('api:metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode('utf-8')
+        self.assertIn('xia_workflow_runs{status="pending"} 1.0', body)
+        self.assertIn('xia_workflow_stage_tasks{stage="extract",'
+                      'status="running"} 1.0', body)
+        self.assertIn('# TYPE xia_ledger_records_total counter', body)
+
+    def test_metrics_containers(self):
+        """Test the metrics written by the processes of each container to
+        a directory of its own are added up"""
+        with tempfile.TemporaryDirectory() as root:
+            paths = [os.path.join(root, name) for name in ('app', 'celery')]
+            for path in paths:
+                os.mkdir(path)
+                subprocess.run(
+                    [sys.executable, '-c', 'from prometheus_client import '
+                     'Counter; Counter("xia_test", "Test").inc(2)'],
+                    env=dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path),
+                    check=True)
+
+            metric, = ContainerMetricsCollector(paths).collect()
+
+        self.assertEqual([(sample.name, sample.value)
+                          for sample in metric.samples],
+                         [('xia_test_total', 4.0)])
+
+    def test_xia_workflow_status(self):
+        """Test the status of a task is cached with an ETag and includes
+        the progress and stages of its run"""
+        run = create_workflow_run('task')
+        url = reverse('api:xia_workflow_status', args=['task'])
+        with patch('core.workflow.AsyncResult') as mock_result:
+            mock_result.return_value.status = 'PROGRESS'
+            mock_result.return_value.result = {'stage': 'extract',
+                                               'records_done': 10}
+            first = self.client.get(url)
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+            other = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+
+        self.assertEqual(mock_result.call_count, 1)
+        self.assertEqual(first.status_code, 200)
+        body = json.loads(first.content)
+        self.assertEqual(body['task_status'], 'PROGRESS')
+        self.assertEqual(body['task_result']['records_done'], 10)
+        self.assertEqual(body['run']['id'], run.pk)
+        self.assertEqual(body['run']['stages']['extract'], 'pending')
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], first['ETag'])
+        self.assertEqual(other.status_code, 200)
+
+    def test_xia_workflow_status_stage_progress(self):
+        """Test the progress of stages run by tasks of their own is part of
+        the status of the workflow task"""
+        run = create_workflow_run('task')
+        run.stages.filter(stage='load').update(status='running',
+                                               task_id='load-task')
+        run.stages.filter(stage='load_supplemental').update(
+            status='running', task_id='supplemental-task')
+        run.stages.filter(stage='extract').update(status='succeeded',
+                                                  task_id='extract-task')
+        results = {
+            'task': ('SUCCESS', run.pk),
+            'load-task': ('PROGRESS', {'stage': 'load'}),
+            'supplemental-task': ('PENDING', None),
+        }
+
+        def async_result(task_id):
+            task_status, result = results[task_id]
+            return type('AsyncResult', (), {'status': task_status,
+                                            'result': result})
+
+        with patch('core.workflow.AsyncResult', side_effect=async_result):
+            response = self.client.get(reverse('api:xia_workflow_status',
+                                               args=['task']))
+
+        body = json.loads(response.content)
+        self.assertEqual(body['task_status'], 'SUCCESS')
+        self.assertEqual(body['run']['progress'], {'load': {'stage': 'load'}})
+
+
+@tag('unit')
+class WebImportTests(SimpleTestCase):
+
+    def test_web_import_budget(self):
+        """Test a cold web process loads within its import time and memory
+        budget without importing the modules of the celery workers"""
+        output = subprocess.run(
+            [sys.executable, '-c', WEB_IMPORT_SCRIPT] + WORKER_MODULES,
+            cwd=settings.BASE_DIR, capture_output=True, text=True,
+            check=True).stdout
+        seconds, rss, imported = json.loads(output.splitlines()[-1])
+
+        self.assertEqual(imported, [])
+        self.assertLess(seconds, WEB_IMPORT_SECONDS)
+        self.assertLess(rss, WEB_IMPORT_RSS)
+
+
+@tag('unit')
+class EventStreamTests(SimpleTestCase):
+
+    def stream(self, path, statuses):
+        """Messages sent by the ASGI application for a GET of path while
+        the task goes through statuses"""
+        messages = []
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': b''}
+            # the client stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        async def django_application(scope, receive, send):
+            messages.append('django')
+
+        bodies = [json.dumps(status if isinstance(status, dict)
+                             else {'task_status': status})
+                  for status in statuses]
+        with patch('api.events.get_task_status', side_effect=bodies):
+            async_to_sync(route_task_events(django_application))(
+                {'type': 'http', 'method': 'GET', 'path': path},
+                receive, send)
+        return messages
+
+    @override_settings(XIA_EVENTS_INTERVAL=0, XIA_EVENTS_HEARTBEAT=0)
+    def test_task_events(self):
+        """Test each change of status is sent as an event until the task is
+        done, with keep-alive comments in between"""
+        messages = self.stream('/api/xia-workflow/events/task/',
+                               ['PENDING', 'PENDING', 'PROGRESS', 'SUCCESS'])
+
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'),
+                      messages[0]['headers'])
+        self.assertEqual(
+            [message['body'] for message in messages[1:]],
+            [b'data: {"task_status": "PENDING"}\n\n', b': keep-alive\n\n',
+             b'data: {"task_status": "PROGRESS"}\n\n',
+             b'data: {"task_status": "SUCCESS"}\n\n', b''])
+
+    @override_settings(XIA_EVENTS_INTERVAL=0, XIA_EVENTS_HEARTBEAT=1)
+    def test_task_events_run(self):
+        """Test the stream of a workflow task lasts until its run finished
+        although the task is done once it dispatched the first stages"""
+        statuses = [
+            {'task_status': 'SUCCESS', 'run': {'status': 'running',
+                                               'progress': {}}},
+            {'task_status': 'SUCCESS', 'run': {
+                'status': 'running', 'progress': {'load': {'stage': 'load'}}}},
+            {'task_status': 'SUCCESS', 'run': {'status': 'succeeded',
+                                               'progress': {}}},
+        ]
+
+        messages = self.stream('/api/xia-workflow/events/task/', statuses)
+
+        self.assertEqual(
+            [json.loads(message['body'][len(b'data: '):])
+             for message in messages[1:-1]], statuses)
+        self.assertEqual(messages[-1]['body'], b'')
+
+    @override_settings(XIA_EVENTS_INTERVAL=0, XIA_EVENTS_HEARTBEAT=1)
+    def test_task_events_run_task_failed(self):
+        """Test the stream ends when the workflow task failed"""
+        messages = self.stream('/api/xia-workflow/events/task/', [
+            {'task_status': 'FAILURE', 'run': {'status': 'running'}}])
+
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[-1]['body'], b'')
+
+    def test_other_requests(self):
+        """Test other paths are handled by the Django application"""
+        self.assertEqual(self.stream('/api/xia-workflow/', []), ['django'])
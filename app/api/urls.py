@@ -1,4 +1,5 @@
-from api.views import WorkflowView
+from api.views import (WorkflowRunListView, WorkflowRunView, WorkflowView,
+                       get_status, metrics)
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
@@ -8,5 +9,12 @@ app_name = 'api'
 
 urlpatterns = [
     path('xia-workflow/', WorkflowView.as_view(), name='xia_workflow'),
+    path('xia-workflow/runs/', WorkflowRunListView.as_view(),
+         name='xia_workflow_runs'),
+    path('xia-workflow/<int:run_id>/', WorkflowRunView.as_view(),
+         name='xia_workflow_run'),
+    path('xia-workflow/status/<str:task_id>/', get_status,
+         name='xia_workflow_status'),
+    path('metrics', metrics, name='metrics'),
 
 ]
@@ -1,8 +1,20 @@
+import hashlib
 import logging
+import uuid
 
-from celery.result import AsyncResult
-from core.tasks import execute_xia_automated_workflow
-from django.http import JsonResponse
+from api.serializers import WorkflowRunSerializer
+from core.metrics import generate_metrics
+from core.models import WorkflowRun
+from core.workflow import (WORKFLOW_TASK, abandon_workflow_run,
+                           acquire_workflow_lock,
+                           count_queued_workflow_tasks, create_workflow_run,
+                           get_task_status, release_workflow_lock,
+                           resume_workflow_run)
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET
+from openlxp_xia_ace_project.celery import app as celery_app
 from rest_framework import permissions, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
@@ -17,19 +29,102 @@ class WorkflowView(APIView):
 
     def get(self, request):
         logger.info('XIA workflow api')
-        task = execute_xia_automated_workflow.delay()
-        response_val = {"task_id": task.id}
+        # ?resume=<run id> runs again the stages of a run that did not
+        # complete
+        resume = request.query_params.get('resume')
+        if resume:
+            resume = get_object_or_404(WorkflowRun, pk=resume)
+        # ?profile=true profiles every stage of the run under XIA_PROFILE_DIR
+        profile = request.query_params.get('profile', '').lower() in (
+            'true', '1')
+
+        task_id = str(uuid.uuid4())
+        holder = acquire_workflow_lock(task_id)
+        if holder is not None:
+            # a run is in progress, hand out that one instead
+            logger.info('Workflow already running in task ' + holder)
+            run_id = WorkflowRun.objects.filter(task_id=holder).values_list(
+                'pk', flat=True).first()
+            return Response({"task_id": holder, "run_id": run_id},
+                            status=status.HTTP_202_ACCEPTED)
+
+        # runs celery beat sent wait on the broker without holding the
+        # lock, a new run would only queue up behind them
+        if count_queued_workflow_tasks() >= settings.XIA_WORKFLOW_MAX_QUEUED:
+            release_workflow_lock(task_id)
+            return Response({"message": "Too many workflow runs are "
+                                        "waiting for a worker"},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS)
+
+        run = None
+        try:
+            if resume:
+                run = resume_workflow_run(resume, task_id, profile)
+            else:
+                run = create_workflow_run(task_id, profile)
+            # sent by name, the web processes never import core.tasks
+            celery_app.send_task(WORKFLOW_TASK, (run.pk,), task_id=task_id)
+        except Exception:
+            # a run whose task was never sent would wait for a worker
+            # forever
+            if run is not None:
+                abandon_workflow_run(run)
+            release_workflow_lock(task_id)
+            raise
+        response_val = {"task_id": task_id, "run_id": run.pk}
 
         return Response(response_val, status=status.HTTP_202_ACCEPTED)
 
 
+@permission_classes((permissions.AllowAny,))
+class WorkflowRunView(APIView):
+    """Handles HTTP requests for the state of a workflow run"""
+
+    def get(self, request, run_id):
+        run = get_object_or_404(WorkflowRun.objects.prefetch_related(
+            'stages__configurations'), pk=run_id)
+        return Response(WorkflowRunSerializer(run).data,
+                        status=status.HTTP_200_OK)
+
+
+@permission_classes((permissions.AllowAny,))
+class WorkflowRunListView(APIView):
+    """Handles HTTP requests for the most recent workflow runs"""
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            return Response({"message": "limit must be a number"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), 100)
+        runs = WorkflowRun.objects.prefetch_related(
+            'stages__configurations').order_by('-created', '-pk')[:limit]
+        return Response(WorkflowRunSerializer(runs, many=True).data,
+                        status=status.HTTP_200_OK)
+
+
+@require_GET
+def metrics(request):
+    """Prometheus metrics of the XIA in the text exposition format"""
+    output, content_type = generate_metrics()
+    return HttpResponse(output, content_type=content_type)
+
+
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
 def get_status(request, task_id):
-    task_result = AsyncResult(task_id)
-    result = {
-        "task_id": task_id,
-        "task_status": task_result.status,
-        "task_result": task_result.result
-    }
-    return JsonResponse(result, status=200)
+    """Status of a celery task with the progress it published, answered
+    with 304 Not Modified when the ETag given in If-None-Match still
+    matches"""
+    body = get_task_status(task_id)
+    etag = '"' + hashlib.md5(body.encode('utf-8')).hexdigest() + '"'
+    if etag in [tag.strip() for tag in
+                request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'max-age=' + str(
+        settings.XIA_STATUS_CACHE_TTL)
+    return response
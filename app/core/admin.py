@@ -1,7 +1,7 @@
 from django import forms
 from django.contrib import admin
 
-from .models import XSRConfiguration
+from .models import StageRun, WorkflowRun, XSRConfiguration
 
 # Register your models here.
 
@@ -24,3 +24,21 @@ class XSRConfigurationAdmin(admin.ModelAdmin):
               'Subscription_key',
               'Parameter', 'API_type']
     form = MyForm
+
+
+class StageRunInline(admin.TabularInline):
+    model = StageRun
+    fields = ['stage', 'status', 'started', 'finished', 'wall_time',
+              'records_fetched', 'records_changed', 'records_written',
+              'http_bytes', 'query_count', 'peak_rss', 'error']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(WorkflowRun)
+class WorkflowRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'created', 'finished')
+    list_filter = ('status',)
+    readonly_fields = ['status', 'created', 'modified', 'finished']
+    inlines = [StageRunInline]
@@ -0,0 +1,215 @@
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import traceback
+
+from core.management.commands.extract_source_metadata import (
+    get_ledger_digest, get_source_metadata)
+from core.management.utils.ace_feed import ACE_FEED_ID_PREFIX, write_ace_feed
+from core.management.utils.xsr_stub import XSRStubServer
+from core.models import LedgerKeyIndex, XSRConfiguration
+from core.workflow import get_report_metrics, measure_resources
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from openlxp_xia.models import MetadataLedger
+
+logger = logging.getLogger('dict_config_logger')
+
+BENCHMARK_API_TYPES = ('Course', 'Occupation')
+BENCHMARK_SUBSCRIPTION_KEY = 'benchmark'
+# Settings recorded with the results as they change what is measured
+BENCHMARK_SETTINGS = ('XSR_STREAMING', 'XSR_STREAM_CHUNK_SIZE',
+                      'XSR_FETCH_CONCURRENCY', 'EXTRACT_BATCH_SIZE',
+                      'EXTRACT_HASH_WORKERS', 'EXTRACT_HASH_MIN_RECORDS')
+
+
+def write_benchmark_feeds(directory, records, api_types, seed=0):
+    """Write a synthetic feed of records records per API type to
+    directory, returns the path of each feed by name"""
+    feeds = {}
+    for api_type in api_types:
+        path = os.path.join(directory, api_type.lower() + '.json')
+        with open(path, 'wb') as file:
+            write_ace_feed(file, api_type, records, seed)
+        feeds[api_type.lower()] = path
+    return feeds
+
+
+def start_xsr_stub(feeds, subscription_key):
+    """Serve feeds from a child process so the stub does not compete with
+    the extraction for the interpreter, returns the server and process"""
+    server = XSRStubServer(feeds, subscription_key)
+    process = multiprocessing.get_context('fork').Process(
+        target=server.serve_forever, name='xsr-stub', daemon=True)
+    process.start()
+    # the child process accepts the connections
+    server.server_close()
+    return server, process
+
+
+def run_extraction(xsr_ids, stream, sender):
+    """Extract the XSR configurations xsr_ids in a benchmark child process,
+    sending its metrics, or the traceback of its failure, to sender"""
+    try:
+        with measure_resources() as metrics:
+            report = get_source_metadata(stream, full=True, xsr_ids=xsr_ids)
+        metrics.update(get_report_metrics(report))
+        sender.send((metrics, None))
+    except BaseException:
+        sender.send((None, traceback.format_exc()))
+    finally:
+        connections.close_all()
+
+
+def measure_extraction(xsr_ids, stream=None):
+    """Extract the XSR configurations xsr_ids in a child process of its
+    own and return its metrics, so the peak RSS is that of this
+    extraction and not the high-water mark of the earlier ones"""
+    # the child opens database connections of its own
+    connections.close_all()
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(
+        target=run_extraction, args=(xsr_ids, stream, sender),
+        name='benchmark-extraction')
+    process.start()
+    sender.close()
+    try:
+        metrics, error = receiver.recv()
+    except EOFError:
+        metrics, error = None, 'exited without results'
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError('Benchmark extraction failed: ' + error)
+    return metrics
+
+
+def delete_benchmark_records(xsr_ids, started):
+    """Delete the XSR configurations xsr_ids with the metadata ledger rows
+    of synthetic records extracted since started and their LedgerKeyIndex
+    rows"""
+    ledger = MetadataLedger.objects.filter(
+        source_metadata_key__startswith=ACE_FEED_ID_PREFIX,
+        source_metadata_extraction_date__gte=started)
+    key_digests = list({get_ledger_digest(key_value_hash)
+                        for key_value_hash in ledger.values_list(
+                            'source_metadata_key_hash', flat=True).iterator()})
+    size = settings.EXTRACT_BATCH_SIZE
+    with transaction.atomic():
+        for start in range(0, len(key_digests), size):
+            LedgerKeyIndex.objects.filter(
+                key_digest__in=key_digests[start:start + size]).delete()
+        deleted, _ = ledger.delete()
+        XSRConfiguration.objects.filter(pk__in=xsr_ids).delete()
+    logger.info('Deleted ' + str(deleted) + ' benchmark ledger rows')
+
+
+def measure_extractions(server, api_types, stream=None, repeat=1):
+    """Extract the stub feeds repeat times and return the metrics of each
+    run, what was extracted is deleted once done
+
+    Every run commits its batches as the extraction does in production.
+    The first run fills an empty ledger, the next ones find every record
+    unchanged.
+    """
+    started = timezone.now()
+    xsr_ids = [XSRConfiguration.objects.create(
+        Transcript_API=server.url(api_type.lower()),
+        Subscription_key=BENCHMARK_SUBSCRIPTION_KEY,
+        API_type=api_type).pk for api_type in api_types]
+    runs = []
+    try:
+        for number in range(repeat):
+            metrics = measure_extraction(xsr_ids, stream)
+            metrics['run'] = number + 1
+            metrics['records_per_second'] = \
+                metrics['records_fetched'] / metrics['wall_time']
+            runs.append(metrics)
+    finally:
+        delete_benchmark_records(xsr_ids, started)
+    return runs
+
+
+def run_benchmark(records=1000, api_types=BENCHMARK_API_TYPES, stream=None,
+                  repeat=1, seed=0, label=None):
+    """Benchmark extract_source_metadata against synthetic feeds of records
+    records per API type served by a local XSR stub"""
+    if stream is None:
+        stream = settings.XSR_STREAMING
+    with tempfile.TemporaryDirectory() as directory:
+        logger.info('Generating ' + str(records) + ' records per feed')
+        feeds = write_benchmark_feeds(directory, records, api_types, seed)
+        server, process = start_xsr_stub(feeds, BENCHMARK_SUBSCRIPTION_KEY)
+        try:
+            runs = measure_extractions(server, api_types, stream, repeat)
+        finally:
+            process.terminate()
+            process.join()
+
+    return {
+        'created': timezone.now().isoformat(),
+        'label': label,
+        'records': records,
+        'api_types': list(api_types),
+        'seed': seed,
+        'stream': stream,
+        'database': connection.vendor,
+        'settings': {name: getattr(settings, name)
+                     for name in BENCHMARK_SETTINGS},
+        'runs': runs,
+    }
+
+
+class Command(BaseCommand):
+    """Django command benchmarking the extraction from a local XSR stub
+    serving synthetic ACE feeds"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--records', type=int, default=1000,
+            help='Number of records in each feed')
+        parser.add_argument(
+            '--type', choices=BENCHMARK_API_TYPES, action='append',
+            dest='api_types', help='Type of feed to extract, can be '
+                                   'repeated, both types by default')
+        parser.add_argument(
+            '--stream', action='store_true', default=None,
+            help='Read the feeds incrementally')
+        parser.add_argument(
+            '--repeat', type=int, default=1,
+            help='Number of extractions, the ones after the first find '
+                 'every record unchanged')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the synthetic feeds')
+        parser.add_argument(
+            '--label', help='Name of the version being measured')
+        parser.add_argument(
+            '--output', help='File receiving the results as JSON')
+
+    def handle(self, *args, **options):
+        """
+            Synthetic feeds are extracted and the measurements are saved
+        """
+        results = run_benchmark(options['records'],
+                                options['api_types'] or BENCHMARK_API_TYPES,
+                                options['stream'], options['repeat'],
+                                options['seed'], options['label'])
+
+        output = options['output'] or 'benchmark-' + \
+            timezone.now().strftime('%Y%m%dT%H%M%S') + '.json'
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+        for run in results['runs']:
+            self.stdout.write(
+                'Run {run}: {records_fetched} records in {wall_time:.2f}s '
+                '({records_per_second:.0f} records/s), {records_written} '
+                'ledger rows written, {query_count} queries, peak RSS '
+                '{peak_rss_mb:.0f} MB'.format(
+                    peak_rss_mb=run['peak_rss'] / 2 ** 20, **run))
+        self.stdout.write('Results saved to ' + output)
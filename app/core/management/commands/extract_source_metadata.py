@@ -1,33 +1,142 @@
 import hashlib
-import json
 import logging
+import os
+import random
+import re
+import time
+from contextlib import contextmanager, nullcontext
 
+import billiard
+from core.management.utils.canonical_json import (dumps_canonical,
+                                                  hash_canonical,
+                                                  loads_canonical)
+from core.management.utils.profiling import (is_profiling, profile_phase,
+                                             profiling)
+from core.management.utils.progress import (is_reporting_progress,
+                                            report_progress)
+from core.management.utils.snapshot import SnapshotSession, SnapshotWriter
 from core.management.utils.xsr_client import (custom_ACE_data,
+                                              custom_ACE_records,
                                               custom_ACE_setting_areas,
                                               extract_source,
-                                              get_source_metadata_key_value)
+                                              get_source_metadata_key_values,
+                                              save_xsr_state)
+from core.metrics import LEDGER_RECORDS
+from core.models import LedgerKeyIndex
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import InternalError, OperationalError, transaction
 from django.utils import timezone
-from openlxp_xia.management.utils.xia_internal import convert_date_to_isoformat
+from openlxp_xia.management.utils.model_help import (
+    bleach_data_to_json, confusable_homoglyphs_check)
 from openlxp_xia.models import MetadataLedger
 
 logger = logging.getLogger('dict_config_logger')
 
+# characters without which bleaching leaves a string unchanged, the html5lib
+# tokenizer of bleach rewrites control characters other than tab and newline
+BLEACHED_CHARACTERS = re.compile('[<&\x00-\x08\x0b-\x1f]')
 
-def get_source_metadata():
-    """Retrieving source metadata"""
 
+def get_source_metadata(stream=None, full=False, replay=None, xsr_ids=None):
+    """Retrieving source metadata, from the snapshot directory replay
+    instead of the XSR when given, of the XSR configurations with an id
+    in xsr_ids only when given, returns the report of the extraction"""
+
+    report = {'fetched': [], 'skipped': [], 'configurations': {},
+              'records_written': 0, 'records_processed': 0}
+    hash_index = ActiveHashIndex()
+    if replay is not None:
+        logger.info('Replaying XSR snapshot ' + replay)
+        # a snapshot holds whole feeds, watermarks and fingerprints of
+        # the recorded run do not apply
+        replay = SnapshotSession(replay)
+        full = True
+        snapshot = None
+    else:
+        snapshot = SnapshotWriter.create()
     #  Retrieve metadata from agents as a list of sources
-    df_source_list = extract_source()
+    df_source_list = extract_source(stream, full, report, snapshot, replay,
+                                    xsr_ids)
     # Iterate through the list of sources and extract metadata
-    for source_item in df_source_list:
-        if source_item.empty:
-            logger.error("Source metadata is empty!")
-        extract_metadata_using_key(source_item)
+    try:
+        with metadata_hash_pool() as pool:
+            for source_item in df_source_list:
+                if not len(source_item):
+                    logger.error("Source metadata is empty!")
+                report['records_written'] += extract_metadata_using_key(
+                    source_item, hash_index, pool, report)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+
+    report_extract_progress(report, force=True)
+    report['unchanged'] = hash_index.unchanged
+    report['records_changed'] = hash_index.changed
+    logger.info(str(hash_index.unchanged) + ' unchanged records skipped')
+
+    if replay is not None:
+        # replayed configurations are not the stored ones
+        return report
+    # Fingerprints are only kept once the records made it to the ledger
+    save_xsr_state(report['fetched'] + report['skipped'])
+    if report['skipped']:
+        logger.info('Skipped unchanged XSR configurations: ' + ', '.join(
+            xsr_obj.Transcript_API for xsr_obj in report['skipped']))
+    return report
+
+
+def report_extract_progress(report, force=False):
+    """Report the records processed out of those fetched so far and the
+    status of every XSR configuration of the extraction report"""
+    if not is_reporting_progress():
+        return
+    configurations = {}
+    for xsr_obj, counters in report['configurations'].items():
+        if xsr_obj in report['skipped']:
+            status = 'skipped'
+        elif xsr_obj in report['fetched']:
+            status = 'fetched'
+        else:
+            status = 'fetching'
+        configurations[str(xsr_obj.pk)] = {
+            'Transcript_API': xsr_obj.Transcript_API, 'status': status,
+            'records_fetched': counters['records_fetched']}
+    report_progress(force, records_done=report['records_processed'],
+                    records_total=sum(
+                        counters['records_fetched']
+                        for counters in report['configurations'].values()),
+                    configurations=configurations)
+
+
+@contextmanager
+def metadata_hash_pool():
+    """Process pool of EXTRACT_HASH_WORKERS workers hashing metadata, None
+    when hashing stays in the current process"""
+    workers = settings.EXTRACT_HASH_WORKERS
+    if workers <= 1:
+        yield None
+        return
+    if is_profiling():
+        # the profile would not see the work done by other processes
+        logger.info('Hashing metadata serially while profiling')
+        yield None
+        return
+    # the pool of celery, unlike multiprocessing, starts processes from
+    # daemonic processes such as the prefork celery workers
+    pool = billiard.Pool(workers)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
 
 
 def add_publisher_to_source(source_df):
-    """Add publisher column to source metadata and return source metadata"""
+    """Add publisher column to source metadata and return source metadata,
+    source_df being a dataframe or a list of record dictionaries"""
 
     # Get publisher name from system operator
     # publisher = get_publisher_detail()
@@ -35,80 +144,454 @@ def add_publisher_to_source(source_df):
     if not publisher:
         logger.warning("Publisher field is empty!")
     # Assign publisher column to source data
+    if isinstance(source_df, list):
+        for record in source_df:
+            record['SOURCESYSTEM'] = publisher
+        return source_df
     source_df['SOURCESYSTEM'] = publisher
     return source_df
 
 
+def get_ledger_digest(value):
+    """Compact digest of a key hash or metadata hash of the ledger, as
+    stored in LedgerKeyIndex"""
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+
+
+class ActiveHashIndex:
+    """Run-scoped map of key digest to metadata digest of the Active ledger
+    records, loaded from the LedgerKeyIndex with one streaming query on
+    first use
+
+    Keys the LedgerKeyIndex has no Active version for, such as keys with
+    more than one Active version, always go through the ledger writer.
+    """
+
+    def __init__(self):
+        self._index = None
+        self.unchanged = 0
+        self.changed = 0
+
+    def _load(self):
+        self._index = dict(LedgerKeyIndex.objects.filter(
+            ledger__record_lifecycle_status='Active').values_list(
+            'key_digest', 'metadata_digest').iterator(chunk_size=10000))
+        logger.info('Loaded ' + str(len(self._index)) +
+                    ' active ledger keys')
+
+    def is_unchanged(self, key_value_hash, hash_value):
+        """Whether the metadata is already the only Active version"""
+        if self._index is None:
+            self._load()
+        current = self._index.get(get_ledger_digest(key_value_hash))
+        if current is not None and current == get_ledger_digest(hash_value):
+            self.unchanged += 1
+            return True
+        return False
+
+    def add(self, key_value_hash, hash_value):
+        """Record the version just queued for the ledger, catching
+        repeats of a key later in the same run"""
+        if self._index is None:
+            self._load()
+        self._index[get_ledger_digest(key_value_hash)] = \
+            get_ledger_digest(hash_value)
+        self.changed += 1
+
+
+def is_newer_metadata(last_updated_on, previous_last_updated_on):
+    """Compare LastUpdatedOn values the way the ledger always has, a
+    version without a date never supersedes a dated one"""
+    if previous_last_updated_on is None:
+        return True
+    if last_updated_on is None:
+        return False
+    return last_updated_on >= previous_last_updated_on
+
+
+def new_ledger_record(key_value, key_value_hash, hash_value, metadata):
+    """Build an unsaved MetadataLedger record, applying the homoglyph
+    check MetadataLedger.save performs as bulk_create bypasses it
+
+    metadata was bleached by encode_source_metadata, so the check applies
+    to the metadata as it is stored.
+    """
+    record = MetadataLedger(source_metadata_key=key_value,
+                            source_metadata_key_hash=key_value_hash,
+                            source_metadata=metadata,
+                            source_metadata_hash=hash_value,
+                            record_lifecycle_status='Active')
+    if not confusable_homoglyphs_check(metadata):
+        record.record_lifecycle_status = 'Inactive'
+        record.metadata_record_inactivation_date = timezone.now()
+    return record
+
+
+@profile_phase('ledger_write')
+def store_source_metadata_batch(records):
+    """Store a chunk of (key, key hash, hash, metadata) tuples from the
+    Experience Source Repository(XSR) in the metadata ledger, the metadata
+    being bleached already as encode_source_metadata does
+
+    The LedgerKeyIndex rows of the keys are locked first, so writers of the
+    same keys in other processes wait for this batch. Active versions of
+    the keys are read from the locked rows, and from the ledger for the
+    keys they do not index, superseded versions are inactivated with one
+    UPDATE and new versions are inserted with bulk_create, all in one
+    transaction along with the index rows of the keys. Records are applied
+    in order, so a key repeated within the chunk behaves as if stored one
+    at a time. The number of ledger rows inserted or inactivated is
+    returned.
+    """
+    records = list(records)
+    if not records:
+        return 0
+
+    # a batch written inside a caller's transaction becomes part of it, and
+    # is retried by that caller if at all
+    attempts = 1 if transaction.get_connection().in_atomic_block else \
+        max(settings.EXTRACT_WRITE_ATTEMPTS, 1)
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic(savepoint=False):
+                inactivated, inserted, skipped = \
+                    apply_source_metadata_batch(records)
+            break
+        # deadlocks are reported as either depending on the database driver
+        except (OperationalError, InternalError) as err:
+            if attempt == attempts:
+                raise
+            logger.warning('Retrying ledger write after ' + repr(err))
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    LEDGER_RECORDS.labels('inserted').inc(inserted)
+    LEDGER_RECORDS.labels('inactivated').inc(inactivated)
+    LEDGER_RECORDS.labels('skipped').inc(skipped)
+    return inactivated + inserted
+
+
+def lock_ledger_keys(key_digests):
+    """Lock the LedgerKeyIndex rows of key_digests until the transaction
+    ends, inserting rows without digests for keys that have none, returns
+    the locked rows as (key digest, metadata digest, LastUpdatedOn, ledger
+    id, ledger status) tuples
+
+    Missing rows are inserted before anything is locked, so the locks are
+    taken on existing rows only and not on the gaps MySQL locks for
+    missing keys, where writers of other keys would deadlock. Keys are
+    looked up without locking first, as inserting a key that exists
+    shares its lock. Rows are inserted and locked in key order, so writers
+    of overlapping batches wait for each other instead of holding each
+    other's rows.
+    """
+    existing = set(LedgerKeyIndex.objects.filter(
+        key_digest__in=key_digests).values_list('key_digest', flat=True))
+    missing = sorted(set(key_digests) - existing)
+    if missing:
+        LedgerKeyIndex.objects.bulk_create(
+            [LedgerKeyIndex(key_digest=key_digest) for key_digest in missing],
+            ignore_conflicts=True)
+    # only the index rows are locked, not the ledger rows they point to
+    return list(LedgerKeyIndex.objects.select_for_update(
+        of=('self',)).filter(key_digest__in=key_digests).order_by(
+        'key_digest').values_list(
+        'key_digest', 'metadata_digest', 'last_updated_on', 'ledger_id',
+        'ledger__record_lifecycle_status'))
+
+
+def get_active_versions(key_digests):
+    """Active versions of the keys of key_digests, a map of key hash to
+    its digest, as lists of [metadata digest, LastUpdatedOn, pk, None] per
+    key digest, with the key digests that were missing from the index
+
+    The index rows of the keys stay locked until the transaction ends.
+    """
+    active = {}
+    for key_digest, metadata_digest, last_updated_on, pk, status in \
+            lock_ledger_keys(set(key_digests.values())):
+        if status == 'Active':
+            active[key_digest] = [[metadata_digest, last_updated_on, pk,
+                                   None]]
+
+    missing = {key_value_hash for key_value_hash, key_digest in
+               key_digests.items() if key_digest not in active}
+    if missing:
+        for pk, key_value_hash, hash_value, last_updated_on in \
+                MetadataLedger.objects.filter(
+                    source_metadata_key_hash__in=missing,
+                    record_lifecycle_status='Active').values_list(
+                    'pk', 'source_metadata_key_hash', 'source_metadata_hash',
+                    'source_metadata__LastUpdatedOn'):
+            active.setdefault(key_digests[key_value_hash], []).append(
+                [get_ledger_digest(hash_value), last_updated_on, pk, None])
+    return active, {key_digests[key_value_hash]
+                    for key_value_hash in missing}
+
+
+def update_ledger_key_index(active, key_digests):
+    """Set the locked LedgerKeyIndex rows of key_digests to the Active
+    version of each key in active, the digests of keys with several Active
+    versions or a LastUpdatedOn that does not fit are cleared"""
+    if not key_digests:
+        return
+    max_length = LedgerKeyIndex._meta.get_field('last_updated_on').max_length
+    rows = []
+    for key_digest in key_digests:
+        # the rows are updated in place, deleting them would release the
+        # lock writers of the same keys are waiting on
+        row = LedgerKeyIndex(key_digest=key_digest)
+        rows.append(row)
+        versions = active.get(key_digest, [])
+        if len(versions) != 1:
+            continue
+        metadata_digest, last_updated_on, pk, record = versions[0]
+        if last_updated_on is not None and (
+                not isinstance(last_updated_on, str) or
+                len(last_updated_on) > max_length):
+            continue
+        row.metadata_digest = metadata_digest
+        row.last_updated_on = last_updated_on
+        row.ledger_id = pk if record is None else record.pk
+    LedgerKeyIndex.objects.bulk_update(
+        rows, ['metadata_digest', 'last_updated_on', 'ledger'])
+
+
+def apply_source_metadata_batch(records):
+    """Write the records of store_source_metadata_batch to the ledger,
+    returns the number of rows inactivated, inserted and skipped"""
+    key_digests = {record[1]: get_ledger_digest(record[1])
+                   for record in records}
+    # Active versions per key digest as
+    # [metadata digest, LastUpdatedOn, pk, record]
+    active, changed = get_active_versions(key_digests)
+
+    inactivate = set()
+    new_records = []
+    skipped = 0
+    for key_value, key_value_hash, hash_value, metadata in records:
+        key_digest = key_digests[key_value_hash]
+        versions = active.setdefault(key_digest, [])
+        last_updated_on = metadata.get("LastUpdatedOn")
+        hash_value_digest = get_ledger_digest(hash_value)
+
+        for version in list(versions):
+            if (version[0] != hash_value_digest and
+                    is_newer_metadata(last_updated_on, version[1])):
+                # Setting record_status & deleted_date for updated record
+                changed.add(key_digest)
+                versions.remove(version)
+                if version[3] is None:
+                    inactivate.add(version[2])
+                else:
+                    version[3].record_lifecycle_status = 'Inactive'
+                    version[3].metadata_record_inactivation_date = \
+                        timezone.now()
+
+        if any(version[0] == hash_value_digest for version in versions):
+            skipped += 1
+            continue
+
+        record = new_ledger_record(key_value, key_value_hash, hash_value,
+                                   metadata)
+        new_records.append(record)
+        if record.record_lifecycle_status == 'Active':
+            changed.add(key_digest)
+            versions.append([hash_value_digest, last_updated_on, None,
+                             record])
+
+    inactivated = 0
+    if inactivate:
+        now = timezone.now()
+        inactivated = MetadataLedger.objects.filter(
+            pk__in=inactivate).update(
+            metadata_record_inactivation_date=now,
+            record_lifecycle_status='Inactive',
+            modified=now)
+    MetadataLedger.objects.bulk_create(new_records)
+    update_ledger_key_index(active, changed)
+    return inactivated, len(new_records), skipped
+
+
 def store_source_metadata(key_value, key_value_hash, hash_value, metadata):
     """Extract data from Experience Source Repository(XSR)
         and store in metadata ledger
     """
+    store_source_metadata_batch(
+        [(key_value, key_value_hash, hash_value, metadata)])
 
-    record_exists = MetadataLedger.objects.filter(
-        source_metadata_key_hash=key_value_hash,
-        record_lifecycle_status='Active').exclude(
-        source_metadata_hash=hash_value)
-
-    for record in record_exists:
-        if (record and
-            (metadata["LastUpdatedOn"] >=
-             record.source_metadata["LastUpdatedOn"])):
-            # Setting record_status & deleted_date for updated record
-            record.metadata_record_inactivation_date = timezone.now()
-            record.record_lifecycle_status = 'Inactive'
-            record.save()
-
-    # Retrieving existing records or creating new record to MetadataLedger
-    MetadataLedger.objects.get_or_create(
-        source_metadata_key=key_value,
-        source_metadata_key_hash=key_value_hash,
-        source_metadata=metadata,
-        source_metadata_hash=hash_value,
-        record_lifecycle_status='Active')
-
-
-def extract_metadata_using_key(source_df):
-    """Creating key, hash of key & hash of metadata """
-    # Convert source data to dictionary and add publisher to metadata
-    source_df = add_publisher_to_source(source_df)
-    source_data_dict = source_df.to_dict(orient='index')
 
-    logger.info('Setting record_status & deleted_date for updated record')
-    logger.info('Getting existing records or creating new record to '
-                'MetadataLedger')
-    for temp_key, temp_val in source_data_dict.items():
-        # key dictionary creation function called
-        key = \
-            get_source_metadata_key_value(source_data_dict[temp_key])
+def shape_source_metadata(metadata):
+    """Apply the ACE customizations to a record"""
+    temp_val_modified = custom_ACE_data(metadata)
 
-        # Call store function with key, hash of key, hash of metadata,
-        # metadata
+    return custom_ACE_setting_areas(temp_val_modified)
+
+
+def bleach_source_metadata(metadata):
+    """metadata as bleach_data_to_json bleaches it, without changing it
+
+    Only the strings bleaching can change are passed to bleach, most
+    records have none and are returned as they are.
+    """
+    bleached = metadata
+    for key, value in metadata.items():
+        if isinstance(value, str):
+            if not BLEACHED_CHARACTERS.search(value):
+                continue
+            value = bleach_data_to_json({key: value})[key]
+        elif isinstance(value, dict):
+            value = bleach_source_metadata(value)
+        else:
+            continue
+        if value is not metadata[key]:
+            if bleached is metadata:
+                bleached = dict(metadata)
+            bleached[key] = value
+    return bleached
 
-        temp_val_modified = custom_ACE_data(temp_val)
 
-        temp_val_convert = json.dumps(temp_val_modified,
-                                      default=convert_date_to_isoformat)
-        temp_json = json.loads(temp_val_convert)
+def encode_source_metadata(metadata):
+    """Canonical encoding of a customized record with the hash of it"""
+    # stored metadata and its hash come from one canonical encoding of the
+    # bleached record, which rehash_source_metadata encodes again
+    temp_val_encoded = dumps_canonical(bleach_source_metadata(metadata))
+    return temp_val_encoded, hash_canonical(temp_val_encoded)
 
-        temp_val_json = custom_ACE_setting_areas(temp_json)
 
-        # creating hash value of metadata
-        hash_value = hashlib.sha512(str(temp_val_json).encode('utf-8')).\
-            hexdigest()
+def hash_source_metadata(metadata):
+    """Apply the ACE customizations to a record and return its canonical
+    encoding with the hash of it"""
+    return encode_source_metadata(shape_source_metadata(metadata))
 
-        if key:
-            store_source_metadata(key['key_value'], key['key_value_hash'],
-                                  hash_value, temp_val_json)
+
+def hash_source_metadata_records(records):
+    """hash_source_metadata of a list of records, customized together"""
+    return [encode_source_metadata(record)
+            for record in custom_ACE_records(records)]
+
+
+def hash_source_metadata_chunk(records, pool=None):
+    """hash_source_metadata of every record, spread over the pool when
+    there are at least EXTRACT_HASH_MIN_RECORDS of them"""
+    if is_profiling():
+        # customizing and encoding are profiled as phases of their own
+        with profile_phase('shaping'):
+            shaped = custom_ACE_records(records)
+        with profile_phase('hashing'):
+            return [encode_source_metadata(record) for record in shaped]
+    if pool is None or len(records) < settings.EXTRACT_HASH_MIN_RECORDS:
+        return hash_source_metadata_records(records)
+    size = -(-len(records) // (settings.EXTRACT_HASH_WORKERS * 4))
+    # a job per part, billiard only credits the first worker of a map with
+    # its results and the others wait 30 seconds for them when exiting
+    parts = [pool.apply_async(hash_source_metadata_records,
+                              (records[start:start + size],))
+             for start in range(0, len(records), size)]
+    return [hashed for part in parts for hashed in part.get()]
+
+
+def iter_source_chunks(source_df, size):
+    """Yield the records of source_df, a dataframe or a list of record
+    dictionaries, in lists of at most size records, a dataframe being
+    converted to dictionaries one chunk at a time"""
+    for start in range(0, len(source_df), size):
+        if isinstance(source_df, list):
+            yield source_df[start:start + size]
+        else:
+            yield source_df.iloc[start:start + size].to_dict(
+                orient='records')
+
+
+def extract_metadata_using_key(source_df, hash_index=None, pool=None,
+                               report=None):
+    """Creating key, hash of key & hash of metadata, records already in
+    the hash_index unchanged are not sent to the ledger, returns the
+    number of ledger rows written
+
+    The source is processed EXTRACT_BATCH_SIZE records at a time, each
+    chunk being written to the ledger in one transaction, so only one
+    chunk of records is held as dictionaries at a time. The records
+    processed are counted in the extraction report when given, and
+    reported as the progress of the extraction after every chunk.
+    """
+    # add publisher to metadata
+    source_df = add_publisher_to_source(source_df)
+
+    logger.info('Setting record_status & deleted_date for updated record')
+    logger.info('Getting existing records or creating new record to '
+                'MetadataLedger')
+    written = 0
+    skipped = 0
+    for records in iter_source_chunks(source_df,
+                                      settings.EXTRACT_BATCH_SIZE):
+        # key dictionaries of the chunk, records without one are dropped
+        keyed = [(key, record) for key, record in
+                 zip(get_source_metadata_key_values(records), records)
+                 if key]
+        hashed = hash_source_metadata_chunk(
+            [record for _, record in keyed], pool)
+
+        batch = []
+        for (key, _), (temp_val_encoded, hash_value) in zip(keyed, hashed):
+            if hash_index is not None:
+                if hash_index.is_unchanged(key['key_value_hash'],
+                                           hash_value):
+                    skipped += 1
+                    continue
+                hash_index.add(key['key_value_hash'], hash_value)
+            # Call store function with key, hash of key, hash of metadata,
+            # metadata
+            batch.append((key['key_value'], key['key_value_hash'],
+                          hash_value, loads_canonical(temp_val_encoded)))
+        written += store_source_metadata_batch(batch)
+        if report is not None:
+            report['records_processed'] += len(records)
+            report_extract_progress(report)
+
+    LEDGER_RECORDS.labels('skipped').inc(skipped)
+    return written
 
 
 class Command(BaseCommand):
     """Django command to extract data from Experience Source Repository (
     XSR) """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stream', action='store_true', default=None,
+            help='Read XSR responses incrementally in bounded chunks')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Extract every feed even when it did not change')
+        parser.add_argument(
+            '--config', type=int, action='append', dest='xsr_ids',
+            metavar='ID', help='Only extract the XSR configuration with '
+                               'this id, can be repeated')
+        parser.add_argument(
+            '--replay', metavar='SNAPSHOT',
+            help='Extract from a snapshot directory instead of the XSR, a '
+                 'relative path being read under XSR_SNAPSHOT_DIR when set')
+        parser.add_argument(
+            '--profile', nargs='?', const='', metavar='DIR',
+            help='Profile each phase of the extraction, saving a pstats '
+                 'file per phase and an allocation summary to DIR, a new '
+                 'directory under XIA_PROFILE_DIR by default')
+
     def handle(self, *args, **options):
         """
             Metadata is extracted from XSR and stored in Metadata Ledger
         """
-        get_source_metadata()
+        replay = options.get('replay')
+        if replay is not None and settings.XSR_SNAPSHOT_DIR:
+            # absolute paths are kept as given
+            replay = os.path.join(settings.XSR_SNAPSHOT_DIR, replay)
+        profile = options.get('profile')
+        if profile == '':
+            profile = os.path.join(settings.XIA_PROFILE_DIR, 'extract-' +
+                                   timezone.now().strftime('%Y%m%dT%H%M%S'))
+        with profiling(profile) if profile is not None else nullcontext(), \
+                profile_phase('extract'):
+            get_source_metadata(options.get('stream'),
+                                options.get('full', False),
+                                replay, options.get('xsr_ids'))
 
         logger.info('MetadataLedger updated with extracted data from XSR')
@@ -0,0 +1,226 @@
+import json
+import logging
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from core.workflow import (acquire_workflow_lock, create_workflow_run,
+                           release_workflow_lock)
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+logger = logging.getLogger('dict_config_logger')
+
+# Serving modes of gunicorn.conf.py
+LOAD_TEST_MODES = ('development', 'threaded', 'asgi')
+# Endpoints requested in turn, the workflow trigger and the task status
+LOAD_TEST_ENDPOINTS = ('xia-workflow', 'status')
+# Seconds a started server is given to answer its first request
+LOAD_TEST_STARTUP_TIMEOUT = 60
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the sorted values, None without any"""
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def get_free_port():
+    """Local TCP port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port):
+    """Start gunicorn serving the project in mode on a local port, returns
+    the process and the URL of the server once it answers"""
+    env = dict(os.environ, XIA_SERVER_MODE=mode,
+               GUNICORN_BIND='127.0.0.1:' + str(port))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py'],
+        cwd=settings.BASE_DIR, env=env)
+    url = 'http://127.0.0.1:' + str(port)
+    deadline = time.monotonic() + LOAD_TEST_STARTUP_TIMEOUT
+    while True:
+        if process.poll() is not None:
+            raise CommandError('gunicorn exited with status ' +
+                               str(process.returncode) + ' in ' + mode +
+                               ' mode')
+        try:
+            requests.get(url + '/api/xia-workflow/runs/?limit=1', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            if time.monotonic() > deadline:
+                stop_server(process)
+                raise CommandError('gunicorn did not answer on ' + url)
+            time.sleep(0.2)
+
+
+def stop_server(process):
+    """Stop a server started by start_server"""
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+@contextmanager
+def workflow_in_progress():
+    """Hold the workflow lock for a run of its own, so triggers answer with
+    that run instead of sending tasks, yields the task id of the run in
+    progress"""
+    task_id = 'load-test-' + str(uuid.uuid4())
+    holder = acquire_workflow_lock(task_id)
+    if holder is not None:
+        # triggers already hand out the run in progress
+        yield holder
+        return
+    run = create_workflow_run(task_id)
+    try:
+        yield task_id
+    finally:
+        release_workflow_lock(task_id)
+        run.delete()
+
+
+def measure_endpoints(url, task_id, count, concurrency):
+    """Send count GET requests from concurrency threads, alternating between
+    the workflow trigger and the status of task_id, returns the latency
+    of each endpoint"""
+    urls = {
+        'xia-workflow': url + '/api/xia-workflow/',
+        'status': url + '/api/xia-workflow/status/' + task_id + '/',
+    }
+    sessions = []
+    local = threading.local()
+
+    def send(number):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        name = LOAD_TEST_ENDPOINTS[number % len(LOAD_TEST_ENDPOINTS)]
+        started = time.perf_counter()
+        try:
+            ok = local.session.get(urls[name], timeout=30).status_code < 400
+        except requests.RequestException:
+            ok = False
+        return name, time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(count)))
+    wall_time = time.perf_counter() - started
+    for session in sessions:
+        session.close()
+
+    endpoints = {}
+    for name in LOAD_TEST_ENDPOINTS:
+        seconds = sorted(elapsed for endpoint, elapsed, ok in results
+                         if endpoint == name and ok)
+        sent = sum(1 for endpoint, _, _ in results if endpoint == name)
+        endpoints[name] = {
+            'requests': sent,
+            'errors': sent - len(seconds),
+            'p50_ms': percentile(seconds, 0.5) * 1000 if seconds else None,
+            'p99_ms': percentile(seconds, 0.99) * 1000 if seconds else None,
+            'requests_per_second': len(seconds) / wall_time,
+        }
+    return endpoints
+
+
+def run_load_test(modes=LOAD_TEST_MODES, url=None, count=2000,
+                  concurrency=16, warmup=100, label=None):
+    """Load test the web tier in each serving mode, or the server at url
+    when given, with count requests after warmup unmeasured ones"""
+    runs = []
+    with workflow_in_progress() as task_id:
+        for mode in [None] if url is not None else modes:
+            process = None
+            if mode is not None:
+                logger.info('Starting gunicorn in ' + mode + ' mode')
+                process, server_url = start_server(mode, get_free_port())
+            else:
+                server_url = url.rstrip('/')
+            try:
+                measure_endpoints(server_url, task_id, warmup, concurrency)
+                endpoints = measure_endpoints(server_url, task_id, count,
+                                              concurrency)
+            finally:
+                if process is not None:
+                    stop_server(process)
+            runs.append({'mode': mode or server_url, 'endpoints': endpoints})
+
+    return {
+        'created': timezone.now().isoformat(),
+        'label': label,
+        'requests': count,
+        'concurrency': concurrency,
+        'cpus': os.cpu_count(),
+        'runs': runs,
+    }
+
+
+class Command(BaseCommand):
+    """Django command load testing the workflow trigger and status
+    endpoints in each serving mode of the web tier"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode', choices=LOAD_TEST_MODES, action='append',
+            dest='modes', help='Serving mode to start gunicorn in, can be '
+                               'repeated, every mode by default')
+        parser.add_argument(
+            '--url', help='Load test the server running at this URL '
+                          'instead of starting gunicorn')
+        parser.add_argument(
+            '--requests', type=int, default=2000, dest='count',
+            help='Number of measured requests per serving mode')
+        parser.add_argument(
+            '--concurrency', type=int, default=16,
+            help='Number of requests in flight at a time')
+        parser.add_argument(
+            '--warmup', type=int, default=100,
+            help='Number of requests sent before measuring')
+        parser.add_argument(
+            '--label', help='Name of the version being measured')
+        parser.add_argument(
+            '--output', help='File receiving the results as JSON')
+
+    def handle(self, *args, **options):
+        """
+            Each serving mode is load tested and the latencies are saved
+        """
+        results = run_load_test(options['modes'] or LOAD_TEST_MODES,
+                                options['url'], options['count'],
+                                options['concurrency'], options['warmup'],
+                                options['label'])
+
+        output = options['output'] or 'load-test-' + \
+            timezone.now().strftime('%Y%m%dT%H%M%S') + '.json'
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+        for run in results['runs']:
+            for name, endpoint in run['endpoints'].items():
+                if endpoint['p50_ms'] is None:
+                    self.stdout.write('{mode} {name}: every request '
+                                      'failed'.format(name=name, **run))
+                    continue
+                self.stdout.write(
+                    '{mode} {name}: p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} '
+                    'ms, {requests_per_second:.0f} requests/s, {errors} '
+                    'errors'.format(name=name, mode=run['mode'], **endpoint))
+        self.stdout.write('Results saved to ' + output)
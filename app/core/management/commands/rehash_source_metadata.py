@@ -0,0 +1,62 @@
+import logging
+
+from core.management.utils.canonical_json import (dumps_canonical,
+                                                  hash_canonical)
+from core.models import LedgerKeyIndex
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from openlxp_xia.models import MetadataLedger
+
+logger = logging.getLogger('dict_config_logger')
+
+
+def rehash_source_metadata(batch_size=None):
+    """Recompute source_metadata_hash of every ledger record from its
+    canonical encoding and return the number of records updated"""
+    batch_size = batch_size or settings.EXTRACT_BATCH_SIZE
+    updated = 0
+    last_pk = None
+    while True:
+        # page by primary key so no cursor stays open across the updates
+        rows = MetadataLedger.objects.order_by('pk')
+        if last_pk is not None:
+            rows = rows.filter(pk__gt=last_pk)
+        rows = list(rows.values_list(
+            'pk', 'source_metadata', 'source_metadata_hash')[:batch_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        batch = []
+        for pk, metadata, old_hash in rows:
+            new_hash = hash_canonical(dumps_canonical(metadata))
+            if new_hash != old_hash:
+                batch.append(MetadataLedger(pk=pk,
+                                            source_metadata_hash=new_hash))
+        if batch:
+            MetadataLedger.objects.bulk_update(batch,
+                                               ['source_metadata_hash'])
+            updated += len(batch)
+
+    if updated:
+        # digests of the old hashes, the next extraction indexes keys again
+        LedgerKeyIndex.objects.all().delete()
+    logger.info('Recomputed source_metadata_hash of ' + str(updated) +
+                ' MetadataLedger records')
+    return updated
+
+
+class Command(BaseCommand):
+    """Django command to recompute metadata hashes stored in the Metadata
+    Ledger with the canonical encoding used by extract_source_metadata"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Number of records updated per query')
+
+    def handle(self, *args, **options):
+        """
+            Metadata hashes are recomputed in bulk
+        """
+        rehash_source_metadata(options.get('batch_size'))
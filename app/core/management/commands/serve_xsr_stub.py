@@ -0,0 +1,51 @@
+import logging
+import tempfile
+
+from core.management.commands.benchmark_extraction import (
+    BENCHMARK_API_TYPES, write_benchmark_feeds)
+from core.management.utils.xsr_stub import XSRStubServer
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger('dict_config_logger')
+
+
+class Command(BaseCommand):
+    """Django command serving synthetic ACE feeds from a local XSR stub
+    until interrupted"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--records', type=int, default=1000,
+            help='Number of records in each feed')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the synthetic feeds')
+        parser.add_argument(
+            '--host', default='127.0.0.1',
+            help='Address to listen on')
+        parser.add_argument(
+            '--port', type=int, default=8030,
+            help='Port to listen on')
+        parser.add_argument(
+            '--key', default='stub',
+            help='Expected Ocp-Apim-Subscription-Key')
+
+    def handle(self, *args, **options):
+        """
+            Feeds are generated and served until interrupted
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            feeds = write_benchmark_feeds(directory, options['records'],
+                                          BENCHMARK_API_TYPES,
+                                          options['seed'])
+            server = XSRStubServer(feeds, options['key'], options['host'],
+                                   options['port'])
+            for api_type in BENCHMARK_API_TYPES:
+                self.stdout.write(api_type + ' feed at ' +
+                                  server.url(api_type.lower()))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
@@ -0,0 +1,150 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+from core.management.utils.xsr_client import XSR_RECORD_PATHS
+
+# Database attribute of the update element of each type of ACE feed
+ACE_FEED_DATABASES = {
+    'Course': 'Courses',
+    'Occupation': 'Occupations',
+}
+
+ACE_CHAPTERS = ['Army', 'Navy', 'Air Force', 'Marine Corps', 'Coast Guard',
+                'Department of Defense']
+ACE_ACADEMIC_LEVELS = ['L', 'U', 'G', 'V']
+ACE_SUBJECTS = ['Aviation Maintenance', 'Electronics', 'Leadership',
+                'Computer Science', 'Emergency Medical Technology',
+                'Logistics', 'Communications', 'Mechanical Engineering',
+                'Physical Education', 'Criminal Justice', 'Cybersecurity',
+                'Technical Writing']
+ACE_WORDS = ['upon', 'completion', 'of', 'the', 'course', 'student', 'will',
+             'be', 'able', 'to', 'operate', 'maintain', 'inspect', 'repair',
+             'aircraft', 'systems', 'radar', 'equipment', 'procedures',
+             'safety', 'supervise', 'personnel', 'apply', 'principles',
+             'electrical', 'hydraulic', 'navigation', 'communications',
+             'lecture', 'practical', 'exercises', 'laboratory', 'field',
+             'training', 'analyze', 'plan', 'logistics', 'documentation',
+             'emergency', 'response', 'tactical', 'network', 'security',
+             'troubleshoot', 'components', 'using', 'technical', 'manuals']
+
+# Prefix of every synthetic ACEID, the ledger keys of the records they
+# flatten into never match those of the real feeds
+ACE_FEED_ID_PREFIX = 'SYNTHETIC-'
+# Feeds are dated within ACE_FEED_DAYS days of ACE_FEED_START
+ACE_FEED_START = datetime(2010, 1, 1, tzinfo=timezone(timedelta(hours=-5)))
+ACE_FEED_DAYS = 15 * 365
+
+
+def ace_sentence(rng, min_words, max_words):
+    """Sentence of random words from the ACE vocabulary"""
+    words = rng.choices(ACE_WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def ace_dates(rng):
+    """Dates shared by the fields of an ACE version or exhibit"""
+    start = ACE_FEED_START + timedelta(days=rng.randrange(ACE_FEED_DAYS))
+    modified = start + timedelta(days=rng.randrange(1, 365))
+    end = start + timedelta(days=rng.randrange(365, 10 * 365))
+    return {
+        'ModDate': modified.isoformat(),
+        'StartDateYYYYMM': start.strftime('%Y%m'),
+        'EndDateYYYYMM': end.strftime('%Y%m'),
+        'LastUpdatedOn': (modified + timedelta(
+            days=rng.randrange(30))).isoformat(),
+    }
+
+
+def ace_titles(rng, name):
+    """Prime title name with up to two alternate titles"""
+    titles = [{'Title': name, 'Precedence': 'prime'}]
+    for number in range(rng.randrange(3)):
+        titles.append({'Title': name + ' ' + str(number + 2),
+                       'Precedence': 'alt'})
+    return titles
+
+
+def generate_ace_course_version(rng, index, courses):
+    """ACE course version number index with the given number of courses"""
+    chapter = rng.choice(ACE_CHAPTERS)
+    ace_id = ACE_FEED_ID_PREFIX + chapter[:2].upper() + '-' + \
+        str(1000 + index % 9000) + '-' + str(index).zfill(7)
+    version = {
+        'ACEID': ace_id,
+        'VerNum': str(rng.randrange(1, 6)).zfill(2),
+        'Chapter': chapter,
+        'objective': ace_sentence(rng, 20, 60),
+        'instruction': ace_sentence(rng, 10, 30),
+        'titles': ace_titles(rng, ace_sentence(rng, 2, 5)[:-1]),
+        'locations': [{'Location': 'Training Center ' +
+                       str(rng.randrange(1, 80))}],
+        'groups': [{'AcadLevel': rng.choice(ACE_ACADEMIC_LEVELS),
+                    'subjects': [{'Subject': subject,
+                                  'Min': str(rng.randrange(1, 7))}
+                                 for subject in rng.sample(
+                                     ACE_SUBJECTS, rng.randint(1, 3))]}
+                   for _ in range(rng.randint(1, 2))],
+        'courses': [{'CourseNumber': ace_id + '-' + str(number + 1),
+                     'Length': {'Weeks': rng.randrange(1, 20)}}
+                    for number in range(courses)],
+    }
+    version.update(ace_dates(rng))
+    return version
+
+
+def generate_ace_occupation_exhibit(rng, index, levels):
+    """ACE occupation exhibit number index with the given number of skill
+    levels"""
+    chapter = rng.choice(ACE_CHAPTERS)
+    ace_id = ACE_FEED_ID_PREFIX + chapter[:2].upper() + '-MOS-' + \
+        str(index).zfill(7)
+    exhibit = {
+        'ACEID': ace_id,
+        'Type': rng.choice(['MOS', 'NEC', 'AFSC', 'Rating']),
+        'Chapter': chapter,
+        'Pattern': ace_sentence(rng, 10, 25),
+        'Summary': ace_sentence(rng, 30, 80),
+        'titles': ace_titles(rng, ace_sentence(rng, 2, 4)[:-1]),
+        'field': {'Name': rng.choice(ACE_SUBJECTS)},
+        'levels': [{'SkillLevel': str((number + 1) * 10),
+                    'Description': ace_sentence(rng, 10, 40),
+                    'Credits': [{'Subject': rng.choice(ACE_SUBJECTS),
+                                 'Hours': str(rng.randrange(1, 7))}]}
+                   for number in range(levels)],
+    }
+    exhibit.update(ace_dates(rng))
+    return exhibit
+
+
+def iter_ace_items(api_type, count, seed=0):
+    """Yield ACE versions or exhibits that flatten into count records,
+    the same ones for a given seed"""
+    rng = random.Random(seed)
+    if api_type == 'Course':
+        generate, most = generate_ace_course_version, 3
+    else:
+        generate, most = generate_ace_occupation_exhibit, 4
+    index = 0
+    while count > 0:
+        records = min(rng.randint(1, most), count)
+        yield generate(rng, index, records)
+        count -= records
+        index += 1
+
+
+def write_ace_feed(file, api_type, count, seed=0):
+    """Write an ACE feed of the given type flattening into count records
+    to the binary file, returns the number of versions or exhibits"""
+    path = XSR_RECORD_PATHS[api_type]
+    file.write(('{"' + path[0] + '": {"Database": ' +
+                json.dumps(ACE_FEED_DATABASES[api_type]) + ', "' +
+                path[1] + '": [').encode('utf-8'))
+    items = 0
+    for item in iter_ace_items(api_type, count, seed):
+        if items:
+            file.write(b', ')
+        file.write(json.dumps(item).encode('utf-8'))
+        items += 1
+    file.write(b']}}')
+    return items
@@ -0,0 +1,67 @@
+import datetime
+import hashlib
+import json
+import logging
+import math
+
+import orjson
+
+logger = logging.getLogger('dict_config_logger')
+
+ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def convert_date(value):
+    """Serialize dates the way convert_date_to_isoformat does"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('Object of type ' + type(value).__name__ +
+                    ' is not JSON serializable')
+
+
+def convert_non_finite(data):
+    """data with NaN and infinite floats replaced by None, which orjson
+    encodes them as"""
+    if isinstance(data, float):
+        return data if math.isfinite(data) else None
+    if isinstance(data, dict):
+        return {key: convert_non_finite(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [convert_non_finite(value) for value in data]
+    return data
+
+
+def dumps_stdlib(data):
+    """Encode data as dumps_canonical does with the standard library
+    encoder, for the values orjson refuses such as integers above 64 bits
+
+    Floats in exponent notation are written the Python way, 1e+16 where
+    orjson writes 1e16, so only data orjson refuses is encoded here.
+    """
+    return json.dumps(convert_non_finite(data), default=convert_date,
+                      sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False, allow_nan=False).encode('utf-8')
+
+
+def dumps_canonical(data):
+    """Encode data as compact UTF-8 JSON bytes with sorted keys
+
+    The bytes, and so the ledger hashes, are those of orjson, which is
+    pinned in requirements.txt as the encoders do not write every float
+    alike. Data orjson refuses is left to dumps_stdlib.
+    """
+    try:
+        return orjson.dumps(data, default=convert_date,
+                            option=ORJSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        return dumps_stdlib(data)
+
+
+def loads_canonical(encoded):
+    """Decode JSON bytes produced by dumps_canonical"""
+    return orjson.loads(encoded)
+
+
+def hash_canonical(encoded):
+    """SHA-512 hex digest of canonical JSON bytes"""
+    return hashlib.sha512(encoded).hexdigest()
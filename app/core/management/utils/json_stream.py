@@ -0,0 +1,165 @@
+import codecs
+import json
+import logging
+import re
+
+logger = logging.getLogger('dict_config_logger')
+
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[,\]}\s]')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONStreamReader:
+    """Incremental reader pulling JSON values out of a stream of chunks
+
+    Only the text of the value currently being decoded is held in memory,
+    everything before it is discarded as soon as it has been consumed.
+    """
+
+    def __init__(self, chunks, encoding='utf-8-sig'):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._buf = ''
+        self._eof = False
+
+    def _fill(self):
+        """Append the next decoded chunk to the buffer"""
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._decoder.decode(chunk)
+            if chunk:
+                self._buf += chunk
+                return True
+        self._buf += self._decoder.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _consume(self, pos):
+        """Drop everything in the buffer before pos"""
+        self._buf = self._buf[pos:]
+        return 0
+
+    def _char(self, pos):
+        """Return the character at pos, reading ahead when needed"""
+        while pos >= len(self._buf):
+            if not self._fill():
+                return ''
+        return self._buf[pos]
+
+    def _skip_whitespace(self, pos):
+        while True:
+            pos = _WHITESPACE.match(self._buf, pos).end()
+            if pos < len(self._buf) or not self._fill():
+                return pos
+
+    def _string_end(self, start):
+        """Return the index just past the string starting at start"""
+        pos = start + 1
+        while True:
+            match = _STRING_END.search(self._buf, pos)
+            if match is None:
+                pos = max(pos, len(self._buf))
+                if not self._fill():
+                    raise ValueError('Unterminated string in JSON stream')
+            elif match.group() == '\\':
+                pos = match.end() + 1
+            else:
+                return match.end()
+
+    def _value_end(self, start):
+        """Return the index just past the JSON value starting at start"""
+        first = self._char(start)
+        if first == '"':
+            return self._string_end(start)
+        if first not in ('[', '{'):
+            while True:
+                match = _SCALAR_END.search(self._buf, start)
+                if match is not None:
+                    return match.start()
+                if not self._fill():
+                    return len(self._buf)
+        depth = 0
+        pos = start
+        while True:
+            match = _STRUCTURE.search(self._buf, pos)
+            if match is None:
+                pos = len(self._buf)
+                if not self._fill():
+                    raise ValueError('Unexpected end of JSON stream')
+                continue
+            char = match.group()
+            if char == '"':
+                pos = self._string_end(match.start())
+                continue
+            depth += 1 if char in '[{' else -1
+            pos = match.end()
+            if not depth:
+                return pos
+
+    def _find_key(self, pos, key):
+        """Move to the value of key in the object whose body starts at pos"""
+        while True:
+            pos = self._skip_whitespace(pos)
+            char = self._char(pos)
+            if char == ',':
+                pos += 1
+                continue
+            if char != '"':
+                return None
+            end = self._string_end(pos)
+            name = json.loads(self._buf[pos:end])
+            pos = self._skip_whitespace(end)
+            if self._char(pos) != ':':
+                raise ValueError('Malformed object in JSON stream')
+            pos = self._skip_whitespace(pos + 1)
+            if name == key:
+                return pos
+            pos = self._consume(self._value_end(pos))
+
+    def iter_items(self, path):
+        """Yield the items of the array found under the keys in path
+
+        An object found under path is yielded as a single item, mirroring
+        how pandas.json_normalize treats a lone record.
+        """
+        pos = self._skip_whitespace(0)
+        for key in path:
+            if self._char(pos) != '{':
+                return
+            pos = self._find_key(pos + 1, key)
+            if pos is None:
+                logger.warning('Key ' + key + ' not found in JSON stream')
+                return
+            pos = self._consume(pos)
+
+        first = self._char(pos)
+        if first == '{':
+            end = self._value_end(pos)
+            yield json.loads(self._buf[pos:end])
+            return
+        if first != '[':
+            return
+
+        pos = self._skip_whitespace(pos + 1)
+        if self._char(pos) == ']':
+            return
+        while True:
+            end = self._value_end(pos)
+            item = json.loads(self._buf[pos:end])
+            pos = self._skip_whitespace(end)
+            separator = self._char(pos)
+            pos = self._consume(pos + 1)
+            yield item
+            if separator != ',':
+                return
+            pos = self._skip_whitespace(pos)
+
+
+def iter_json_items(chunks, path):
+    """Yield items of the JSON array under path from an iterable of
+    byte chunks without loading the whole document"""
+    return JSONStreamReader(chunks).iter_items(path)
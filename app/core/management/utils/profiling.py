@@ -0,0 +1,147 @@
+import cProfile
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger('dict_config_logger')
+
+PROFILE_TOP_ALLOCATIONS = 20
+# Calls of each phase whose allocations are compared line by line, later
+# calls only add to the phase totals
+PROFILE_ALLOCATION_SAMPLES = 3
+PROFILE_SUMMARY = 'allocations.txt'
+
+# Profiler of the phases entered by this process, None when not profiling
+_profiler = None
+
+
+class PhaseProfiler:
+    """cProfile and tracemalloc measurements of named phases
+
+    Entering a phase inside another one suspends the outer phase, so
+    time is attributed to the innermost phase. Net allocations of a phase
+    include the phases nested in it.
+    """
+
+    def __init__(self, path, top=PROFILE_TOP_ALLOCATIONS):
+        self.path = path
+        self.top = top
+        self._profiles = {}
+        self._totals = {}
+        self._allocations = {}
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        if self._stack:
+            self._profiles[self._stack[-1]].disable()
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        totals = self._totals.setdefault(
+            name, {'calls': 0, 'seconds': 0.0, 'allocated': 0})
+        before = None
+        if totals['calls'] < PROFILE_ALLOCATION_SAMPLES:
+            before = self._snapshot()
+        allocated = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        self._stack.append(name)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._stack.pop()
+            totals['calls'] += 1
+            totals['seconds'] += time.perf_counter() - started
+            totals['allocated'] += \
+                tracemalloc.get_traced_memory()[0] - allocated
+            if before is not None:
+                self._add_allocations(name, self._snapshot().compare_to(
+                    before, 'lineno'))
+            if self._stack:
+                self._profiles[self._stack[-1]].enable()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)])
+
+    def _add_allocations(self, name, differences):
+        sites = self._allocations.setdefault(name, {})
+        for difference in differences:
+            if difference.size_diff <= 0:
+                continue
+            site = sites.setdefault(str(difference.traceback[0]), [0, 0])
+            site[0] += difference.size_diff
+            site[1] += difference.count_diff
+
+    def write(self):
+        """Write a pstats file per phase and the allocation summary"""
+        os.makedirs(self.path, exist_ok=True)
+        for name, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(self.path, name + '.pstats'))
+
+        lines = ['{:<20} {:>8} {:>10} {:>14}'.format(
+            'Phase', 'Calls', 'Seconds', 'Net allocated')]
+        for name, totals in self._totals.items():
+            lines.append('{:<20} {:>8} {:>10.3f} {:>14}'.format(
+                name, totals['calls'], totals['seconds'],
+                format_size(totals['allocated'])))
+        for name, sites in self._allocations.items():
+            lines.append('')
+            lines.append('Top ' + str(self.top) + ' allocation sites of ' +
+                         name + ' (first ' + str(min(
+                             PROFILE_ALLOCATION_SAMPLES,
+                             self._totals[name]['calls'])) + ' calls)')
+            for site, (size, count) in sorted(
+                    sites.items(), key=lambda item: -item[1][0])[:self.top]:
+                lines.append('{:>12} {:>10} blocks  {}'.format(
+                    format_size(size), count, site))
+        with open(os.path.join(self.path, PROFILE_SUMMARY), 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        logger.info('Profile of ' + ', '.join(self._totals) +
+                    ' saved to ' + self.path)
+
+
+def format_size(size):
+    """Human readable number of bytes"""
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GiB'.format(size)
+
+
+def is_profiling():
+    """Whether phases of this process are being profiled"""
+    return _profiler is not None
+
+
+@contextmanager
+def profile_phase(name):
+    """Profile the block as phase name, nothing is measured unless the
+    block runs inside profiling"""
+    if _profiler is None:
+        yield
+        return
+    with _profiler.phase(name):
+        yield
+
+
+@contextmanager
+def profiling(path, top=PROFILE_TOP_ALLOCATIONS):
+    """Profile the phases entered in the block, writing a pstats file per
+    phase and an allocation summary to the directory path"""
+    global _profiler
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    _profiler = PhaseProfiler(path, top)
+    try:
+        yield _profiler
+    finally:
+        profiler, _profiler = _profiler, None
+        if not tracing:
+            tracemalloc.stop()
+        profiler.write()
@@ -0,0 +1,75 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger('dict_config_logger')
+
+# Celery state of a task publishing its progress
+PROGRESS_STATE = 'PROGRESS'
+
+# Reporter of the celery task run by this process, None outside of one
+_reporter = None
+
+
+class ProgressReporter:
+    """Progress of a bound celery task published as its PROGRESS state
+
+    Updates are merged into the published meta, which is sent to the
+    result backend at most once every interval seconds unless forced, so
+    a loop over records does not write to the backend for every chunk.
+    """
+
+    def __init__(self, task, interval=None, **meta):
+        self.task = task
+        self.interval = settings.XIA_PROGRESS_INTERVAL \
+            if interval is None else interval
+        self.meta = meta
+        self._published = None
+
+    def update(self, force=False, **fields):
+        """Merge fields into the progress, returns whether it was
+        published"""
+        self.meta.update(fields)
+        now = time.monotonic()
+        if not force and self._published is not None and \
+                now - self._published < self.interval:
+            return False
+        # a task called directly has no state to update
+        if self.task.request.id is None:
+            return False
+        self._published = now
+        try:
+            self.task.update_state(state=PROGRESS_STATE,
+                                   meta=dict(self.meta))
+        except Exception as err:
+            # progress is informative, the task goes on without it
+            logger.warning('Could not publish progress: ' + repr(err))
+            return False
+        return True
+
+
+def report_progress(force=False, **fields):
+    """Merge fields into the progress of the task run by this process,
+    nothing is published outside of reporting_progress"""
+    if _reporter is not None:
+        _reporter.update(force, **fields)
+
+
+def is_reporting_progress():
+    """Whether this process publishes the progress of a task"""
+    return _reporter is not None
+
+
+@contextmanager
+def reporting_progress(task, **meta):
+    """Publish the progress reported in the block as the state of the
+    bound celery task, starting from meta"""
+    global _reporter
+    previous = _reporter
+    _reporter = ProgressReporter(task, **meta)
+    try:
+        yield _reporter
+    finally:
+        _reporter = previous
@@ -0,0 +1,102 @@
+import logging
+
+logger = logging.getLogger('dict_config_logger')
+
+
+def flatten_record(record, sep='.'):
+    """Flatten nested dictionaries of a record into sep joined keys,
+    ordering keys like pandas.json_normalize does"""
+    flat = {}
+    nested = []
+    for key, value in record.items():
+        if not isinstance(key, str):
+            key = str(key)
+        if isinstance(value, dict):
+            nested.append((key, value))
+        else:
+            flat[key] = value
+    for key, value in nested:
+        _flatten_into(flat, value, key + sep, sep)
+    return flat
+
+
+def _flatten_into(flat, obj, prefix, sep):
+    for key, value in obj.items():
+        if not isinstance(key, str):
+            key = str(key)
+        if isinstance(value, dict):
+            _flatten_into(flat, value, prefix + key + sep, sep)
+        else:
+            flat[prefix + key] = value
+
+
+def pull_field(obj, path):
+    """Value found following path in obj, None when a key is missing"""
+    for field in path:
+        if obj is None:
+            return None
+        try:
+            obj = obj[field]
+        except KeyError:
+            return None
+    return obj
+
+
+def iter_flattened_records(data, record_path, meta, sep='.'):
+    """Lazily yield one flat dictionary per item under record_path of
+    every object in data, with the meta fields of its parent object
+
+    Mirrors pandas.json_normalize(data, record_path=[record_path],
+    meta=meta, errors='ignore', sep=sep) for a single level record path,
+    except that missing values are left out instead of set to NaN.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    meta_paths = [field if isinstance(field, list) else [field]
+                  for field in meta]
+    meta_keys = get_meta_keys(meta, sep)
+
+    for obj in data:
+        records = obj[record_path]
+        if records is None:
+            continue
+        if not isinstance(records, list):
+            raise TypeError(str(obj) + ' has non list value ' +
+                            str(records) + ' for path ' + record_path +
+                            '. Must be list or null.')
+        if not records:
+            continue
+        meta_values = [pull_field(obj, path) for path in meta_paths]
+        for record in records:
+            row = flatten_record(record, sep)
+            for key, value in zip(meta_keys, meta_values):
+                if key in row:
+                    raise ValueError('Conflicting metadata name ' + key +
+                                     ', need distinguishing prefix ')
+                row[key] = value
+            yield row
+
+
+def get_meta_keys(meta, sep='.'):
+    """Names the meta fields get in the flattened records"""
+    return [sep.join(field) if isinstance(field, list) else field
+            for field in meta]
+
+
+def fill_missing_fields(rows, last_fields=()):
+    """Give every row of a chunk the same keys with None for the missing
+    ones, as a dataframe would
+
+    Keys are ordered by first appearance, except last_fields which come
+    at the end in the given order like json_normalize meta columns.
+    """
+    rows = list(rows)
+    fields = {}
+    for row in rows:
+        for key in row:
+            if key not in fields:
+                fields[key] = None
+    for key in last_fields:
+        fields.pop(key, None)
+        fields[key] = None
+    return [{key: row.get(key) for key in fields} for row in rows]
@@ -0,0 +1,108 @@
+import functools
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from core.metrics import RUN_CACHE_LOOKUPS
+from openlxp_xia.management.utils import xss_client
+from openlxp_xia.models import XIAConfiguration, XISConfiguration
+
+logger = logging.getLogger('dict_config_logger')
+
+# Managers whose first() the openlxp_xia commands call for every stage,
+# and for every record in places, memoized during a run by lookup name
+RUN_CACHED_MANAGERS = {
+    'XIAConfiguration': XIAConfiguration.objects,
+    'XISConfiguration': XISConfiguration.objects,
+}
+# Module functions memoized during a run by their arguments, schemas and
+# transformation maps are requested from the XSS by read_json_data
+RUN_CACHED_FUNCTIONS = {
+    'read_json_data': (xss_client, 'read_json_data'),
+}
+
+# Cache of the run in progress in this process, None outside of one
+_cache = None
+
+
+class RunCache:
+    """Values of lookups kept for the duration of a workflow run, with the
+    hits and misses of each lookup"""
+
+    def __init__(self):
+        self._values = {}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def get(self, name, key, fetch):
+        """Value of the lookup name for key, calling fetch on a miss"""
+        try:
+            value = self._values[name, key]
+        except KeyError:
+            self.misses[name] += 1
+            value = self._values[name, key] = fetch()
+            return value
+        self.hits[name] += 1
+        return value
+
+    def memoize(self, name, function):
+        """function memoized under the lookup name by its arguments"""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.get(name, (args, tuple(sorted(kwargs.items()))),
+                            lambda: function(*args, **kwargs))
+        return wrapper
+
+    def report(self):
+        """Count the hits and misses of every lookup in the metrics and
+        log them"""
+        for name in sorted(set(self.hits) | set(self.misses)):
+            RUN_CACHE_LOOKUPS.labels(name, 'hit').inc(self.hits[name])
+            RUN_CACHE_LOOKUPS.labels(name, 'miss').inc(self.misses[name])
+            logger.info('Run cache ' + name + ': ' + str(self.hits[name]) +
+                        ' hits, ' + str(self.misses[name]) + ' misses')
+
+
+def run_cached(name):
+    """Decorator memoizing a function under the lookup name while a run
+    cache is active, its arguments must be hashable"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _cache is None:
+                return function(*args, **kwargs)
+            return _cache.get(name, (args, tuple(sorted(kwargs.items()))),
+                              lambda: function(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def run_cache():
+    """Memoize the configuration and schema lookups of the block, so each
+    is fetched once however many stages run in it, the values are dropped
+    when the block ends
+
+    Entering it again inside the block shares the outer cache.
+    """
+    global _cache
+    if _cache is not None:
+        yield _cache
+        return
+    _cache = RunCache()
+    for name, manager in RUN_CACHED_MANAGERS.items():
+        # shadows Manager.first on the instance every model access returns
+        manager.first = _cache.memoize(name, manager.first)
+    originals = {}
+    for name, (module, attribute) in RUN_CACHED_FUNCTIONS.items():
+        originals[name] = getattr(module, attribute)
+        setattr(module, attribute, _cache.memoize(name, originals[name]))
+    try:
+        yield _cache
+    finally:
+        for manager in RUN_CACHED_MANAGERS.values():
+            del manager.first
+        for name, (module, attribute) in RUN_CACHED_FUNCTIONS.items():
+            setattr(module, attribute, originals[name])
+        cache, _cache = _cache, None
+        cache.report()
@@ -0,0 +1,234 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+import requests
+from core.management.utils.xsr_client import get_xsr_api_endpoint
+from core.models import XSRConfiguration
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger('dict_config_logger')
+
+SNAPSHOT_MANIFEST = 'manifest.json'
+# Name of the directory of every run, the UTC time it started
+SNAPSHOT_RUN_FORMAT = '%Y%m%dT%H%M%S%fZ'
+# Runs without a manifest this old were interrupted, younger ones may
+# still be written by another extraction
+SNAPSHOT_STALE_AGE = timedelta(days=1)
+# Chunks waiting for the writer thread before the extraction has to wait
+SNAPSHOT_QUEUE_SIZE = 64
+SNAPSHOT_COMPRESS_LEVEL = 6
+SNAPSHOT_READ_SIZE = 64 * 1024
+
+
+class SnapshotWriter:
+    """Store the raw XSR responses of one extraction run as gzip files
+    under XSR_SNAPSHOT_DIR/<run>/ together with a manifest
+
+    Compression and disk writes happen on a background thread, the
+    extraction only hands over the chunks it already holds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = []
+        self._queue = queue.Queue(maxsize=SNAPSHOT_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run,
+                                        name='xsr-snapshot', daemon=True)
+        os.makedirs(path, exist_ok=True)
+        self._thread.start()
+
+    @classmethod
+    def create(cls, root=None):
+        """Writer for a new run under root, None when snapshots are off"""
+        root = root or settings.XSR_SNAPSHOT_DIR
+        if not root:
+            return None
+        now = timezone.now()
+        writer = cls(os.path.join(root, now.strftime(SNAPSHOT_RUN_FORMAT)))
+        pruned = prune_snapshot_runs(root, now,
+                                     settings.XSR_SNAPSHOT_KEEP_RUNS,
+                                     settings.XSR_SNAPSHOT_KEEP_DAYS)
+        if pruned:
+            logger.info('Removed ' + str(len(pruned)) +
+                        ' old snapshot runs from ' + root)
+        return writer
+
+    def _run(self):
+        files = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            action, entry, chunk = item
+            name = entry['file']
+            if action != 'open' and name not in files:
+                # the snapshot of this response already failed
+                continue
+            try:
+                if action == 'open':
+                    files[name] = gzip.open(
+                        os.path.join(self.path, name), 'wb',
+                        compresslevel=SNAPSHOT_COMPRESS_LEVEL)
+                elif action == 'write':
+                    files[name].write(chunk)
+                else:
+                    files.pop(name).close()
+                    if action == 'close':
+                        self._entries.append(entry)
+                    else:
+                        os.remove(os.path.join(self.path, name))
+            except OSError as err:
+                logger.error('Snapshot of ' + entry['Transcript_API'] +
+                             ' failed: ' + str(err))
+                files.pop(name, None)
+
+    def record(self, xsr_obj, resp, chunks):
+        """Pass the body chunks of resp through while snapshotting them"""
+        entry = {
+            'id': xsr_obj.pk,
+            'file': 'xsr-' + str(xsr_obj.pk) + '.json.gz',
+            'API_type': xsr_obj.API_type,
+            'Transcript_API': xsr_obj.Transcript_API,
+            'Parameter': xsr_obj.Parameter,
+            'headers': {name: resp.headers[name]
+                        for name in ('ETag', 'Last-Modified')
+                        if name in resp.headers},
+            'recorded': timezone.now().isoformat(),
+        }
+        self._queue.put(('open', entry, None))
+        complete = False
+        try:
+            for chunk in chunks:
+                self._queue.put(('write', entry, chunk))
+                yield chunk
+            complete = True
+        finally:
+            # responses not read to the end are left out of the snapshot
+            self._queue.put(('close' if complete else 'discard', entry,
+                             None))
+
+    def add(self, xsr_obj, resp, content):
+        """Snapshot a response body received in one piece"""
+        for _ in self.record(xsr_obj, resp, [content]):
+            pass
+
+    def close(self):
+        """Wait for pending writes and write the manifest"""
+        self._queue.put(None)
+        self._thread.join()
+        with open(os.path.join(self.path, SNAPSHOT_MANIFEST), 'w') as file:
+            json.dump({'created': timezone.now().isoformat(),
+                       'configurations': self._entries}, file, indent=2)
+        logger.info('Saved snapshot of ' + str(len(self._entries)) +
+                    ' XSR responses to ' + self.path)
+
+
+def prune_snapshot_runs(root, now, keep_runs, keep_days):
+    """Remove the run directories under root beyond the keep_runs newest
+    finished runs or older than keep_days days, a limit of 0 keeping them
+    all, returns the names of the removed runs"""
+    runs = []
+    for name in os.listdir(root):
+        try:
+            started = datetime.strptime(name, SNAPSHOT_RUN_FORMAT)
+        except ValueError:
+            # not a run, left alone
+            continue
+        if os.path.isdir(os.path.join(root, name)):
+            runs.append((started.replace(tzinfo=dt_timezone.utc), name))
+
+    pruned = []
+    finished = 0
+    for started, name in sorted(runs, reverse=True):
+        path = os.path.join(root, name)
+        age = now - started
+        if os.path.exists(os.path.join(path, SNAPSHOT_MANIFEST)):
+            finished += 1
+            expired = bool(keep_runs) and finished > keep_runs
+        else:
+            expired = bool(keep_runs) and age > SNAPSHOT_STALE_AGE
+        if keep_days and age > timedelta(days=keep_days):
+            expired = True
+        if expired:
+            shutil.rmtree(path, ignore_errors=True)
+            pruned.append(name)
+    return pruned
+
+
+class SnapshotResponse:
+    """Offline stand-in for the requests response of a snapshot file"""
+
+    status_code = 200
+
+    def __init__(self, path, headers):
+        self.path = path
+        self.headers = headers
+
+    @property
+    def content(self):
+        with gzip.open(self.path, 'rb') as file:
+            return file.read()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                str(self.status_code) + ' response snapshot of ' + self.path,
+                response=self)
+
+    def iter_content(self, chunk_size=SNAPSHOT_READ_SIZE):
+        with gzip.open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                yield chunk
+
+    def close(self):
+        pass
+
+
+class SnapshotSession:
+    """Session answering XSR requests from a snapshot directory without
+    touching the network"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SNAPSHOT_MANIFEST)) as file:
+            self.manifest = json.load(file)
+        self._responses = {}
+
+    def configurations(self):
+        """Unsaved XSR configurations the snapshot was recorded with"""
+        xsr_list = []
+        for entry in self.manifest['configurations']:
+            xsr_obj = XSRConfiguration(id=entry['id'],
+                                       API_type=entry['API_type'],
+                                       Transcript_API=entry['Transcript_API'],
+                                       Parameter=entry['Parameter'])
+            xsr_url, _ = get_xsr_api_endpoint(xsr_obj)
+            self._responses[xsr_url] = \
+                SnapshotResponse(os.path.join(self.path, entry['file']),
+                                 entry['headers'])
+            xsr_list.append(xsr_obj)
+        return xsr_list
+
+    def get(self, url, **kwargs):
+        try:
+            return self._responses[url]
+        except KeyError:
+            raise FileNotFoundError('No snapshot of ' + url + ' in ' +
+                                    self.path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,16 +1,62 @@
 import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-import pandas as pd
 import requests
+from core.management.utils.json_stream import iter_json_items
+from core.management.utils.record_flattener import (
+    fill_missing_fields, get_meta_keys, iter_flattened_records)
+from core.management.utils.profiling import is_profiling, profile_phase
+from core.management.utils.run_cache import run_cached
+from core.metrics import (RECORDS_NORMALIZED, XSR_REQUEST_SECONDS,
+                          XSR_RESPONSE_BYTES)
 from core.models import XSRConfiguration
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from openlxp_xia.management.utils.xia_internal import convert_date_to_isoformat
 from openlxp_xia.management.utils.xia_internal import get_key_dict
 
 logger = logging.getLogger('dict_config_logger')
 
+# Location of the individual records inside each type of ACE feed
+XSR_RECORD_PATHS = {
+    'Course': ('update', 'versions'),
+    'Occupation': ('update', 'exhibits'),
+}
+
+# Version and exhibit fields repeated on every course and skill level
+ACE_COURSE_FIELDS = ['ACEID',
+                     'VerNum',
+                     'Chapter',
+                     'ModDate',
+                     'StartDateYYYYMM',
+                     'EndDateYYYYMM',
+                     'LastUpdatedOn',
+                     'objective',
+                     ['instruction'],
+                     'titles',
+                     'locations',
+                     'groups']
+ACE_OCCUPATION_FIELDS = ['ACEID',
+                         'Type',
+                         'Chapter',
+                         'ModDate',
+                         'StartDateYYYYMM',
+                         'EndDateYYYYMM',
+                         'LastUpdatedOn',
+                         'Pattern',
+                         'Summary',
+                         'titles',
+                         'field']
+
+# Number of bytes read from the socket at a time while streaming
+XSR_STREAM_READ_SIZE = 64 * 1024
+
 
 def convert_yyyymm_to_date(yyyymm_string):
     """Converts a yyyymm string to a date object,
@@ -22,38 +68,118 @@ def convert_yyyymm_to_date(yyyymm_string):
         return None
 
 
-def get_xsr_api_endpoint(xsr_obj):
+def get_xsr_api_endpoint(xsr_obj, since=None):
     """Setting API endpoint to connect to XSR """
     logger.debug("Retrieve xsr_api_endpoint from XSR configuration")
-    # add parameters to API
+    # add parameters to API, keeping any query already in the endpoint
 
-    xsr_url = xsr_obj.Transcript_API
+    scheme, netloc, path, query, fragment = urlsplit(xsr_obj.Transcript_API)
+    params = parse_qsl(query, keep_blank_values=True)
     if xsr_obj.Parameter:
         # Iterate over key-value pairs
         for key, value in xsr_obj.Parameter.items():
-            xsr_url += '?'+str(key)+'='+str(value)
-    return (xsr_url, xsr_obj.Subscription_key)
-
+            params.append((str(key), str(value)))
+    if since is not None and settings.XSR_WATERMARK_PARAMETER:
+        params.append((settings.XSR_WATERMARK_PARAMETER, since.isoformat()))
 
-def get_xsr_api_response(xsr_obj):
-    """Function to get api response from xsr endpoint"""
-    # url of rss feed
+    xsr_url = urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+    return (xsr_url, xsr_obj.Subscription_key)
 
-    xsr_url, token = get_xsr_api_endpoint(xsr_obj)
 
-    headers = {'Cache-Control': 'no-cache',
-               'Ocp-Apim-Subscription-Key': token}
+def get_xsr_session():
+    """Create a keep-alive session with a connection pool large enough
+    for every concurrent XSR request"""
+    pool_size = max(settings.XSR_FETCH_CONCURRENCY, 1)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'Connection': 'keep-alive'})
+    return session
+
+
+def get_xsr_request_headers(xsr_obj, token, full=False):
+    """Build request headers, asking XSR to only send the feed when it
+    changed since the validators stored for the configuration"""
+    headers = {'Ocp-Apim-Subscription-Key': token}
+    if full:
+        headers['Cache-Control'] = 'no-cache'
+        return headers
+    if xsr_obj.etag:
+        headers['If-None-Match'] = xsr_obj.etag
+    if xsr_obj.last_modified:
+        headers['If-Modified-Since'] = xsr_obj.last_modified
+    return headers
+
+
+def get_xsr_api_response(xsr_obj, stream=False, session=None, full=False):
+    """Function to get api response from xsr endpoint, leaving the body
+    unread when stream is set"""
+    # url of rss feed, only asking for records past the watermark
+
+    since = None if full else xsr_obj.last_updated_watermark
+    xsr_url, token = get_xsr_api_endpoint(xsr_obj, since)
+
+    headers = get_xsr_request_headers(xsr_obj, token, full)
 
     # creating HTTP response object from given url
+    client = session if session is not None else requests
+    started = time.monotonic()
     try:
-        resp = requests.get(url=xsr_url, headers=headers, verify=False)
+        resp = client.get(url=xsr_url, headers=headers, verify=False,
+                          stream=stream)
     except requests.exceptions.RequestException as e:
         logger.error(e)
         raise SystemExit('Exiting! Can not make connection with XSR.')
+    XSR_REQUEST_SECONDS.labels(str(xsr_obj.pk)).observe(
+        time.monotonic() - started)
 
     return resp
 
 
+def get_record_timestamp(record):
+    """Latest of the LastUpdatedOn and ModDate of an ACE record"""
+    timestamp = None
+    for field in ('LastUpdatedOn', 'ModDate'):
+        value = record.get(field)
+        if not isinstance(value, str):
+            continue
+        try:
+            parsed = parse_datetime(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            continue
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, timezone.utc)
+        parsed = parsed.astimezone(timezone.utc)
+        if timestamp is None or parsed > timestamp:
+            timestamp = parsed
+    return timestamp
+
+
+def iter_records_since(records, xsr_obj, full=False):
+    """Yield the records updated at or after the watermark of xsr_obj,
+    moving the watermark up to the latest timestamp seen on the way"""
+    watermark = None if full else xsr_obj.last_updated_watermark
+    skipped = 0
+    for record in records:
+        timestamp = get_record_timestamp(record)
+        if timestamp is not None:
+            if (xsr_obj.last_updated_watermark is None or
+                    timestamp > xsr_obj.last_updated_watermark):
+                xsr_obj.last_updated_watermark = timestamp
+            if watermark is not None and timestamp < watermark:
+                skipped += 1
+                continue
+        yield record
+    if skipped:
+        logger.info(str(skipped) + ' records of ' + xsr_obj.Transcript_API +
+                    ' not updated since ' + watermark.isoformat())
+
+
 def get_source_metadata_key_value(data_dict):
     """Function to create key value for source metadata """
     # field names depend on source data and SOURCESYSTEM is system generated
@@ -79,83 +205,93 @@ def get_source_metadata_key_value(data_dict):
     return key
 
 
-def custom_ACE_setting_areas(metadata):
-
-    areasandhours_list = []
-
-    area_dict = {}
-    version = ""
-    start_date = ""
-    end_date = ""
-    last_updated_on = ""
-
-    # if 'ACEID' in metadata and metadata['ACEID']:
-
-    #     ace_identifier = metadata['ACEID']
-
-    # area_dict.update({
-    #     "ace_identifier": {"ace_identifier": metadata['ACEID']}})
-
+def get_source_metadata_key_values(records):
+    """Batched get_source_metadata_key_value building the key dictionaries
+    of a whole chunk of records column by column"""
+    key_vals = [record.get('Key_val') for record in records]
+    systems = [record.get('SOURCESYSTEM') for record in records]
+
+    for item, column in (('Key_val', key_vals), ('SOURCESYSTEM', systems)):
+        missing = sum(1 for value in column if not value)
+        if missing:
+            logger.info('Field name ' + item + ' is missing for key '
+                        'creation in ' + str(missing) + ' records')
+
+    key_values = [key_val + '_' + system if key_val and system else None
+                  for key_val, system in zip(key_vals, systems)]
+    sha512 = hashlib.sha512
+    return [get_key_dict(key_value,
+                         sha512(key_value.encode('utf-8')).hexdigest())
+            if key_value is not None else None
+            for key_value in key_values]
+
+
+def get_ACE_setting_dates(metadata):
+    """Version and dates of an ACE record as repeated on each of its
+    course areas"""
+    dates = {"version": "", "start_date": "", "end_date": "",
+             "last_updated_on": ""}
     if 'VerNum' in metadata and metadata['VerNum']:
-
-        version = metadata['VerNum']
-        area_dict.update({
-            "version": metadata['VerNum']})
-
+        dates["version"] = metadata['VerNum']
     if 'StartDateYYYYMM' in metadata and metadata['StartDateYYYYMM']:
-
-        start_date = convert_yyyymm_to_date(metadata['StartDateYYYYMM'])
-
-        # area_dict.update({
-        #     "start_date": start_date})
+        dates["start_date"] = convert_yyyymm_to_date(
+            metadata['StartDateYYYYMM'])
     if 'EndDateYYYYMM' in metadata and metadata['EndDateYYYYMM']:
-
-        end_date = convert_yyyymm_to_date(metadata['EndDateYYYYMM'])
-
-        # area_dict.update({
-        #     "end_date": end_date})
+        dates["end_date"] = convert_yyyymm_to_date(metadata['EndDateYYYYMM'])
     if 'LastUpdatedOn' in metadata and metadata['LastUpdatedOn']:
+        dates["last_updated_on"] = convert_date_to_isoformat(
+            metadata['LastUpdatedOn'])
+    return dates
 
-        last_updated_on = convert_date_to_isoformat(metadata['LastUpdatedOn'])
-
-        # area_dict.update({
-        #     "last_updated_on": last_updated_on})
 
-    if 'groups' in metadata and metadata['groups']:
-        for level in metadata['groups']:
-            if 'subject' in level:
-                for subject in level['subjects']:
-                    area_dict = {
-                        "hours": subject['Min'],
-                        "level": level['AcadLevel'],
-                        "version": version,
-                        "start_date": start_date,
-                        "end_date": end_date,
-                        "last_updated_on": last_updated_on,
-                        "academic_course_area": {
-                            "course_area": subject['Subject']
-                        }
-                    }
+def get_ACE_course_areas(groups, dates):
+    """Course area and hours of every subject of the academic levels in
+    groups, with the version and dates of the record"""
+    areasandhours_list = []
+    for level in groups or []:
+        subjects = level.get('subjects') if isinstance(level, dict) else None
+        if isinstance(subjects, dict):
+            subjects = [subjects]
+        for subject in subjects or []:
+            if not isinstance(subject, dict):
+                continue
+            area_dict = {
+                "hours": subject.get('Min'),
+                "level": level.get('AcadLevel'),
+                "academic_course_area": {
+                    "course_area": subject.get('Subject')
+                }
+            }
+            area_dict.update(dates)
+            areasandhours_list.append(area_dict)
+    return areasandhours_list
+
+
+def join_ACE_titles(title_json):
+    """Titles of an ACE record joined with the prime title first and the
+    alternate ones after it in reverse order"""
+    title_len = len(title_json)
+
+    title_list = [None]*title_len
+    num = title_len-1
+
+    for item in title_json:
+        if item["Precedence"] == "prime":
+            title_list[-title_len] = item["Title"]
+        else:
+            title_list[num] = item["Title"]
+            num -= 1
+    return ", ".join(title_list)
 
-                areasandhours_list.append(area_dict)
 
-    metadata['groups'] = areasandhours_list
+def custom_ACE_setting_areas(metadata):
+    """Replace the groups of an ACE record by one course area per subject
+    and its titles by a single string"""
+    metadata['groups'] = get_ACE_course_areas(metadata.get('groups'),
+                                              get_ACE_setting_dates(metadata))
 
     if 'titles' in metadata and metadata['titles']:
-        title_json = metadata['titles']
-        title_len = len(title_json)
-
-        title_list = [None]*title_len
-        num = title_len-1
-
-        for item in title_json:
-            if item["Precedence"] == "prime":
-                title_list[-title_len] = item["Title"]
-            else:
-                title_list[num] = item["Title"]
-                num -= 1
-        title = ", ".join(title_list)
-        metadata['titles'] = title
+        metadata['titles'] = join_ACE_titles(metadata['titles'])
 
     return metadata
 
@@ -176,91 +312,381 @@ def custom_ACE_data(metadata):
     return metadata
 
 
+def map_distinct(function, values):
+    """function of each of values, computed once per distinct string"""
+    cache = {}
+    results = []
+    for value in values:
+        if not isinstance(value, str):
+            results.append(function(value))
+            continue
+        if value not in cache:
+            cache[value] = function(value)
+        results.append(cache[value])
+    return results
+
+
+def custom_ACE_records(records):
+    """custom_ACE_setting_areas(custom_ACE_data(record)) of every record,
+    in place, the dates of the chunk being converted column by column
+    once per distinct value"""
+    columns = {}
+    for field, convert in (('StartDateYYYYMM', convert_yyyymm_to_date),
+                           ('EndDateYYYYMM', convert_yyyymm_to_date),
+                           ('LastUpdatedOn', convert_date_to_isoformat)):
+        values = [record.get(field) for record in records]
+        present = [value for value in values if value]
+        converted = iter(map_distinct(convert, present))
+        columns[field] = [next(converted) if value else ""
+                          for value in values]
+
+    for metadata, start_date, end_date, last_updated_on in zip(
+            records, columns['StartDateYYYYMM'], columns['EndDateYYYYMM'],
+            columns['LastUpdatedOn']):
+        custom_ACE_data(metadata)
+        dates = {"version": metadata.get('VerNum') or "",
+                 "start_date": start_date, "end_date": end_date,
+                 "last_updated_on": last_updated_on}
+        metadata['groups'] = get_ACE_course_areas(metadata.get('groups'),
+                                                  dates)
+        if metadata.get('titles'):
+            metadata['titles'] = join_ACE_titles(metadata['titles'])
+    return records
+
+
 def extract_ACE_course_data(source_data_dict):
-    ace_fields = ['ACEID',
-                  'VerNum',
-                  'Chapter',
-                  'ModDate',
-                  'StartDateYYYYMM',
-                  'EndDateYYYYMM',
-                  'LastUpdatedOn',
-                  'objective',
-                  ['instruction'],
-                  'titles',
-                  'locations',
-                  'groups']
     source_data_dict = source_data_dict["update"]['versions']
 
     logger.info("Retrieving data from source page ")
-    source_df = pd.json_normalize(source_data_dict,
-                                  record_path=['courses'],
-                                  meta=ace_fields,
-                                  errors='ignore', sep='.')
-    source_df["requirements"] = source_df["instruction"]
-    source_df["description"] = (source_df["objective"])
-    source_df["experience_id"] = source_df["CourseNumber"]
-    source_df["Key_val"] = (
-        source_df["ACEID"] + source_df["CourseNumber"] +
-        source_df["VerNum"])
-    source_df.to_excel("course.xlsx")
-    source_df_list = source_df
-    return source_df_list
+    return flatten_ACE_course_records(source_data_dict)
 
 
 def extract_ACE_occupation_data(source_data_dict):
-    ace_fields = ['ACEID',
-                  'Type',
-                  'Chapter',
-                  'ModDate',
-                  'StartDateYYYYMM',
-                  'EndDateYYYYMM',
-                  'LastUpdatedOn',
-                  'Pattern',
-                  'Summary',
-                  'titles',
-                  'field']
     source_data_dict = source_data_dict["update"]['exhibits']
 
     logger.info("Retrieving data from source page ")
-    source_df = pd.json_normalize(source_data_dict,
-                                  record_path=['levels'],
-                                  meta=ace_fields,
-                                  errors='ignore')
-
-    source_df["requirements"] = source_df["Pattern"]
-    source_df["description"] = source_df["Summary"]
-    source_df["experience_id"] = (
-        source_df["ACEID"] + "-" + source_df["SkillLevel"])
-    source_df["Key_val"] = (
-        source_df["ACEID"] + source_df["SkillLevel"])
+    return flatten_ACE_occupation_records(source_data_dict)
 
-    source_df_list = source_df
-    return source_df_list
 
+def join_fields(*values):
+    """Concatenate key fields, None when any of them is missing"""
+    if any(value is None for value in values):
+        return None
+    return ''.join(values)
+
+
+def flatten_ACE_course_records(versions):
+    """Flatten ACE course versions into one dict per course, with null
+    values as None, list fields stay lists however many entries each
+    version has"""
+    rows = fill_missing_fields(
+        iter_flattened_records(versions, 'courses', ACE_COURSE_FIELDS),
+        get_meta_keys(ACE_COURSE_FIELDS))
+    for row in rows:
+        row["requirements"] = row["instruction"]
+        row["description"] = row["objective"]
+        row["experience_id"] = row["CourseNumber"]
+        row["Key_val"] = join_fields(row["ACEID"], row["CourseNumber"],
+                                     row["VerNum"])
+    return rows
+
+
+def flatten_ACE_occupation_records(exhibits):
+    """Flatten ACE occupation exhibits into one dict per skill level, with
+    null values as None"""
+    rows = fill_missing_fields(
+        iter_flattened_records(exhibits, 'levels', ACE_OCCUPATION_FIELDS),
+        get_meta_keys(ACE_OCCUPATION_FIELDS))
+    for row in rows:
+        row["requirements"] = row["Pattern"]
+        row["description"] = row["Summary"]
+        row["experience_id"] = join_fields(row["ACEID"], "-",
+                                           row["SkillLevel"])
+        row["Key_val"] = join_fields(row["ACEID"], row["SkillLevel"])
+    return rows
+
+
+def iter_digest_chunks(chunks, content_digest, metrics=None):
+    """Pass chunks through while feeding them to content_digest, adding
+    their size to the http_bytes of metrics when given"""
+    for chunk in chunks:
+        content_digest.update(chunk)
+        if metrics is not None:
+            metrics['http_bytes'] += len(chunk)
+        yield chunk
+
+
+def iter_xsr_records(resp, xsr_obj, content_digest=None, snapshot=None,
+                     metrics=None):
+    """Yield ACE records one at a time from a streamed XSR response,
+    feeding the raw body to content_digest and snapshot on the way"""
+    chunks = iter(resp.iter_content(chunk_size=XSR_STREAM_READ_SIZE))
+    if content_digest is not None:
+        chunks = iter_digest_chunks(chunks, content_digest, metrics)
+    if snapshot is not None:
+        chunks = snapshot.record(xsr_obj, resp, chunks)
+    yield from iter_json_items(chunks, XSR_RECORD_PATHS[xsr_obj.API_type])
+    # read past the records so the digest and snapshot get the whole body
+    for _ in chunks:
+        pass
+
+
+def iter_record_batches(records, batch_size):
+    """Group an iterable of records into lists of at most batch_size"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_xsr_metrics(report, xsr_obj):
+    """Extraction counters of xsr_obj kept in the 'configurations' of
+    report, counters that are thrown away when there is no report"""
+    metrics = {'wall_time': 0.0, 'records_fetched': 0, 'http_bytes': 0}
+    if report is None:
+        return metrics
+    return report.setdefault('configurations', {}).setdefault(xsr_obj,
+                                                              metrics)
+
+
+def set_xsr_fingerprint(xsr_obj, resp, content_digest):
+    """Remember the validators and digest of the feed just received on
+    the configuration, they are only saved by save_xsr_state"""
+    xsr_obj.etag = resp.headers.get('ETag')
+    xsr_obj.last_modified = resp.headers.get('Last-Modified')
+    xsr_obj.content_digest = content_digest
+
+
+def save_xsr_state(xsr_list):
+    """Persist the fingerprint and watermark of feeds once their records
+    are stored"""
+    for xsr_obj in xsr_list:
+        xsr_obj.save(update_fields=['etag', 'last_modified',
+                                    'content_digest',
+                                    'last_updated_watermark'])
+
+
+def get_xsr_api_data(xsr_obj, session=None, full=False, snapshot=None,
+                     metrics=None):
+    """Function to get the parsed api response from xsr endpoint, None is
+    returned when the feed did not change since the last extraction"""
+    with profile_phase('fetch'):
+        resp = get_xsr_api_response(xsr_obj, session=session, full=full)
+        if resp.status_code == 304:
+            logger.info('XSR feed ' + xsr_obj.Transcript_API +
+                        ' not modified since last extraction')
+            return None
+        # an error body would be parsed as the feed and fingerprinted
+        resp.raise_for_status()
+        content = resp.content
+    XSR_RESPONSE_BYTES.labels(str(xsr_obj.pk)).observe(len(content))
+    if metrics is not None:
+        metrics['http_bytes'] += len(content)
+    content_digest = hashlib.sha512(content).hexdigest()
+    unchanged = not full and content_digest == xsr_obj.content_digest
+    set_xsr_fingerprint(xsr_obj, resp, content_digest)
+    if unchanged:
+        logger.info('XSR feed ' + xsr_obj.Transcript_API +
+                    ' content unchanged since last extraction')
+        return None
+    if snapshot is not None:
+        snapshot.add(xsr_obj, resp, content)
+    with profile_phase('parse'):
+        return json.loads(content)
+
+
+def fetch_xsr_api_data(xsr_list, session, full=False, snapshot=None,
+                       report=None):
+    """Request every XSR endpoint in parallel over a shared session and
+    return the parsed responses in configuration order, timing each of
+    them in report when given"""
+    metrics_list = [get_xsr_metrics(report, xsr_obj) for xsr_obj in xsr_list]
+
+    def fetch(xsr_obj, metrics):
+        started = time.monotonic()
+        try:
+            return get_xsr_api_data(xsr_obj, session, full, snapshot,
+                                    metrics)
+        finally:
+            metrics['wall_time'] += time.monotonic() - started
+
+    workers = min(max(settings.XSR_FETCH_CONCURRENCY, 1), len(xsr_list))
+    # a profile only sees the thread it was started in
+    if workers <= 1 or is_profiling():
+        return [fetch(xsr_obj, metrics)
+                for xsr_obj, metrics in zip(xsr_list, metrics_list)]
+
+    logger.info("Fetching " + str(len(xsr_list)) + " XSR endpoints with " +
+                str(workers) + " concurrent requests")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, xsr_list, metrics_list))
+
+
+@run_cached('XSRConfiguration')
+def get_xsr_configurations(xsr_ids=None):
+    """XSR configurations, only those with an id in the tuple xsr_ids when
+    given"""
+    xsr_list = XSRConfiguration.objects.all()
+    if xsr_ids is not None:
+        xsr_list = xsr_list.filter(pk__in=xsr_ids)
+    return list(xsr_list)
+
+
+def get_xsr_sources(replay=None, xsr_ids=None):
+    """XSR configurations to extract, only those with an id in xsr_ids
+    when given, with the session to request them, served from the replay
+    snapshot session when one is given"""
+    if replay is not None:
+        xsr_list, session = replay.configurations(), replay
+    else:
+        xsr_list = list(get_xsr_configurations(
+            None if xsr_ids is None else tuple(xsr_ids)))
+        session = get_xsr_session()
+    if xsr_ids is not None:
+        xsr_list = [xsr_obj for xsr_obj in xsr_list if xsr_obj.pk in xsr_ids]
+    return xsr_list, session
+
+
+def stream_source(full=False, report=None, snapshot=None, replay=None,
+                  xsr_ids=None):
+    """Generator streaming every XSR feed and yielding lists of flattened
+    records from at most XSR_STREAM_CHUNK_SIZE source records"""
+
+    # feeds are consumed one after the other to keep memory bounded, the
+    # pooled session still saves a connection setup per endpoint
+    xsr_list, session = get_xsr_sources(replay, xsr_ids)
+    for xsr_obj in xsr_list:
+
+        metrics = get_xsr_metrics(report, xsr_obj)
+        started = time.monotonic()
+        with profile_phase('fetch'):
+            resp = get_xsr_api_response(xsr_obj, stream=True,
+                                        session=session, full=full)
+        if resp.status_code == 304:
+            logger.info('XSR feed ' + xsr_obj.Transcript_API +
+                        ' not modified since last extraction')
+            if report is not None:
+                report['skipped'].append(xsr_obj)
+            resp.close()
+            metrics['wall_time'] += time.monotonic() - started
+            continue
+        # an error body would read as an empty feed and be fingerprinted
+        try:
+            resp.raise_for_status()
+        except requests.exceptions.HTTPError:
+            resp.close()
+            raise
 
-def extract_source():
+        if xsr_obj.API_type == "Course":
+            flatten = flatten_ACE_course_records
+        else:
+            flatten = flatten_ACE_occupation_records
+
+        # the digest is only known once the whole feed went through, so
+        # it is recorded here but can not short-circuit the stream
+        content_digest = hashlib.sha512()
+
+        logger.info("Streaming data from source page ")
+        batches = iter_record_batches(
+            iter_records_since(iter_xsr_records(
+                resp, xsr_obj, content_digest, snapshot, metrics),
+                xsr_obj, full),
+            settings.XSR_STREAM_CHUNK_SIZE)
+        try:
+            while True:
+                # reading the body is parsing it, they make a single phase
+                with profile_phase('parse'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                with profile_phase('normalize'):
+                    rows = flatten(batch)
+                RECORDS_NORMALIZED.labels(str(xsr_obj.pk)).inc(len(rows))
+                metrics['records_fetched'] += len(rows)
+                # the time spent storing the rows is not the feed's
+                metrics['wall_time'] += time.monotonic() - started
+                yield rows
+                started = time.monotonic()
+        finally:
+            resp.close()
+        metrics['wall_time'] += time.monotonic() - started
+        XSR_RESPONSE_BYTES.labels(str(xsr_obj.pk)).observe(
+            metrics['http_bytes'])
+
+        set_xsr_fingerprint(xsr_obj, resp, content_digest.hexdigest())
+        if report is not None:
+            report['fetched'].append(xsr_obj)
+    session.close()
+    logger.info("Completed streaming data from source")
+
+
+def extract_source(stream=None, full=False, report=None, snapshot=None,
+                   replay=None, xsr_ids=None):
     """function to parse xsr data and
-    convert to dictionary"""
-
-    std_source_df = pd.DataFrame()
-
-    source_df_list = []
+    convert to dictionary
+
+    Feeds that did not change since the last extraction are left out.
+    When a report dict is given its 'fetched' list receives the
+    configurations whose new fingerprint should be saved with
+    save_xsr_state once their records are stored, and its 'skipped'
+    list the configurations that were left out, its 'configurations' dict
+    maps each configuration to its wall_time, records_fetched and
+    http_bytes counters. Raw responses are handed
+    to the snapshot writer when one is given, a replay session serves
+    them back instead of the XSR. xsr_ids limits the extraction to the
+    configurations with those ids."""
+
+    if stream is None:
+        stream = settings.XSR_STREAMING
+    if stream:
+        return stream_source(full, report, snapshot, replay, xsr_ids)
+
+    source_records = []
+
+    xsr_list, session = get_xsr_sources(replay, xsr_ids)
+    with session:
+        source_data_list = fetch_xsr_api_data(xsr_list, session, full,
+                                              snapshot, report)
+
+    for xsr_obj, source_data_dict in zip(xsr_list, source_data_list):
+
+        if report is not None:
+            report['fetched' if source_data_dict is not None
+                   else 'skipped'].append(xsr_obj)
+        if source_data_dict is None:
+            continue
+
+        metrics = get_xsr_metrics(report, xsr_obj)
+        started = time.monotonic()
+        records_key = XSR_RECORD_PATHS[xsr_obj.API_type][-1]
+        records = source_data_dict["update"][records_key]
+        if isinstance(records, dict):
+            records = [records]
+        records = list(iter_records_since(records, xsr_obj, full))
+        if not records:
+            continue
+        source_data_dict["update"][records_key] = records
+
+        # flattened like streamed feeds, so both modes store and hash the
+        # same metadata
+        with profile_phase('normalize'):
+            if xsr_obj.API_type == "Course":
+                rows = extract_ACE_course_data(source_data_dict)
 
-    for xsr_obj in XSRConfiguration.objects.all():
-
-        resp = get_xsr_api_response(xsr_obj)
-        source_data_dict = json.loads(resp.text)
-
-        if xsr_obj.API_type == "Course":
-            source_df = extract_ACE_course_data(source_data_dict)
+            else:
+                rows = extract_ACE_occupation_data(source_data_dict)
+        source_records.extend(rows)
+        RECORDS_NORMALIZED.labels(str(xsr_obj.pk)).inc(len(rows))
+        metrics['records_fetched'] += len(rows)
+        metrics['wall_time'] += time.monotonic() - started
 
-        else:
-            source_df = extract_ACE_occupation_data(source_data_dict)
-        source_df_list.append(source_df)
+    if not source_records:
+        logger.info("No XSR feed changed since last extraction")
+        return []
 
-    source_df = pd.concat(source_df_list).reset_index(drop=True)
-    logger.info("Changing null values to None for source dataframe")
-    std_source_df = source_df.where(pd.notnull(source_df),
-                                    None)
     logger.info("Completed retrieving data from source")
-    return [std_source_df]
+    return [source_records]
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('dict_config_logger')
+
+XSR_STUB_READ_SIZE = 64 * 1024
+# Error bodies of the API management gateway in front of the ACE API
+XSR_STUB_ERRORS = {
+    'missing_key': (401, 'Access denied due to missing subscription key. '
+                         'Make sure to include subscription key when making '
+                         'requests to an API.'),
+    'invalid_key': (401, 'Access denied due to invalid subscription key. '
+                         'Make sure to provide a valid key for an active '
+                         'subscription.'),
+    'not_found': (404, 'Resource not found'),
+}
+
+
+class XSRStubHandler(BaseHTTPRequestHandler):
+    """Answers GET requests for the feeds of an XSRStubServer"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_error_body(self, error):
+        status, message = XSR_STUB_ERRORS[error]
+        body = json.dumps({'statusCode': status,
+                           'message': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        key = self.headers.get('Ocp-Apim-Subscription-Key')
+        if not key:
+            return self.send_error_body('missing_key')
+        if key != self.server.subscription_key:
+            return self.send_error_body('invalid_key')
+        feed = self.server.feeds.get(urlsplit(self.path).path.strip('/'))
+        if feed is None:
+            return self.send_error_body('not_found')
+
+        if ('no-cache' not in self.headers.get('Cache-Control', '') and
+                self.headers.get('If-None-Match') == feed['etag']):
+            self.send_response(304)
+            self.send_header('ETag', feed['etag'])
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(feed['size']))
+        self.send_header('ETag', feed['etag'])
+        self.send_header('Last-Modified', feed['last_modified'])
+        self.end_headers()
+        with open(feed['path'], 'rb') as file:
+            for chunk in iter(lambda: file.read(XSR_STUB_READ_SIZE), b''):
+                self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        logger.debug('XSR stub ' + format % args)
+
+
+class XSRStubServer(ThreadingHTTPServer):
+    """Local HTTP server answering like the ACE Transcript API, serving
+    feed files under their name and requiring the Ocp-Apim-Subscription-Key
+    header
+
+    Responses carry an ETag and Last-Modified, If-None-Match is answered
+    with 304 unless the request asks for no-cache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, feeds, subscription_key, host='127.0.0.1', port=0):
+        """feeds maps the name of each feed to the path of its file"""
+        super().__init__((host, port), XSRStubHandler)
+        self.subscription_key = subscription_key
+        self.feeds = {}
+        for name, path in feeds.items():
+            stat = os.stat(path)
+            self.feeds[name] = {
+                'path': path,
+                'size': stat.st_size,
+                'etag': '"' + format(stat.st_mtime_ns, 'x') + '-' +
+                        format(stat.st_size, 'x') + '"',
+                'last_modified': formatdate(stat.st_mtime, usegmt=True),
+            }
+
+    def url(self, name):
+        """URL of the feed name"""
+        host, port = self.server_address[:2]
+        return 'http://' + host + ':' + str(port) + '/' + name
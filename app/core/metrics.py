@@ -0,0 +1,95 @@
+import glob
+import os
+
+from core.models import StageRun, WorkflowRun
+from django.conf import settings
+from django.db.models import Count
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+# Metrics are aggregated in the process that records them. With
+# PROMETHEUS_MULTIPROC_DIR set, each gunicorn and celery worker writes its
+# values to files in that directory, one per container, and the metrics
+# endpoint adds up the files of the directories of XIA_METRICS_DIRS.
+
+XSR_REQUEST_SECONDS = Histogram(
+    'xia_xsr_request_seconds',
+    'Time to receive an XSR response, up to the headers when streaming',
+    ['configuration'])
+XSR_RESPONSE_BYTES = Histogram(
+    'xia_xsr_response_bytes', 'Size of XSR response bodies',
+    ['configuration'],
+    buckets=[2 ** exponent for exponent in range(10, 32, 2)])
+RECORDS_NORMALIZED = Counter(
+    'xia_records_normalized', 'XSR records flattened into ledger rows',
+    ['configuration'])
+LEDGER_RECORDS = Counter(
+    'xia_ledger_records',
+    'Metadata ledger records inserted, inactivated or skipped as unchanged',
+    ['operation'])
+RUN_CACHE_LOOKUPS = Counter(
+    'xia_run_cache_lookups',
+    'Configuration and schema lookups of workflow runs served from the '
+    'run cache or fetched', ['lookup', 'result'])
+STAGE_SECONDS = Histogram(
+    'xia_workflow_stage_seconds', 'Duration of workflow stages',
+    ['stage', 'status'],
+    buckets=[1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200])
+
+
+class WorkflowCollector:
+    """Queued and running workflow runs and stages, read from their
+    checkpoints when metrics are collected so every process agrees"""
+
+    def collect(self):
+        runs = GaugeMetricFamily('xia_workflow_runs',
+                                 'Workflow runs waiting or in progress',
+                                 labels=['status'])
+        counts = dict(WorkflowRun.objects.filter(
+            status__in=[WorkflowRun.STATUS.pending,
+                        WorkflowRun.STATUS.running]).values_list(
+            'status').annotate(Count('id')).order_by())
+        for status in (WorkflowRun.STATUS.pending,
+                       WorkflowRun.STATUS.running):
+            runs.add_metric([status], counts.get(status, 0))
+        yield runs
+
+        stages = GaugeMetricFamily('xia_workflow_stage_tasks',
+                                   'Workflow stage tasks queued or running',
+                                   labels=['stage', 'status'])
+        counts = {(stage, status): count for stage, status, count in
+                  StageRun.objects.filter(
+                      status__in=[StageRun.STATUS.queued,
+                                  StageRun.STATUS.running]).values_list(
+                      'stage', 'status').annotate(Count('id')).order_by()}
+        for (stage, status), count in sorted(counts.items()):
+            stages.add_metric([stage, status], count)
+        yield stages
+
+
+class ContainerMetricsCollector:
+    """Metrics of the processes of several containers, each writing to a
+    PROMETHEUS_MULTIPROC_DIR of its own"""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def collect(self):
+        files = [file for path in self.paths
+                 for file in glob.glob(os.path.join(path, '*.db'))]
+        return multiprocess.MultiProcessCollector.merge(files,
+                                                        accumulate=True)
+
+
+def generate_metrics():
+    """Metrics of every process in the text exposition format, with its
+    content type"""
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry.register(ContainerMetricsCollector(settings.XIA_METRICS_DIRS))
+    else:
+        registry.register(REGISTRY)
+    registry.register(WorkflowCollector())
+    return generate_latest(registry), CONTENT_TYPE_LATEST
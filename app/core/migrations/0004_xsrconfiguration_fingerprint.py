@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_xsrconfiguration_api_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xsrconfiguration',
+            name='content_digest',
+            field=models.CharField(blank=True, help_text='SHA-512 of the last extracted response body', max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='xsrconfiguration',
+            name='etag',
+            field=models.CharField(blank=True, help_text='ETag of the last extracted response', max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='xsrconfiguration',
+            name='last_modified',
+            field=models.CharField(blank=True, help_text='Last-Modified of the last extracted response', max_length=100, null=True),
+        ),
+    ]
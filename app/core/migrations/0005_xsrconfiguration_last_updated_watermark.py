@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_xsrconfiguration_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xsrconfiguration',
+            name='last_updated_watermark',
+            field=models.DateTimeField(blank=True, help_text='Latest LastUpdatedOn/ModDate of the last extraction', null=True),
+        ),
+    ]
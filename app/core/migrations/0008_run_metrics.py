@@ -0,0 +1,68 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_workflowrun_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stagerun',
+            name='http_bytes',
+            field=models.BigIntegerField(blank=True, help_text='Bytes of XSR response bodies', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak resident memory of the process in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='query_count',
+            field=models.PositiveIntegerField(blank=True, help_text='Database queries', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='records_changed',
+            field=models.PositiveIntegerField(blank=True, help_text='Records not already Active in the metadata ledger', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='records_fetched',
+            field=models.PositiveIntegerField(blank=True, help_text='Records read from the XSR', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='records_written',
+            field=models.PositiveIntegerField(blank=True, help_text='Metadata ledger rows inserted or inactivated', null=True),
+        ),
+        migrations.AddField(
+            model_name='stagerun',
+            name='wall_time',
+            field=models.FloatField(blank=True, help_text='Seconds', null=True),
+        ),
+        migrations.CreateModel(
+            name='ConfigurationRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wall_time', models.FloatField(blank=True, help_text='Seconds', null=True)),
+                ('records_fetched', models.PositiveIntegerField(blank=True, help_text='Records read from the XSR', null=True)),
+                ('records_changed', models.PositiveIntegerField(blank=True, help_text='Records not already Active in the metadata ledger', null=True)),
+                ('records_written', models.PositiveIntegerField(blank=True, help_text='Metadata ledger rows inserted or inactivated', null=True)),
+                ('http_bytes', models.BigIntegerField(blank=True, help_text='Bytes of XSR response bodies', null=True)),
+                ('query_count', models.PositiveIntegerField(blank=True, help_text='Database queries', null=True)),
+                ('peak_rss', models.BigIntegerField(blank=True, help_text='Peak resident memory of the process in bytes', null=True)),
+                ('Transcript_API', models.CharField(blank=True, max_length=200, null=True)),
+                ('stage_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='configurations', to='core.stagerun')),
+                ('xsr_configuration', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='runs', to='core.xsrconfiguration')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
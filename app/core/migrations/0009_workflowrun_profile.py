@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_run_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowrun',
+            name='profile',
+            field=models.BooleanField(default=False, help_text='Profile the stages of the run under XIA_PROFILE_DIR'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:28
+
+from django.db import migrations, models
+import core.models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openlxp_xia', '0009_auto_20250225_1536'),
+        ('core', '0009_workflowrun_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerKeyIndex',
+            fields=[
+                ('key_digest', core.models.DigestField(help_text='Digest of source_metadata_key_hash', max_length=16, primary_key=True, serialize=False)),
+                ('metadata_digest', core.models.DigestField(blank=True, help_text='Digest of source_metadata_hash of the Active version', max_length=16, null=True)),
+                ('last_updated_on', models.CharField(blank=True, help_text='LastUpdatedOn of the Active version', max_length=64, null=True)),
+                ('ledger', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='openlxp_xia.metadataledger')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_ledger_key_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stagerun',
+            name='task_id',
+            field=models.CharField(blank=True, help_text='Celery task running the stage and publishing its progress', max_length=255, null=True),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from model_utils import Choices
-from model_utils.models import StatusField
+from model_utils.models import StatusField, TimeStampedModel
+from openlxp_xia.models import MetadataLedger
 
 
 class XSRConfiguration(models.Model):
@@ -18,3 +19,136 @@ class XSRConfiguration(models.Model):
     )
     Parameter = models.JSONField('Enter parameters ',
                                  null=True, blank=True)
+    etag = models.CharField(
+        help_text='ETag of the last extracted response',
+        max_length=200, null=True, blank=True)
+    last_modified = models.CharField(
+        help_text='Last-Modified of the last extracted response',
+        max_length=100, null=True, blank=True)
+    content_digest = models.CharField(
+        help_text='SHA-512 of the last extracted response body',
+        max_length=128, null=True, blank=True)
+    last_updated_watermark = models.DateTimeField(
+        help_text='Latest LastUpdatedOn/ModDate of the last extraction',
+        null=True, blank=True)
+
+
+class WorkflowRun(TimeStampedModel):
+    """Model for one run of the XIA workflow and its stages"""
+    STATUS = Choices('pending', 'running', 'succeeded', 'failed')
+    status = StatusField()
+    finished = models.DateTimeField(null=True, blank=True)
+    task_id = models.CharField(max_length=255, null=True, blank=True,
+                               db_index=True)
+    profile = models.BooleanField(
+        default=False,
+        help_text='Profile the stages of the run under XIA_PROFILE_DIR')
+
+    def __str__(self):
+        return 'Workflow run ' + str(self.pk) + ' ' + self.status
+
+
+class RunMetrics(models.Model):
+    """Resources used by a stage of a workflow run or by the extraction of
+    one XSR configuration, fields that do not apply are left empty"""
+    wall_time = models.FloatField(
+        help_text='Seconds', null=True, blank=True)
+    records_fetched = models.PositiveIntegerField(
+        help_text='Records read from the XSR', null=True, blank=True)
+    records_changed = models.PositiveIntegerField(
+        help_text='Records not already Active in the metadata ledger',
+        null=True, blank=True)
+    records_written = models.PositiveIntegerField(
+        help_text='Metadata ledger rows inserted or inactivated',
+        null=True, blank=True)
+    http_bytes = models.BigIntegerField(
+        help_text='Bytes of XSR response bodies', null=True, blank=True)
+    query_count = models.PositiveIntegerField(
+        help_text='Database queries', null=True, blank=True)
+    peak_rss = models.BigIntegerField(
+        help_text='Peak resident memory of the process in bytes',
+        null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+
+class StageRun(RunMetrics):
+    """Model for the checkpoint of one stage of a workflow run"""
+    STATUS = Choices('pending', 'queued', 'running', 'succeeded', 'failed')
+    workflow_run = models.ForeignKey(WorkflowRun, on_delete=models.CASCADE,
+                                     related_name='stages')
+    stage = models.CharField(max_length=50)
+    status = StatusField()
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    task_id = models.CharField(
+        max_length=255, null=True, blank=True,
+        help_text='Celery task running the stage and publishing its '
+                  'progress')
+
+    class Meta:
+        ordering = ('id',)
+        unique_together = ('workflow_run', 'stage')
+
+    def __str__(self):
+        return self.stage + ' ' + self.status
+
+
+class ConfigurationRun(RunMetrics):
+    """Model for the extraction of one XSR configuration in a stage"""
+    stage_run = models.ForeignKey(StageRun, on_delete=models.CASCADE,
+                                  related_name='configurations')
+    xsr_configuration = models.ForeignKey(
+        XSRConfiguration, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='runs')
+    Transcript_API = models.CharField(max_length=200, null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return str(self.Transcript_API) + ' in ' + str(self.stage_run)
+
+
+class DigestField(models.BinaryField):
+    """Fixed length binary digest, a binary column MySQL can index and use
+    as primary key where BinaryField is a longblob"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 16)
+        super().__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return 'binary(%d)' % self.max_length
+        return super().db_type(connection)
+
+    def from_db_value(self, value, expression, connection):
+        # drivers return bytearray or memoryview, digests are dict keys
+        return None if value is None else bytes(value)
+
+
+class LedgerKeyIndex(models.Model):
+    """Model for the only Active MetadataLedger version of an ACE key, kept
+    by the extraction so change detection does not search the ledger
+
+    Digests are the first 128 bits of a BLAKE2b of the ledger hashes. Keys
+    without exactly one Active version have a row without digests, rows
+    are locked by the writers of their key so concurrent extractions take
+    turns on it.
+    """
+    key_digest = DigestField(
+        primary_key=True, help_text='Digest of source_metadata_key_hash')
+    metadata_digest = DigestField(
+        help_text='Digest of source_metadata_hash of the Active version',
+        null=True, blank=True)
+    last_updated_on = models.CharField(
+        help_text='LastUpdatedOn of the Active version',
+        max_length=64, null=True, blank=True)
+    # the ledger row may be inactivated or deleted outside the extraction,
+    # lookups only trust rows whose ledger row is still Active
+    ledger = models.ForeignKey(MetadataLedger, on_delete=models.DO_NOTHING,
+                               db_constraint=False, related_name='+',
+                               null=True, blank=True)
@@ -1,8 +1,21 @@
 import logging
+import uuid
 
-from celery import shared_task
+from celery import chord, shared_task
 from core.management.commands.extract_source_metadata import \
-    Command as extract_Command
+    get_source_metadata
+from core.management.utils.progress import reporting_progress
+from core.management.utils.run_cache import run_cache
+from core.models import WorkflowRun, XSRConfiguration
+from core.workflow import (WORKFLOW_TASK, acquire_workflow_lock,
+                           claim_ready_stages, finish_stage,
+                           get_workflow_run, holding_workflow_lock,
+                           measure_resources,
+                           profile_stage, record_configuration_runs,
+                           run_stage, start_stage,
+                           summarize_configuration_runs,
+                           update_workflow_status)
+from django.conf import settings
 from openlxp_notifications.management.commands.trigger_status_update import \
     Command as conformance_alerts_Command
 from openlxp_xia.management.commands.load_supplemental_metadata import \
@@ -19,25 +32,128 @@ from openlxp_xia.management.commands.validate_target_metadata import \
 logger = logging.getLogger('dict_config_logger')
 
 
-@shared_task(name="workflow_for_xia")
-def execute_xia_automated_workflow():
-    """XIA automated workflow"""
+# Command run by each stage of core.workflow.WORKFLOW_STAGES, the
+# extraction returns its report so its counters are recorded
+STAGE_COMMANDS = {
+    'conformance_alerts': lambda: conformance_alerts_Command().handle(
+        email_references="Status_update"),
+    'extract': lambda: get_source_metadata(),
+    'validate_source': lambda: validate_source_Command().handle(),
+    'transform': lambda: transform_Command().handle(),
+    'validate_target': lambda: validate_target_Command().handle(),
+    'load': lambda: load_Command().handle(),
+    'load_supplemental': lambda: load_supplemental_Command().handle(),
+}
+
+
+@shared_task(bind=True, name=WORKFLOW_TASK)
+def execute_xia_automated_workflow(self, run_id=None, profile=False):
+    """XIA automated workflow, resuming run_id from its first incomplete
+    stages when given, profiling every stage under XIA_PROFILE_DIR when
+    profile is set"""
     logger.info('STARTING WORKFLOW')
+    task_id = None
+    if run_id is None:
+        # runs given by the API already hold the workflow lock
+        task_id = self.request.id or str(uuid.uuid4())
+        holder = acquire_workflow_lock(task_id)
+        if holder is not None:
+            logger.info('Workflow already running in task ' + holder)
+            return None
+    run = get_workflow_run(run_id, task_id, profile)
 
-    conformance_alerts_class = conformance_alerts_Command()
-    extract_class = extract_Command()
-    validate_source_class = validate_source_Command()
-    transform_class = transform_Command()
-    validate_target_class = validate_target_Command()
-    load_class = load_Command()
-    load_supplemental_class = load_supplemental_Command()
-
-    conformance_alerts_class.handle(email_references="Status_update")
-    extract_class.handle()
-    validate_source_class.handle()
-    transform_class.handle()
-    validate_target_class.handle()
-    load_class.handle()
-    load_supplemental_class.handle()
+    if settings.XIA_WORKFLOW_MODE == 'dag':
+        dispatch_workflow_stages(run)
+        logger.info('DISPATCHED WORKFLOW')
+        return run.pk
+
+    try:
+        # stages share the configuration and schema lookups of the run
+        with reporting_progress(self, run_id=run.pk, stage=None,
+                                configurations={}), run_cache():
+            while True:
+                ready = claim_ready_stages(run, limit=1)
+                if not ready:
+                    break
+                run_stage(run, ready[0], STAGE_COMMANDS[ready[0]],
+                          self.request.id)
+    finally:
+        update_workflow_status(run)
 
     logger.info('COMPLETED WORKFLOW')
+    return run.pk
+
+
+def dispatch_workflow_stages(run):
+    """Send a task for every stage of run ready to start"""
+    for stage in claim_ready_stages(run):
+        execute_workflow_stage.delay(run.pk, stage)
+    update_workflow_status(run)
+
+
+@shared_task(bind=True, name="workflow_stage_for_xia")
+def execute_workflow_stage(self, run_id, stage):
+    """Run one stage of a workflow run and dispatch the stages it
+    unblocks, publishing its progress as the state of this task"""
+    run = WorkflowRun.objects.get(pk=run_id)
+    if stage == 'extract' and settings.XIA_EXTRACT_FANOUT:
+        fan_out_extract_stage(run)
+        return
+    try:
+        with reporting_progress(self, run_id=run.pk, configurations={}), \
+                run_cache():
+            run_stage(run, stage, STAGE_COMMANDS[stage], self.request.id)
+    finally:
+        dispatch_workflow_stages(run)
+
+
+def fan_out_extract_stage(run):
+    """Extract every XSR configuration of run in its own task, the extract
+    stage completes once all of them are done"""
+    start_stage(run, 'extract')
+    xsr_ids = list(XSRConfiguration.objects.values_list('pk', flat=True))
+    if not xsr_ids:
+        finish_stage(run, 'extract')
+        dispatch_workflow_stages(run)
+        return
+    logger.info('Extracting ' + str(len(xsr_ids)) +
+                ' XSR configurations in parallel')
+    callback = complete_workflow_stage.si(run.pk, 'extract')
+    callback.link_error(fail_workflow_stage.si(run.pk, 'extract'))
+    chord([extract_xsr_configuration.si(run.pk, xsr_id)
+           for xsr_id in xsr_ids])(callback)
+
+
+@shared_task(bind=True, name="workflow_extract_configuration_for_xia")
+def extract_xsr_configuration(self, run_id, xsr_id):
+    """Extract the records of a single XSR configuration, publishing its
+    progress as the state of this task"""
+    logger.info('Workflow run ' + str(run_id) +
+                ' extracting XSR configuration ' + str(xsr_id))
+    run = WorkflowRun.objects.get(pk=run_id)
+    with measure_resources() as metrics, holding_workflow_lock(
+            run.task_id), profile_stage(
+            run, 'extract', 'extract-' + str(xsr_id)), reporting_progress(
+            self, run_id=run.pk, stage='extract', configurations={}):
+        report = get_source_metadata(xsr_ids=[xsr_id])
+    metrics.update(records_changed=report['records_changed'],
+                   records_written=report['records_written'])
+    record_configuration_runs(run, 'extract', report, metrics)
+
+
+@shared_task(name="workflow_complete_stage_for_xia")
+def complete_workflow_stage(run_id, stage):
+    """Checkpoint a stage run by several tasks once they all succeeded"""
+    run = WorkflowRun.objects.get(pk=run_id)
+    finish_stage(run, stage,
+                 metrics=summarize_configuration_runs(run, stage))
+    dispatch_workflow_stages(run)
+
+
+@shared_task(name="workflow_fail_stage_for_xia")
+def fail_workflow_stage(run_id, stage):
+    """Checkpoint a stage run by several tasks when one of them failed"""
+    run = WorkflowRun.objects.get(pk=run_id)
+    finish_stage(run, stage, 'A task of the ' + stage + ' stage failed',
+                 summarize_configuration_runs(run, stage))
+    update_workflow_status(run)
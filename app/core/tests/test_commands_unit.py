@@ -1,15 +1,36 @@
+import copy
+import io
+import json
 import logging
-from unittest.mock import patch
+import os
+import tempfile
+import threading
+import uuid
+from unittest.mock import MagicMock, call, patch
 
+import billiard
 import pandas as pd
 from core.management.commands.extract_source_metadata import (
-    add_publisher_to_source, extract_metadata_using_key, get_source_metadata,
-    store_source_metadata)
-from ddt import ddt
+    ActiveHashIndex, add_publisher_to_source, bleach_source_metadata,
+    extract_metadata_using_key, get_ledger_digest, get_source_metadata,
+    hash_source_metadata, hash_source_metadata_chunk, metadata_hash_pool,
+    store_source_metadata, store_source_metadata_batch)
+from core.management.commands.rehash_source_metadata import \
+    rehash_source_metadata
+from core.management.utils.canonical_json import (dumps_canonical,
+                                                  hash_canonical)
+from core.management.utils.profiling import PROFILE_SUMMARY
+from core.management.utils.progress import reporting_progress
+from ddt import data, ddt
 from django.core.management import call_command
+from django.db import connection
 from django.db.utils import OperationalError
-from django.test import tag
+from core.models import LedgerKeyIndex, WorkflowRun, XSRConfiguration
+from django.test import (LiveServerTestCase, TransactionTestCase,
+                         override_settings, tag)
+from openlxp_xia.management.utils.model_help import bleach_data_to_json
 from openlxp_xia.models import MetadataLedger, XIAConfiguration
+from prometheus_client import REGISTRY
 
 from .test_setup import TestSetUp
 
@@ -48,6 +69,42 @@ class CommandTests(TestSetUp):
             get_source_metadata()
             mock_logger.error.assert_called_with("Source metadata is empty!")
 
+    def test_get_source_metadata_saves_fingerprint(self):
+        """Test feed fingerprints are saved after the records are stored
+        and skipped feeds are reported"""
+        fetched = XSRConfiguration(Transcript_API='test1')
+        fetched.save()
+        skipped = XSRConfiguration(Transcript_API='test2')
+        skipped.save()
+
+        def extract(stream, full, report, snapshot, replay, xsr_ids):
+            fetched.content_digest = 'digest'
+            report['fetched'].append(fetched)
+            report['skipped'].append(skipped)
+            return [self.metadata_df]
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.extract_source', side_effect=extract), \
+                patch('core.management.commands.extract_source_metadata'
+                      '.extract_metadata_using_key') as mock_extract, \
+                patch('core.management.commands.extract_source_metadata'
+                      '.logger') as mock_logger:
+            def store(source_df, hash_index, pool, report):
+                self.assertIsNone(XSRConfiguration.objects.get(
+                    pk=fetched.pk).content_digest)
+                return 0
+
+            mock_extract.side_effect = store
+            report = get_source_metadata()
+
+            self.assertEqual(mock_extract.call_count, 1)
+            self.assertEqual(report['skipped'], [skipped])
+            self.assertEqual(
+                XSRConfiguration.objects.get(pk=fetched.pk).content_digest,
+                'digest')
+            mock_logger.info.assert_called_with(
+                'Skipped unchanged XSR configurations: test2')
+
     def test_add_publisher_to_source(self):
         """Test for Add publisher column to source metadata and return
         source metadata"""
@@ -73,20 +130,60 @@ class CommandTests(TestSetUp):
                 return_value=data_df), \
                 patch(
                     'core.management.commands.extract_source_metadata'
-                    '.get_source_metadata_key_value',
+                    '.get_source_metadata_key_values',
                     return_value=None) as mock_get_source, \
                 patch(
                     'core.management.commands.extract_source_metadata'
-                    '.store_source_metadata',
-                    return_value=None) as mock_store_source:
-            mock_get_source.return_value = mock_get_source
+                    '.store_source_metadata_batch',
+                    return_value=1) as mock_store_source:
+            mock_get_source.return_value = [mock_get_source]
             mock_get_source.exclude.return_value = mock_get_source
             mock_get_source.filter.side_effect = [
                 mock_get_source, mock_get_source]
 
-            extract_metadata_using_key(data_df)
+            self.assertEqual(extract_metadata_using_key(data_df), 1)
             self.assertEqual(mock_get_source.call_count, 1)
             self.assertEqual(mock_store_source.call_count, 1)
+            self.assertEqual(len(mock_store_source.call_args[0][0]), 1)
+
+    @data(False, True)
+    @override_settings(EXTRACT_BATCH_SIZE=2)
+    def test_extract_metadata_using_key_chunks(self, as_list):
+        """Test records are converted and written one chunk at a time, each
+        chunk in a transaction"""
+        records = [dict(self.source_metadata, ACEID=str(number),
+                        Key_val=str(number)) for number in range(5)]
+        source = records if as_list else pd.DataFrame(records)
+        with patch('core.management.commands.extract_source_metadata'
+                   '.transaction.atomic') as mock_atomic:
+            self.assertEqual(extract_metadata_using_key(source), 5)
+
+        self.assertEqual(
+            mock_atomic.call_args_list.count(call(savepoint=False)), 3)
+        self.assertEqual(MetadataLedger.objects.count(), 5)
+
+    @override_settings(EXTRACT_BATCH_SIZE=2)
+    def test_extract_metadata_using_key_progress(self):
+        """Test the records processed are reported after every chunk with
+        the status of each XSR configuration"""
+        records = [dict(self.source_metadata, ACEID=str(number),
+                        Key_val=str(number)) for number in range(5)]
+        xsr_obj = XSRConfiguration(pk=3, Transcript_API='http://xsr')
+        report = {'fetched': [xsr_obj], 'skipped': [], 'records_processed': 0,
+                  'configurations': {xsr_obj: {'records_fetched': 5}}}
+        task = MagicMock()
+        task.request.id = 'task'
+        with reporting_progress(task, interval=0):
+            extract_metadata_using_key(records, report=report)
+
+        metas = [update[1]['meta']
+                 for update in task.update_state.call_args_list]
+        self.assertEqual([meta['records_done'] for meta in metas],
+                         [2, 4, 5])
+        self.assertEqual(metas[-1]['records_total'], 5)
+        self.assertEqual(metas[-1]['configurations'], {
+            '3': {'Transcript_API': 'http://xsr', 'status': 'fetched',
+                  'records_fetched': 5}})
 
     def test_store_source_metadata(self):
         """Test to check saving of source metadata"""
@@ -122,3 +219,450 @@ class CommandTests(TestSetUp):
                         record_lifecycle_status="Inactive")
         self.assertIsNotNone(m_obj_active)
         self.assertIsNotNone(m_obj_inactive)
+
+    def test_store_source_metadata_batch(self):
+        """Test a chunk is stored with one lookup of the key index, one
+        insert of the rows missing from it and one locking lookup of all
+        of them, one lookup of the ledger for the keys the index has no Active
+        version for, one update and one insert of the ledger and one update
+        of the index"""
+        store_source_metadata(self.key_value, self.key_value_hash,
+                              self.hash_value,
+                              dict(self.source_metadata))
+        newer = dict(self.source_metadata,
+                     LastUpdatedOn="2018-03-28T00:00:00-04:00")
+        other = dict(self.source_metadata, ACEID="Other")
+
+        ledger_records = {
+            operation: REGISTRY.get_sample_value(
+                'xia_ledger_records_total', {'operation': operation}) or 0
+            for operation in ('inserted', 'inactivated', 'skipped')}
+
+        with self.assertNumQueries(7):
+            written = store_source_metadata_batch([
+                (self.key_value, self.key_value_hash, self.hash_value1,
+                 newer),
+                ("Other_ACE", "other", self.hash_value, other),
+                ("Other_ACE", "other", self.hash_value, dict(other))])
+
+        self.assertEqual(written, 3)
+        for operation, count in (('inserted', 2), ('inactivated', 1),
+                                 ('skipped', 1)):
+            self.assertEqual(REGISTRY.get_sample_value(
+                'xia_ledger_records_total', {'operation': operation}),
+                ledger_records[operation] + count)
+
+        self.assertEqual(MetadataLedger.objects.get(
+            source_metadata_key=self.key_value,
+            record_lifecycle_status="Active").source_metadata_hash,
+            self.hash_value1)
+        self.assertEqual(MetadataLedger.objects.filter(
+            source_metadata_key=self.key_value,
+            record_lifecycle_status="Inactive").count(), 1)
+        self.assertEqual(MetadataLedger.objects.filter(
+            source_metadata_key="Other_ACE").count(), 1)
+
+    def test_store_source_metadata_batch_unchanged(self):
+        """Test storing an unchanged record writes nothing, its key index
+        row being looked up and locked"""
+        store_source_metadata(self.key_value, self.key_value_hash,
+                              self.hash_value,
+                              dict(self.source_metadata))
+
+        with self.assertNumQueries(2):
+            store_source_metadata_batch([
+                (self.key_value, self.key_value_hash, self.hash_value,
+                 dict(self.source_metadata))])
+
+        self.assertEqual(MetadataLedger.objects.count(), 1)
+
+    def test_ledger_key_index(self):
+        """Test the index holds the only Active version of each key, no
+        version for keys with several, and is not trusted once the ledger
+        row is no longer Active"""
+        store_source_metadata_batch([
+            (self.key_value, self.key_value_hash, self.hash_value,
+             dict(self.source_metadata)),
+            ("Twice_ACE", "twice", "a", dict(self.source_metadata)),
+            ("Twice_ACE", "twice", "b",
+             dict(self.source_metadata, LastUpdatedOn=None))])
+        active = MetadataLedger.objects.get(
+            source_metadata_key_hash=self.key_value_hash)
+
+        row = LedgerKeyIndex.objects.get(
+            key_digest=get_ledger_digest(self.key_value_hash))
+        self.assertEqual((row.key_digest, row.metadata_digest,
+                          row.last_updated_on, row.ledger_id),
+                         (get_ledger_digest(self.key_value_hash),
+                          get_ledger_digest(self.hash_value),
+                          self.source_metadata["LastUpdatedOn"], active.pk))
+        row = LedgerKeyIndex.objects.get(key_digest=get_ledger_digest("twice"))
+        self.assertEqual((row.metadata_digest, row.ledger_id), (None, None))
+
+        MetadataLedger.objects.filter(pk=active.pk).update(
+            record_lifecycle_status='Inactive')
+        self.assertFalse(ActiveHashIndex().is_unchanged(
+            self.key_value_hash, self.hash_value))
+        self.assertEqual(store_source_metadata_batch([
+            (self.key_value, self.key_value_hash, self.hash_value,
+             dict(self.source_metadata))]), 1)
+        self.assertNotEqual(LedgerKeyIndex.objects.get(
+            key_digest=get_ledger_digest(self.key_value_hash)).ledger_id,
+            active.pk)
+
+    def test_store_source_metadata_batch_in_order(self):
+        """Test versions of one key within a chunk keep the LastUpdatedOn
+        semantics of storing them one at a time"""
+        older = dict(self.source_metadata,
+                     LastUpdatedOn="2016-03-28T00:00:00-04:00")
+        newer = dict(self.source_metadata,
+                     LastUpdatedOn="2018-03-28T00:00:00-04:00")
+
+        store_source_metadata_batch([
+            (self.key_value, self.key_value_hash, "a", older),
+            (self.key_value, self.key_value_hash, "b", newer),
+            (self.key_value, self.key_value_hash, "c", dict(older))])
+
+        self.assertEqual(sorted(MetadataLedger.objects.filter(
+            record_lifecycle_status="Active").values_list(
+            'source_metadata_hash', flat=True)), ["b", "c"])
+        self.assertEqual(list(MetadataLedger.objects.filter(
+            record_lifecycle_status="Inactive").values_list(
+            'source_metadata_hash', flat=True)), ["a"])
+
+    def test_active_hash_index(self):
+        """Test the index is loaded once and catches unchanged records and
+        keys repeated within a run"""
+        store_source_metadata(self.key_value, self.key_value_hash,
+                              self.hash_value, dict(self.source_metadata))
+        store_source_metadata("Twice_ACE", "twice", "a",
+                              dict(self.source_metadata))
+        store_source_metadata("Twice_ACE", "twice", "b",
+                              dict(self.source_metadata, LastUpdatedOn=None))
+        hash_index = ActiveHashIndex()
+
+        with self.assertNumQueries(1):
+            self.assertTrue(hash_index.is_unchanged(self.key_value_hash,
+                                                    self.hash_value))
+            self.assertFalse(hash_index.is_unchanged(self.key_value_hash,
+                                                     self.hash_value1))
+            self.assertFalse(hash_index.is_unchanged("twice", "a"))
+            self.assertFalse(hash_index.is_unchanged("new", "c"))
+            hash_index.add("new", "c")
+            self.assertTrue(hash_index.is_unchanged("new", "c"))
+
+        self.assertEqual(hash_index.unchanged, 2)
+
+    def test_extract_metadata_using_key_unchanged(self):
+        """Test records unchanged in the ledger are not written again"""
+        data = {1: dict(self.source_metadata, Key_val="TestData 123"),
+                2: dict(self.source_metadata, Key_val="TestData 123")}
+        data_df = pd.DataFrame.from_dict(data, orient='index')
+        extract_metadata_using_key(data_df.iloc[:1].copy())
+        hash_index = ActiveHashIndex()
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.store_source_metadata_batch') as mock_store_source:
+            extract_metadata_using_key(data_df, hash_index)
+
+            self.assertEqual(hash_index.unchanged, 2)
+            mock_store_source.assert_called_once_with([])
+
+    def test_extract_metadata_using_key_canonical_hash(self):
+        """Test the stored metadata and its hash share one encoding"""
+        data = [dict(self.source_metadata, Key_val="TestData 123")]
+
+        with patch('core.management.commands.extract_source_metadata'
+                   '.store_source_metadata_batch') as mock_store_source:
+            extract_metadata_using_key(data)
+
+            (_, _, hash_value, metadata), = mock_store_source.call_args[0][0]
+            self.assertEqual(list(metadata), sorted(metadata))
+            self.assertEqual(hash_value,
+                             hash_canonical(dumps_canonical(metadata)))
+
+    def test_bleach_source_metadata(self):
+        """Test records are bleached as bleach_data_to_json does, without
+        changing them"""
+        record = dict(self.source_metadata,
+                      objective="<b>Fuel</b> &amp; oil\r\n",
+                      nested={"a": "&lt;i&gt;", "b": {"c": "1 > 0"}},
+                      titles=["<i>kept</i>"])
+        expected = bleach_data_to_json(copy.deepcopy(record))
+
+        bleached = bleach_source_metadata(record)
+
+        self.assertEqual(bleached, expected)
+        self.assertEqual(bleached["objective"], "Fuel & oil\n")
+        self.assertEqual(record["objective"], "<b>Fuel</b> &amp; oil\r\n")
+        self.assertIs(bleached["nested"]["b"], record["nested"]["b"])
+        self.assertIs(bleach_source_metadata(self.source_metadata),
+                      self.source_metadata)
+
+    def test_rehash_source_metadata_extracted(self):
+        """Test extraction hashes records as they are stored, so rehashing
+        them changes nothing"""
+        data = [dict(self.source_metadata, Key_val="TestData 123",
+                     objective="<p>Fuel &amp; oil</p>")]
+
+        extract_metadata_using_key(data)
+
+        self.assertEqual(MetadataLedger.objects.get().source_metadata[
+            "objective"], "Fuel & oil")
+        self.assertEqual(rehash_source_metadata(), 0)
+
+    def test_rehash_source_metadata(self):
+        """Test stale metadata hashes are recomputed in bulk"""
+        for num in range(3):
+            store_source_metadata(self.key_value + str(num),
+                                  self.key_value_hash + str(num),
+                                  self.hash_value,
+                                  dict(self.source_metadata))
+        current = MetadataLedger.objects.order_by('pk').first()
+        current.source_metadata_hash = hash_canonical(
+            dumps_canonical(current.source_metadata))
+        current.save()
+
+        updated = rehash_source_metadata(batch_size=2)
+
+        self.assertEqual(updated, 2)
+        for record in MetadataLedger.objects.all():
+            self.assertEqual(record.source_metadata_hash, hash_canonical(
+                dumps_canonical(record.source_metadata)))
+        self.assertFalse(LedgerKeyIndex.objects.exists())
+
+    @override_settings(EXTRACT_HASH_WORKERS=2, EXTRACT_HASH_MIN_RECORDS=3)
+    def test_hash_source_metadata_chunk_pool(self):
+        """Test hashing in worker processes matches hashing in process"""
+        records = [dict(self.source_metadata, Key_val=str(num))
+                   for num in range(5)]
+        expected = [hash_source_metadata(dict(record)) for record in records]
+
+        with metadata_hash_pool() as pool:
+            self.assertIsNotNone(pool)
+            result = hash_source_metadata_chunk(records, pool)
+
+        self.assertEqual(result, expected)
+
+    @override_settings(EXTRACT_HASH_WORKERS=2, EXTRACT_HASH_MIN_RECORDS=3)
+    def test_hash_source_metadata_chunk_small(self):
+        """Test chunks below the threshold are hashed in process"""
+        pool = MagicMock()
+
+        result = hash_source_metadata_chunk(
+            [dict(self.source_metadata) for _ in range(2)], pool)
+
+        self.assertEqual(len(result), 2)
+        pool.apply_async.assert_not_called()
+
+    @override_settings(EXTRACT_HASH_WORKERS=2, EXTRACT_HASH_MIN_RECORDS=3)
+    def test_metadata_hash_pool_daemon(self):
+        """Test daemonic processes such as prefork celery workers hash in
+        worker processes too"""
+        records = [dict(self.source_metadata, Key_val=str(num))
+                   for num in range(5)]
+        expected = [hash_source_metadata(dict(record)) for record in records]
+        receiver, sender = billiard.Pipe(duplex=False)
+
+        def hash_records():
+            with metadata_hash_pool() as pool:
+                hashed = hash_source_metadata_chunk(records, pool)
+            sender.send((pool is not None, hashed))
+
+        process = billiard.Process(target=hash_records, daemon=True)
+        process.start()
+        # the pool exits without waiting out a timeout of its workers
+        self.assertTrue(receiver.poll(15))
+        result = receiver.recv()
+        process.join()
+
+        self.assertEqual(result, (True, expected))
+
+    @data(False, True)
+    def test_get_source_metadata_replay(self, stream):
+        """Test a snapshot of a run, named by its path or by its
+        directory under XSR_SNAPSHOT_DIR, replays to the same ledger
+        records without any request to the XSR"""
+        XSRConfiguration(Transcript_API='https://xsr/test',
+                         Subscription_key='secret',
+                         Parameter={"key": "value"}).save()
+        version = self.xsr_data["update"]["versions"]
+        body = json.dumps({"update": {"versions": [
+            version, dict(version, ACEID="TestData 456", titles=[],
+                          groups=[])]}}).encode('utf-8')
+        response = MagicMock(status_code=200, headers={'ETag': '"v1"'},
+                             content=body)
+        response.iter_content.return_value = [body[:10], body[10:]]
+
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(XSR_SNAPSHOT_DIR=root):
+            with patch('core.management.utils.xsr_client'
+                       '.get_xsr_api_response', return_value=response):
+                get_source_metadata(stream)
+            recorded = set(MetadataLedger.objects.values_list(
+                'source_metadata_key_hash', 'source_metadata_hash'))
+            MetadataLedger.objects.all().delete()
+            run, = os.listdir(root)
+            with open(os.path.join(root, run, 'manifest.json')) as file:
+                self.assertNotIn('secret', file.read())
+
+            with patch('core.management.utils.xsr_client'
+                       '.requests') as mock_requests:
+                call_command('extract_source_metadata', stream=stream,
+                             replay=run if stream else os.path.join(root,
+                                                                    run))
+
+                mock_requests.get.assert_not_called()
+                mock_requests.Session.assert_not_called()
+            self.assertEqual(os.listdir(root), [run])
+
+        self.assertEqual(len(recorded), 2)
+        self.assertEqual(set(MetadataLedger.objects.values_list(
+            'source_metadata_key_hash', 'source_metadata_hash')), recorded)
+
+    @data(False, True)
+    def test_extract_source_metadata_profile(self, stream):
+        """Test --profile saves a profile of every phase of the
+        extraction"""
+        XSRConfiguration(Transcript_API='https://xsr/test').save()
+        version = self.xsr_data["update"]["versions"]
+        body = json.dumps({"update": {"versions": [
+            version, dict(version, ACEID="TestData 456", titles=[],
+                          groups=[])]}}).encode('utf-8')
+        response = MagicMock(status_code=200, headers={}, content=body)
+        response.iter_content.return_value = [body]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(EXTRACT_HASH_WORKERS=2), \
+                patch('core.management.utils.xsr_client'
+                      '.get_xsr_api_response', return_value=response):
+            call_command('extract_source_metadata', stream=stream,
+                         profile=directory)
+
+            self.assertEqual(sorted(os.listdir(directory)), [
+                PROFILE_SUMMARY, 'extract.pstats', 'fetch.pstats',
+                'hashing.pstats', 'ledger_write.pstats',
+                'normalize.pstats', 'parse.pstats', 'shaping.pstats'])
+        self.assertTrue(MetadataLedger.objects.exists())
+
+
+@tag('unit')
+class BenchmarkCommandTests(TransactionTestCase):
+
+    def test_benchmark_extraction(self):
+        """Test the benchmark extracts synthetic feeds from the stub, saves
+        its measurements and deletes what it extracted, and only that"""
+        existing = [MetadataLedger.objects.create(
+            metadata_record_uuid=uuid.UUID(int=number << 127),
+            source_metadata_key='AR-1000-0000000' + str(number) + '_ACE',
+            source_metadata_key_hash=str(number), source_metadata={},
+            source_metadata_hash=str(number),
+            record_lifecycle_status='Active').pk for number in (0, 1)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_extraction', records=10, repeat=2,
+                         output=output, stdout=io.StringIO())
+            with open(output) as file:
+                results = json.load(file)
+
+        self.assertEqual(results['api_types'], ['Course', 'Occupation'])
+        first, second = results['runs']
+        self.assertEqual((first['records_fetched'], first['records_written']),
+                         (20, 20))
+        self.assertEqual((second['records_fetched'],
+                          second['records_changed']), (20, 0))
+        self.assertGreater(first['query_count'], 0)
+        self.assertGreater(first['peak_rss'], 0)
+        self.assertEqual(list(MetadataLedger.objects.filter(
+            record_lifecycle_status='Active').order_by('pk').values_list(
+            'pk', flat=True)), existing)
+        self.assertEqual(MetadataLedger.objects.count(), 2)
+        self.assertFalse(LedgerKeyIndex.objects.exists())
+        self.assertFalse(XSRConfiguration.objects.exists())
+
+
+@tag('unit')
+class LoadTestCommandTests(LiveServerTestCase):
+
+    @override_settings(CELERY_BROKER_URL='memory://')
+    def test_load_test_server(self):
+        """Test the server at url is load tested through the trigger and
+        status endpoints while a run of its own holds the workflow lock"""
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('core.workflow.AsyncResult') as mock_result, \
+                patch('api.views.celery_app.send_task') as mock_send:
+            mock_result.return_value.status = 'PENDING'
+            mock_result.return_value.result = None
+            output = os.path.join(directory, 'results.json')
+            call_command('load_test_server', url=self.live_server_url,
+                         count=20, concurrency=1, warmup=2, output=output,
+                         stdout=io.StringIO())
+            with open(output) as file:
+                results = json.load(file)
+
+        run, = results['runs']
+        self.assertEqual(run['mode'], self.live_server_url)
+        self.assertEqual(sorted(run['endpoints']), ['status', 'xia-workflow'])
+        for endpoint in run['endpoints'].values():
+            self.assertEqual((endpoint['requests'], endpoint['errors']),
+                             (10, 0))
+            self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+        mock_send.assert_not_called()
+        self.assertFalse(WorkflowRun.objects.exists())
+
+
+@tag('unit')
+class LedgerConcurrencyTests(TransactionTestCase):
+    # writers storing a version of every key in each of their batches
+    WRITERS = 8
+    BATCHES = 5
+    KEYS = 10
+
+    def test_store_source_metadata_batch_parallel_writers(self):
+        """Test writers storing the same keys at the same time leave one
+        Active version of each key, indexed in the LedgerKeyIndex, without
+        deadlocking more often than the default attempts absorb"""
+        barrier = threading.Barrier(self.WRITERS)
+        errors = []
+        # writers on SQLite fail on its database lock instead of waiting
+        # for the key rows, MySQL makes them wait
+        if connection.vendor == 'sqlite':
+            attempts = override_settings(EXTRACT_WRITE_ATTEMPTS=100)
+            attempts.enable()
+            self.addCleanup(attempts.disable)
+
+        def write(writer):
+            try:
+                barrier.wait()
+                for batch in range(self.BATCHES):
+                    store_source_metadata_batch([
+                        ("ACE" + str(key), "key" + str(key),
+                         "hash{}-{}-{}".format(key, writer, batch),
+                         {"LastUpdatedOn": "2020-01-01T00:00:00-04:00"})
+                        for key in range(self.KEYS)])
+            except Exception as err:
+                errors.append(err)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(writer,))
+                   for writer in range(self.WRITERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(MetadataLedger.objects.count(),
+                         self.WRITERS * self.BATCHES * self.KEYS)
+        active = dict(MetadataLedger.objects.filter(
+            record_lifecycle_status='Active').values_list(
+            'source_metadata_key_hash', 'pk'))
+        self.assertEqual(MetadataLedger.objects.filter(
+            record_lifecycle_status='Active').count(), self.KEYS)
+        self.assertEqual(
+            dict(LedgerKeyIndex.objects.values_list('key_digest',
+                                                    'ledger_id')),
+            {get_ledger_digest(key_value_hash): pk
+             for key_value_hash, pk in active.items()})
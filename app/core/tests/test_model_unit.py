@@ -1,4 +1,6 @@
-from core.models import XSRConfiguration
+from unittest.mock import MagicMock
+
+from core.models import LedgerKeyIndex, XSRConfiguration
 from django.test import TestCase, tag
 
 
@@ -22,3 +24,16 @@ class ModelTests(TestCase):
                          test_data)
         self.assertEqual(xia_config.Parameter,
                          test_json)
+
+    def test_ledger_key_index_digests(self):
+        """Test LedgerKeyIndex digests are 16 byte binary columns read back
+        as bytes"""
+        field = LedgerKeyIndex._meta.get_field('key_digest')
+        LedgerKeyIndex.objects.create(key_digest=bytes(range(16)),
+                                      metadata_digest=bytearray(16))
+
+        self.assertEqual(field.db_type(MagicMock(vendor='mysql')),
+                         'binary(16)')
+        self.assertEqual(LedgerKeyIndex.objects.values_list(
+            'key_digest', 'metadata_digest').get(),
+            (bytes(range(16)), bytes(16)))
@@ -1,8 +1,22 @@
 import logging
-from unittest.mock import patch
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
 
-from core.tasks import execute_xia_automated_workflow
-from django.test import tag
+from core.management.utils.profiling import PROFILE_SUMMARY
+from core.models import StageRun, WorkflowRun, XSRConfiguration
+from core.tasks import (complete_workflow_stage, execute_workflow_stage,
+                        execute_xia_automated_workflow,
+                        extract_xsr_configuration, fail_workflow_stage)
+from core.workflow import (WORKFLOW_LOCK_KEY, WORKFLOW_REFRESH_SCRIPT,
+                           WORKFLOW_STAGES, acquire_workflow_lock,
+                           claim_ready_stages, create_workflow_run,
+                           holding_workflow_lock, refresh_workflow_lock,
+                           release_workflow_lock, resume_workflow_run,
+                           run_stage)
+from ddt import data, ddt
+from django.test import override_settings, tag
 
 from .test_setup import TestSetUp
 
@@ -10,6 +24,7 @@ logger = logging.getLogger('dict_config_logger')
 
 
 @tag('unit')
+@ddt
 class TasksTests(TestSetUp):
 
     @patch("core.tasks.execute_xia_automated_workflow.run")
@@ -27,7 +42,7 @@ class TasksTests(TestSetUp):
     def test_check_calls_xia_workflow(self):
         """Testing the calls to commands from task list"""
 
-        with patch('core.tasks.extract_Command.handle') as mock_extract, \
+        with patch('core.tasks.get_source_metadata') as mock_extract, \
                 patch('core.tasks.validate_source_Command.'
                       'handle') as mock_validate_source, \
                 patch('core.tasks.transform_Command.'
@@ -48,3 +63,295 @@ class TasksTests(TestSetUp):
             self.assertEqual(mock_validate_target.call_count, 1)
             self.assertEqual(mock_load.call_count, 1)
             self.assertEqual(mock_load_supplemental.call_count, 1)
+
+    def stage_statuses(self, run):
+        return dict(run.stages.values_list('stage', 'status'))
+
+    def test_workflow_run_checkpoints(self):
+        """Testing every stage is checkpointed once completed"""
+        with patch('core.tasks.STAGE_COMMANDS',
+                   {stage: MagicMock() for stage in WORKFLOW_STAGES}):
+            run_id = execute_xia_automated_workflow.run()
+
+        run = WorkflowRun.objects.get(pk=run_id)
+        self.assertEqual(run.status, 'succeeded')
+        self.assertIsNotNone(run.finished)
+        self.assertEqual(set(self.stage_statuses(run).values()),
+                         {'succeeded'})
+        for stage_run in run.stages.all():
+            self.assertIsNotNone(stage_run.wall_time)
+            self.assertGreater(stage_run.peak_rss, 0)
+
+    @data('sequential', 'dag')
+    def test_workflow_run_resume(self, mode):
+        """Testing a rerun resumes from the first incomplete stage"""
+        commands = {stage: MagicMock() for stage in WORKFLOW_STAGES}
+        commands['load_supplemental'].side_effect = ValueError('failed')
+        run = create_workflow_run()
+
+        with override_settings(XIA_WORKFLOW_MODE=mode), \
+                patch('core.tasks.STAGE_COMMANDS', commands), \
+                patch('core.tasks.execute_workflow_stage.delay') as delay:
+            delay.side_effect = execute_workflow_stage.run
+            with self.assertRaises(ValueError):
+                execute_xia_automated_workflow.run(run.pk)
+
+            run.refresh_from_db()
+            self.assertEqual(run.status, 'failed')
+            self.assertEqual(self.stage_statuses(run)['load_supplemental'],
+                             'failed')
+            self.assertIn('failed', run.stages.get(
+                stage='load_supplemental').error)
+
+            commands['load_supplemental'].side_effect = None
+            for command in commands.values():
+                command.reset_mock()
+            execute_xia_automated_workflow.run(resume_workflow_run(run).pk)
+
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'succeeded')
+        commands['load_supplemental'].assert_called_once_with()
+        commands['extract'].assert_not_called()
+        commands['load'].assert_not_called()
+
+    @override_settings(XIA_WORKFLOW_MODE='dag')
+    def test_workflow_dag_dispatch(self):
+        """Testing independent stages are dispatched together"""
+        run = create_workflow_run()
+
+        with patch('core.tasks.execute_workflow_stage.delay') as delay:
+            execute_xia_automated_workflow.run(run.pk)
+
+            self.assertEqual([call[0][1] for call in delay.call_args_list],
+                             ['conformance_alerts', 'extract'])
+
+        run.stages.exclude(stage__startswith='load').update(
+            status=StageRun.STATUS.succeeded)
+        self.assertEqual(claim_ready_stages(run),
+                         ['load', 'load_supplemental'])
+        self.assertEqual(claim_ready_stages(run), [])
+
+    @override_settings(XIA_WORKFLOW_MODE='dag', XIA_EXTRACT_FANOUT=True)
+    def test_workflow_extract_fanout(self):
+        """Testing every XSR configuration is extracted in its own task
+        joined by a chord before the next stages"""
+        xsr_ids = [XSRConfiguration.objects.create(
+            Transcript_API='test' + str(num)).pk for num in range(2)]
+        run = create_workflow_run()
+        run.stages.filter(stage__in=['conformance_alerts', 'extract']).update(
+            status='queued')
+
+        with patch('core.tasks.chord') as mock_chord, \
+                patch('core.tasks.execute_workflow_stage.delay') as delay:
+            execute_workflow_stage.run(run.pk, 'extract')
+
+            header = mock_chord.call_args[0][0]
+            self.assertEqual([task.args for task in header],
+                             [(run.pk, xsr_id) for xsr_id in xsr_ids])
+            callback = mock_chord.return_value.call_args[0][0]
+            self.assertEqual(callback.args, (run.pk, 'extract'))
+            self.assertEqual(self.stage_statuses(run)['extract'], 'running')
+
+            with patch('core.tasks.get_source_metadata') as mock_extract:
+                mock_extract.side_effect = lambda xsr_ids: {
+                    'configurations': {
+                        XSRConfiguration.objects.get(pk=xsr_ids[0]): {
+                            'wall_time': 0.5, 'records_fetched': 2,
+                            'http_bytes': 100}},
+                    'records_changed': 1, 'records_written': 2}
+                for task in header:
+                    extract_xsr_configuration.run(*task.args)
+            self.assertEqual([call[1] for call in
+                              mock_extract.call_args_list],
+                             [{'xsr_ids': [xsr_id]} for xsr_id in xsr_ids])
+
+            complete_workflow_stage.run(*callback.args)
+
+            self.assertEqual(self.stage_statuses(run)['extract'],
+                             'succeeded')
+            delay.assert_called_once_with(run.pk, 'validate_source')
+
+        stage_run = run.stages.get(stage='extract')
+        self.assertEqual(
+            [(config.xsr_configuration_id, config.records_fetched,
+              config.records_written) for config in
+             stage_run.configurations.all()],
+            [(xsr_id, 2, 2) for xsr_id in xsr_ids])
+        self.assertEqual(stage_run.records_fetched, 4)
+        self.assertEqual(stage_run.http_bytes, 200)
+        self.assertIsNotNone(stage_run.query_count)
+
+    def test_workflow_extract_fanout_failed(self):
+        """Testing the extract stage fails when a configuration failed"""
+        run = create_workflow_run()
+        run.stages.filter(stage='extract').update(status='running')
+
+        fail_workflow_stage.run(run.pk, 'extract')
+
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'failed')
+        self.assertEqual(self.stage_statuses(run)['extract'], 'failed')
+
+    def test_workflow_lock(self):
+        """Testing scheduled runs are skipped while a run holds the lock"""
+        self.assertIsNone(acquire_workflow_lock('running'))
+        self.assertEqual(acquire_workflow_lock('other'), 'running')
+
+        with patch('core.tasks.STAGE_COMMANDS') as commands:
+            self.assertIsNone(execute_xia_automated_workflow.run())
+        commands.__getitem__.assert_not_called()
+        self.assertFalse(WorkflowRun.objects.exists())
+
+        release_workflow_lock('other')
+        self.assertEqual(acquire_workflow_lock('other'), 'running')
+        release_workflow_lock('running')
+        self.assertIsNone(acquire_workflow_lock('other'))
+
+    @override_settings(XIA_WORKFLOW_LOCK_URL='redis://redis:6379/1',
+                       XIA_WORKFLOW_LOCK_TIMEOUT=60)
+    def test_workflow_lock_redis(self):
+        """Testing the lock is shared through redis when configured"""
+        with patch('core.workflow.redis.Redis.from_url') as from_url:
+            client = from_url.return_value
+            client.set.return_value = None
+            client.get.return_value = 'running'
+
+            self.assertEqual(acquire_workflow_lock('task'), 'running')
+            client.set.assert_called_once_with(WORKFLOW_LOCK_KEY, 'task',
+                                               nx=True, ex=60)
+
+            release_workflow_lock('task')
+            self.assertEqual(client.eval.call_args[0][1:],
+                             (1, WORKFLOW_LOCK_KEY, 'task'))
+
+    @override_settings(XIA_WORKFLOW_LOCK_URL='redis://redis:6379/1',
+                       XIA_WORKFLOW_LOCK_TIMEOUT=60)
+    def test_refresh_workflow_lock_redis(self):
+        """Testing the lock is only extended for the task holding it"""
+        with patch('core.workflow.redis.Redis.from_url') as from_url:
+            refresh_workflow_lock('task')
+
+        from_url.return_value.eval.assert_called_once_with(
+            WORKFLOW_REFRESH_SCRIPT, 1, WORKFLOW_LOCK_KEY, 'task', 60)
+
+    def test_refresh_workflow_lock(self):
+        """Testing the lock of another task is left as it is"""
+        self.assertIsNone(acquire_workflow_lock('running'))
+
+        with patch('core.workflow.cache.touch') as touch:
+            refresh_workflow_lock('other')
+            touch.assert_not_called()
+            refresh_workflow_lock('running')
+            touch.assert_called_once_with(WORKFLOW_LOCK_KEY, 6 * 60 * 60)
+
+    @override_settings(XIA_WORKFLOW_LOCK_TIMEOUT=0.3)
+    def test_holding_workflow_lock(self):
+        """Testing the lock is refreshed while a stage runs and no longer
+        once it ended"""
+        with patch('core.workflow.refresh_workflow_lock') as refresh:
+            with holding_workflow_lock('task'):
+                time.sleep(0.35)
+            calls = refresh.call_count
+            time.sleep(0.2)
+
+        self.assertGreaterEqual(calls, 3)
+        self.assertEqual(refresh.call_count, calls)
+        refresh.assert_called_with('task')
+
+    def test_run_stage_holds_workflow_lock(self):
+        """Testing stages keep the lock of their run"""
+        run = create_workflow_run('task')
+
+        with patch('core.workflow.holding_workflow_lock') as holding:
+            run_stage(run, 'extract', lambda: None)
+
+        holding.assert_called_once_with('task')
+
+    def test_workflow_stage_peak_rss(self):
+        """Testing the peak RSS of a stage is its own and not that of the
+        stages the worker ran before"""
+        run = create_workflow_run()
+
+        def allocate():
+            # touch every page so the buffer is resident
+            buffer = bytearray(256 * 2 ** 20)
+            buffer[::4096] = b'x' * len(buffer[::4096])
+
+        run_stage(run, 'extract', allocate)
+        run_stage(run, 'validate_source', lambda: None)
+
+        large, small = (run.stages.get(stage=stage).peak_rss
+                        for stage in ('extract', 'validate_source'))
+        self.assertGreater(large - small, 128 * 2 ** 20)
+
+    def test_workflow_extract_metrics(self):
+        """Testing the counters of an extraction are stored on its stage
+        and its XSR configurations"""
+        xsr_obj = XSRConfiguration.objects.create(Transcript_API='test')
+        run = create_workflow_run()
+
+        def extract():
+            XSRConfiguration.objects.count()
+            return {'configurations': {xsr_obj: {
+                'wall_time': 0.5, 'records_fetched': 3, 'http_bytes': 100}},
+                'records_changed': 2, 'records_written': 3}
+
+        run_stage(run, 'extract', extract)
+
+        stage_run = run.stages.get(stage='extract')
+        self.assertEqual((stage_run.records_fetched,
+                          stage_run.records_changed,
+                          stage_run.records_written, stage_run.http_bytes,
+                          stage_run.query_count), (3, 2, 3, 100, 1))
+        config = stage_run.configurations.get()
+        self.assertEqual((config.Transcript_API, config.wall_time,
+                          config.records_fetched), ('test', 0.5, 3))
+
+    def test_workflow_profile(self):
+        """Testing a profiled run saves the profile of each stage"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(XIA_PROFILE_DIR=directory), \
+                patch('core.tasks.STAGE_COMMANDS',
+                      {stage: MagicMock() for stage in WORKFLOW_STAGES}):
+            run_id = execute_xia_automated_workflow.run(profile=True)
+
+            self.assertTrue(WorkflowRun.objects.get(pk=run_id).profile)
+            path = os.path.join(directory, 'run-' + str(run_id))
+            self.assertEqual(sorted(os.listdir(path)),
+                             sorted(WORKFLOW_STAGES))
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(path, 'extract'))),
+                [PROFILE_SUMMARY, 'extract.pstats'])
+
+    def test_workflow_progress(self):
+        """Testing the workflow publishes each stage as it starts"""
+        execute_xia_automated_workflow.push_request(id='workflow-task')
+        try:
+            with patch('core.tasks.STAGE_COMMANDS',
+                       {stage: MagicMock() for stage in WORKFLOW_STAGES}), \
+                    patch.object(execute_xia_automated_workflow,
+                                 'update_state') as update_state:
+                run_id = execute_xia_automated_workflow.run()
+        finally:
+            execute_xia_automated_workflow.pop_request()
+
+        metas = [update[1]['meta'] for update in update_state.call_args_list]
+        self.assertEqual([meta['stage'] for meta in metas],
+                         list(WORKFLOW_STAGES))
+        self.assertTrue(all(meta['run_id'] == run_id for meta in metas))
+        self.assertEqual(update_state.call_args[1]['state'], 'PROGRESS')
+
+    def test_workflow_stage_task_id(self):
+        """Testing a stage records the task running it, so its progress
+        can be found from the run"""
+        run = create_workflow_run('workflow-task')
+        execute_workflow_stage.push_request(id='stage-task')
+        try:
+            with patch('core.tasks.STAGE_COMMANDS',
+                       {stage: MagicMock() for stage in WORKFLOW_STAGES}), \
+                    patch('core.tasks.dispatch_workflow_stages'):
+                execute_workflow_stage.run(run.pk, 'load')
+        finally:
+            execute_workflow_stage.pop_request()
+
+        self.assertEqual(run.stages.get(stage='load').task_id, 'stage-task')
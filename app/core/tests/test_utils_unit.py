@@ -1,22 +1,73 @@
+import copy
 import hashlib
+import io
 import json
 import logging
-from unittest.mock import patch
+import os
+import pstats
+import tempfile
+import threading
+from datetime import timedelta
+from unittest.mock import ANY, MagicMock, patch
 
+import pandas as pd
 import requests
-from core.management.utils.xsr_client import (extract_source,
+from core.management.utils.ace_feed import iter_ace_items, write_ace_feed
+from core.management.utils.canonical_json import (dumps_canonical,
+                                                  dumps_stdlib,
+                                                  loads_canonical)
+from core.management.utils.json_stream import iter_json_items
+from core.management.utils.profiling import (PROFILE_SUMMARY, is_profiling,
+                                             profile_phase, profiling)
+from core.management.utils.progress import (report_progress,
+                                            reporting_progress)
+from core.management.utils.record_flattener import iter_flattened_records
+from core.management.utils.run_cache import run_cache
+from core.management.utils.snapshot import (SNAPSHOT_RUN_FORMAT,
+                                            SnapshotWriter)
+from core.management.utils.xsr_client import (ACE_COURSE_FIELDS,
+                                              ACE_OCCUPATION_FIELDS,
+                                              custom_ACE_data,
+                                              custom_ACE_records,
+                                              custom_ACE_setting_areas,
+                                              extract_source,
+                                              fetch_xsr_api_data,
+                                              flatten_ACE_course_records,
+                                              flatten_ACE_occupation_records,
+                                              get_record_timestamp,
                                               get_source_metadata_key_value,
+                                              get_source_metadata_key_values,
                                               get_xsr_api_endpoint,
-                                              get_xsr_api_response)
+                                              get_xsr_api_response,
+                                              get_xsr_configurations,
+                                              get_xsr_request_headers,
+                                              get_xsr_session,
+                                              iter_records_since)
+from core.management.utils.xsr_stub import XSRStubServer
 from core.models import XSRConfiguration
 from ddt import data, ddt, unpack
-from django.test import tag
+from django.utils import timezone
+from django.test import override_settings, tag
+from django.utils.dateparse import parse_datetime
+from openlxp_xia.management.utils import xia_internal
+from openlxp_xia.management.utils.xss_client import \
+    get_source_validation_schema
+from openlxp_xia.models import XIAConfiguration
 
 from .test_setup import TestSetUp
 
 logger = logging.getLogger('dict_config_logger')
 
 
+def xsr_response(content, status_code=200, headers=None):
+    """Requests response of an XSR endpoint with the whole body read"""
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp._content = content
+    return resp
+
+
 @tag('unit')
 @ddt
 class UtilsTests(TestSetUp):
@@ -39,6 +90,21 @@ class UtilsTests(TestSetUp):
         self.assertEqual(transcript_api, test_url)
         self.assertEqual(subscription_key, test_data)
 
+    @override_settings(XSR_WATERMARK_PARAMETER='since')
+    def test_get_xsr_api_endpoint_query(self):
+        """Test every parameter and the watermark end up in one query"""
+        xsr_config = XSRConfiguration(
+            Transcript_API='https://ace/api/courses?format=json',
+            Parameter={"chapter": "Navy", "page size": 50})
+        since = parse_datetime('2024-01-02T03:04:05+00:00')
+
+        transcript_api, _ = get_xsr_api_endpoint(xsr_config, since)
+
+        self.assertEqual(transcript_api,
+                         'https://ace/api/courses?format=json&chapter=Navy'
+                         '&page+size=50&since=2024-01-02T03%3A04%3A05%2B00'
+                         '%3A00')
+
     def test_get_xsr_api_response(self):
         """ Test Function to get api response
         from xsr endpoint"""
@@ -100,6 +166,20 @@ class UtilsTests(TestSetUp):
 
         self.assertEqual(result_key_dict, None)
 
+    def test_get_source_metadata_key_values(self):
+        """Test batched key dictionaries match the per record ones"""
+        records = [{'Key_val': 'key_field1', 'SOURCESYSTEM': 'ACE'},
+                   {'Key_val': 'key_field2', 'SOURCESYSTEM': ''},
+                   {'Key_val': None, 'SOURCESYSTEM': 'ACE'},
+                   {'SOURCESYSTEM': 'ACE'},
+                   {'Key_val': 'key_field\u00e9', 'SOURCESYSTEM': 'ACE'}]
+
+        result = get_source_metadata_key_values(records)
+
+        self.assertEqual(result, [get_source_metadata_key_value(record)
+                                  for record in records])
+        self.assertEqual(result.count(None), 3)
+
     def test_extract_source(self):
         """Test function to parse xsr data and
         convert to dictionary"""
@@ -114,8 +194,734 @@ class UtilsTests(TestSetUp):
 
         with patch('core.management.utils.xsr_client'
                    '.get_xsr_api_response') as mock_resp:
-            mock_resp.return_value.text = json.dumps(self.xsr_data)
+            mock_resp.return_value.content = json.dumps(
+                self.xsr_data).encode('utf-8')
             resp = extract_source()
             self.assertIn(self.xsr_data["update"]['versions']['ACEID'],
-                          resp[0]['ACEID'].values)
+                          [record['ACEID'] for record in resp[0]])
             self.assertIsInstance(resp, list)
+            self.assertEqual(resp[0], flatten_ACE_course_records(
+                self.xsr_data["update"]['versions']))
+
+    def test_extract_source_xsr_ids(self):
+        """Test only the requested XSR configurations are extracted"""
+        xsr_list = [XSRConfiguration.objects.create(
+            Transcript_API='test' + str(num)) for num in range(3)]
+
+        with patch('core.management.utils.xsr_client'
+                   '.fetch_xsr_api_data') as mock_fetch:
+            mock_fetch.side_effect = lambda xsr_list, *args: [None] * len(
+                xsr_list)
+            report = {'fetched': [], 'skipped': []}
+            extract_source(report=report, xsr_ids=[xsr_list[1].pk])
+
+            self.assertEqual(report['skipped'], [xsr_list[1]])
+
+    def test_extract_source_stream(self):
+        """Test streaming xsr data in bounded chunks of flat records"""
+        xsr_data = {"update": {"Database": "Courses", "versions": [
+            dict(self.xsr_data["update"]["versions"], ACEID="ACE " + str(i))
+            for i in range(5)]}}
+        body = json.dumps(xsr_data).encode('utf-8')
+
+        xsr_config = XSRConfiguration(
+            Transcript_API='test',
+            Subscription_key='test')
+        xsr_config.save()
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response') as mock_resp, \
+                override_settings(XSR_STREAM_CHUNK_SIZE=2):
+            mock_resp.return_value.iter_content.return_value = [
+                body[i:i + 7] for i in range(0, len(body), 7)]
+            report = {'fetched': [], 'skipped': []}
+            resp = list(extract_source(stream=True, report=report))
+
+            self.assertEqual([len(rows) for rows in resp], [2, 2, 1])
+            self.assertEqual(resp[2][0]['ACEID'], 'ACE 4')
+            self.assertEqual(resp[0][1]['Key_val'], 'ACE 1ABC 1230')
+            mock_resp.assert_called_once_with(xsr_config, stream=True,
+                                              session=ANY, full=False)
+            mock_resp.return_value.close.assert_called_once()
+            metrics = report['configurations'][xsr_config]
+            self.assertEqual(metrics['records_fetched'], 5)
+            self.assertEqual(metrics['http_bytes'], len(body))
+
+    def test_extract_source_stream_error(self):
+        """Test a streamed error response fails the extraction without
+        fingerprinting the feed"""
+        xsr_config = XSRConfiguration(Transcript_API='test', etag='"a"')
+        xsr_config.save()
+        resp = requests.Response()
+        resp.status_code = 401
+        resp.headers['ETag'] = '"error"'
+        resp.raw = io.BytesIO(b'{"statusCode": 401}')
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response', return_value=resp):
+            report = {'fetched': [], 'skipped': []}
+            with self.assertRaises(requests.exceptions.HTTPError):
+                list(extract_source(stream=True, report=report))
+
+        self.assertEqual(report['fetched'], [])
+        xsr_config.refresh_from_db()
+        self.assertEqual((xsr_config.etag, xsr_config.content_digest),
+                         ('"a"', None))
+
+    def test_extract_source_error(self):
+        """Test an error response fails the extraction without
+        fingerprinting the feed"""
+        xsr_config = XSRConfiguration(Transcript_API='test', etag='"a"')
+        xsr_config.save()
+        resp = xsr_response(b'{"statusCode": 500}', 500,
+                            {'ETag': '"error"'})
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response', return_value=resp):
+            report = {'fetched': [], 'skipped': []}
+            with self.assertRaises(requests.exceptions.HTTPError):
+                extract_source(report=report)
+
+        self.assertEqual(report['fetched'], [])
+        xsr_config.refresh_from_db()
+        self.assertEqual((xsr_config.etag, xsr_config.content_digest),
+                         ('"a"', None))
+
+    @override_settings(XSR_FETCH_CONCURRENCY=3)
+    def test_fetch_xsr_api_data(self):
+        """Test all XSR endpoints are requested over one shared session
+        and returned in configuration order"""
+        xsr_list = [XSRConfiguration(Transcript_API='test' + str(i))
+                    for i in range(5)]
+        session = get_xsr_session()
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response') as mock_resp:
+            mock_resp.side_effect = lambda xsr_obj, session, full: \
+                xsr_response(json.dumps(
+                    {"url": xsr_obj.Transcript_API}).encode('utf-8'))
+            result = fetch_xsr_api_data(xsr_list, session)
+
+            self.assertEqual([item["url"] for item in result],
+                             ['test0', 'test1', 'test2', 'test3', 'test4'])
+            self.assertEqual(mock_resp.call_count, 5)
+            for call in mock_resp.call_args_list:
+                self.assertIs(call[1]['session'], session)
+
+    @override_settings(XSR_FETCH_CONCURRENCY=3)
+    def test_get_xsr_session(self):
+        """Test the pooled session accepts compressed responses"""
+        session = get_xsr_session()
+
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+        self.assertEqual(
+            session.get_adapter('https://ace')._pool_maxsize, 3)
+
+    def test_get_xsr_request_headers(self):
+        """Test stored validators are sent as conditional headers"""
+        xsr_config = XSRConfiguration(Transcript_API='test',
+                                      etag='"abc"',
+                                      last_modified='Mon, 02 Jun 2025 '
+                                                    '10:00:00 GMT')
+
+        headers = get_xsr_request_headers(xsr_config, 'token')
+        full_headers = get_xsr_request_headers(xsr_config, 'token', True)
+
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         xsr_config.last_modified)
+        self.assertNotIn('Cache-Control', headers)
+        self.assertNotIn('If-None-Match', full_headers)
+        self.assertEqual(full_headers['Ocp-Apim-Subscription-Key'], 'token')
+
+    def test_extract_source_not_modified(self):
+        """Test feeds answered with 304 or an already seen body are
+        skipped and reported"""
+        content = json.dumps(self.xsr_data).encode('utf-8')
+        not_modified = XSRConfiguration(Transcript_API='test1', etag='"a"')
+        not_modified.save()
+        same_body = XSRConfiguration(
+            Transcript_API='test2',
+            content_digest=hashlib.sha512(content).hexdigest())
+        same_body.save()
+        report = {'fetched': [], 'skipped': []}
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response') as mock_resp:
+            responses = {
+                'test1': type('Response', (), {'status_code': 304}),
+                'test2': xsr_response(content, headers={'ETag': '"b"'})}
+            mock_resp.side_effect = lambda xsr_obj, **kwargs: responses[
+                xsr_obj.Transcript_API]
+            resp = extract_source(report=report)
+
+            self.assertEqual(resp, [])
+            self.assertEqual(report['fetched'], [])
+            self.assertEqual(
+                [xsr_obj.Transcript_API for xsr_obj in report['skipped']],
+                ['test1', 'test2'])
+            self.assertEqual(report['skipped'][1].etag, '"b"')
+            self.assertEqual(
+                [(metrics['records_fetched'], metrics['http_bytes'])
+                 for metrics in report['configurations'].values()],
+                [(0, 0), (0, len(content))])
+
+    def test_extract_source_fingerprint(self):
+        """Test a changed feed is extracted and its fingerprint kept"""
+        content = json.dumps(self.xsr_data).encode('utf-8')
+        XSRConfiguration(Transcript_API='test',
+                         content_digest='old').save()
+        report = {'fetched': [], 'skipped': []}
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response') as mock_resp:
+            mock_resp.return_value.status_code = 200
+            mock_resp.return_value.headers = {
+                'ETag': '"b"', 'Last-Modified': 'Tue'}
+            mock_resp.return_value.content = content
+            resp = extract_source(report=report)
+
+            self.assertEqual(len(resp[0]), 1)
+            self.assertEqual(report['skipped'], [])
+            xsr_obj = report['fetched'][0]
+            self.assertEqual(xsr_obj.etag, '"b"')
+            self.assertEqual(xsr_obj.last_modified, 'Tue')
+            self.assertEqual(xsr_obj.content_digest,
+                             hashlib.sha512(content).hexdigest())
+            self.assertEqual(
+                XSRConfiguration.objects.get().content_digest, 'old')
+
+    @data(({"LastUpdatedOn": "2017-03-28T00:00:00-04:00",
+            "ModDate": "2017-02-28T00:00:00-04:00"},
+           '2017-03-28T04:00:00+00:00'),
+          ({"LastUpdatedOn": "bad", "ModDate": "2017-05-28T00:00:00"},
+           '2017-05-28T00:00:00+00:00'),
+          ({"LastUpdatedOn": None}, None))
+    @unpack
+    def test_get_record_timestamp(self, record, expected):
+        """Test the latest parsable record date is used"""
+        timestamp = get_record_timestamp(record)
+
+        self.assertEqual(timestamp.isoformat() if timestamp else None,
+                         expected)
+
+    def test_iter_records_since(self):
+        """Test records older than the watermark are dropped and the
+        watermark moves to the latest record"""
+        xsr_config = XSRConfiguration(
+            Transcript_API='test',
+            last_updated_watermark=parse_datetime(
+                '2020-01-01T00:00:00+00:00'))
+        records = [{"ACEID": "old", "LastUpdatedOn": "2019-12-31T23:00:00"},
+                   {"ACEID": "same", "LastUpdatedOn": "2020-01-01T00:00:00"},
+                   {"ACEID": "new", "ModDate": "2021-06-01T00:00:00-04:00"},
+                   {"ACEID": "undated"}]
+
+        result = list(iter_records_since(records, xsr_config))
+
+        self.assertEqual([record["ACEID"] for record in result],
+                         ['same', 'new', 'undated'])
+        self.assertEqual(xsr_config.last_updated_watermark.isoformat(),
+                         '2021-06-01T04:00:00+00:00')
+        self.assertEqual(len(list(iter_records_since(
+            records, xsr_config, full=True))), 4)
+
+    def test_extract_source_watermark(self):
+        """Test feeds without records past the watermark are left out"""
+        XSRConfiguration(Transcript_API='test',
+                         last_updated_watermark=parse_datetime(
+                             '2018-01-01T00:00:00+00:00')).save()
+        report = {'fetched': [], 'skipped': []}
+
+        with patch('core.management.utils.xsr_client'
+                   '.get_xsr_api_response') as mock_resp:
+            mock_resp.return_value.status_code = 200
+            mock_resp.return_value.headers = {}
+            mock_resp.return_value.content = json.dumps(
+                self.xsr_data).encode('utf-8')
+            resp = extract_source(report=report)
+            full_resp = extract_source(full=True)
+
+            self.assertEqual(resp, [])
+            self.assertEqual(len(report['fetched']), 1)
+            self.assertEqual(len(full_resp[0]), 1)
+
+
+@tag('unit')
+@ddt
+class JSONStreamTests(TestSetUp):
+    """Unit Test cases for incremental JSON parsing"""
+
+    def chunked(self, document, size):
+        body = json.dumps(document, ensure_ascii=False).encode('utf-8')
+        return [body[i:i + size] for i in range(0, len(body), size)]
+
+    @data(1, 3, 64, 4096)
+    def test_iter_json_items(self, size):
+        """Test items are read across any chunk boundary"""
+        items = [{"ACEID": "NV-1\u00e9\"", "n": i, "x": [1.5, None, True],
+                  "titles": [{"Title": "a]}b{["}]} for i in range(4)]
+        document = {"header": {"skip": [1, {"a": "}"}]}, "n": -12,
+                    "update": {"Database": "Courses", "versions": items}}
+
+        result = list(iter_json_items(self.chunked(document, size),
+                                      ('update', 'versions')))
+
+        self.assertEqual(result, items)
+
+    def test_iter_json_items_single_object(self):
+        """Test a lone object under the path is yielded as one item"""
+        chunks = self.chunked(self.xsr_data, 5)
+
+        result = list(iter_json_items(chunks, ('update', 'versions')))
+
+        self.assertEqual(result, [self.xsr_data["update"]["versions"]])
+
+    @data([], {}, {"update": {}}, {"update": {"versions": []}})
+    def test_iter_json_items_missing(self, document):
+        """Test nothing is yielded when the path holds no records"""
+        result = list(iter_json_items(self.chunked(document, 2),
+                                      ('update', 'versions')))
+
+        self.assertEqual(result, [])
+
+
+@tag('unit')
+@ddt
+class RecordFlattenerTests(TestSetUp):
+    """Unit Test cases for flattening ACE records without pandas"""
+
+    def setUp(self):
+        super().setUp()
+        version = self.xsr_data["update"]["versions"]
+        self.versions = [
+            version,
+            dict(version, ACEID="TestData 456", VerNum=None,
+                 instruction=None, courses=[
+                     {"CourseNumber": "DEF 456", "Length": {"Weeks": 3}},
+                     {"CourseNumber": "DEF 789", "Hours": 40}]),
+            dict(version, ACEID="TestData 789", courses=[]),
+            {"ACEID": "TestData 000", "courses": [{"CourseNumber": "X 1"}]}]
+        self.exhibits = [
+            {"ACEID": "TestData 321", "Type": "MOS", "Pattern": "pattern",
+             "Summary": "summary", "titles": [{"Title": "Gunner"}],
+             "field": {"Name": "Aviation"}, "LastUpdatedOn": "2017",
+             "levels": [{"SkillLevel": "10", "Credits": {"Lower": 3}},
+                        {"SkillLevel": "20", "Description": "desc"}]},
+            {"ACEID": "TestData 654", "levels": None},
+            {"ACEID": "TestData 987", "levels": [{"SkillLevel": None}]}]
+
+    def pandas_records(self, source_df):
+        return source_df.astype(object).where(
+            pd.notnull(source_df), None).to_dict('records')
+
+    def normalize_ACE_course_records(self, versions):
+        source_df = pd.json_normalize(versions, record_path=['courses'],
+                                      meta=ACE_COURSE_FIELDS,
+                                      errors='ignore', sep='.')
+        source_df["requirements"] = source_df["instruction"]
+        source_df["description"] = source_df["objective"]
+        source_df["experience_id"] = source_df["CourseNumber"]
+        source_df["Key_val"] = (source_df["ACEID"] +
+                                source_df["CourseNumber"] +
+                                source_df["VerNum"])
+        return source_df
+
+    def normalize_ACE_occupation_records(self, exhibits):
+        source_df = pd.json_normalize(exhibits, record_path=['levels'],
+                                      meta=ACE_OCCUPATION_FIELDS,
+                                      errors='ignore')
+        source_df["requirements"] = source_df["Pattern"]
+        source_df["description"] = source_df["Summary"]
+        source_df["experience_id"] = (source_df["ACEID"] + "-" +
+                                      source_df["SkillLevel"])
+        source_df["Key_val"] = source_df["ACEID"] + source_df["SkillLevel"]
+        return source_df
+
+    def test_flatten_ACE_course_records_parity(self):
+        """Test course records match the pandas normalization"""
+        result = flatten_ACE_course_records(self.versions)
+
+        expected = self.pandas_records(
+            self.normalize_ACE_course_records(self.versions))
+        self.assertEqual(result, expected)
+        self.assertEqual([list(row) for row in result],
+                         [list(row) for row in expected])
+
+    def test_flatten_ACE_occupation_records_parity(self):
+        """Test occupation records match the pandas normalization"""
+        result = flatten_ACE_occupation_records(self.exhibits)
+
+        expected = self.pandas_records(
+            self.normalize_ACE_occupation_records(self.exhibits))
+        self.assertEqual(result, expected)
+        self.assertEqual([list(row) for row in result],
+                         [list(row) for row in expected])
+
+    def test_flatten_ACE_course_records_single_version(self):
+        """Test a lone version object is flattened like a list of one,
+        keeping list meta values pandas collapses when not ragged"""
+        version = self.xsr_data["update"]["versions"]
+
+        result = flatten_ACE_course_records(version)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['titles'], version['titles'])
+        self.assertEqual(result[0]['groups'], version['groups'])
+        self.assertEqual(result[0]['Key_val'], 'TestData 123ABC 1230')
+
+    def test_iter_flattened_records_lazy(self):
+        """Test records are yielded one at a time"""
+        records = iter_flattened_records(iter(self.versions), 'courses',
+                                         ACE_COURSE_FIELDS)
+
+        self.assertEqual(next(records)['CourseNumber'], 'ABC 123')
+        self.assertEqual(next(records)['Length.Weeks'], 3)
+
+    @data(({"courses": "ABC"}, TypeError),
+          ({"ACEID": "1"}, KeyError),
+          ({"ACEID": "1", "courses": [{"ACEID": "2"}]}, ValueError))
+    @unpack
+    def test_iter_flattened_records_errors(self, version, error):
+        """Test malformed versions raise like pandas.json_normalize"""
+        with self.assertRaises(error):
+            list(iter_flattened_records([version], 'courses',
+                                        ACE_COURSE_FIELDS))
+
+
+@tag('unit')
+class ACEShapingTests(TestSetUp):
+    """Unit Test cases for the ACE customizations of records"""
+
+    def test_custom_ACE_setting_areas(self):
+        """Test every subject of every academic level becomes a course
+        area and titles are joined prime first"""
+        record = custom_ACE_setting_areas({
+            "VerNum": "02", "StartDateYYYYMM": "201701",
+            "EndDateYYYYMM": "bad", "LastUpdatedOn": "2017-02-28",
+            "groups": [{"AcadLevel": "L", "subjects": [
+                {"Subject": "Electronics", "Min": "3"},
+                {"Subject": "Leadership", "Min": "1"}]},
+                {"AcadLevel": "U", "subjects": {"Subject": "Logistics",
+                                                "Min": "2"}},
+                {"AcadLevel": "G"}],
+            "titles": [{"Title": "Alt", "Precedence": "alt"},
+                       {"Title": "Prime", "Precedence": "prime"}]})
+
+        self.assertEqual(record["titles"], "Prime, Alt")
+        self.assertEqual(
+            [(area["level"], area["hours"],
+              area["academic_course_area"]["course_area"])
+             for area in record["groups"]],
+            [("L", "3", "Electronics"), ("L", "1", "Leadership"),
+             ("U", "2", "Logistics")])
+        self.assertEqual(
+            {key: record["groups"][0][key] for key in (
+                "version", "start_date", "end_date", "last_updated_on")},
+            {"version": "02", "start_date": "2017-01-01", "end_date": None,
+             "last_updated_on": "2017-02-28"})
+
+    def test_custom_ACE_records_parity(self):
+        """Test customizing a chunk matches customizing each record"""
+        records = flatten_ACE_course_records(
+            list(iter_ace_items('Course', 50, seed=3)))
+        records += flatten_ACE_occupation_records(
+            list(iter_ace_items('Occupation', 20, seed=3)))
+        records.append(dict(self.source_metadata, EndDateYYYYMM=None,
+                            description={"Objective": "objective"}))
+
+        expected = [custom_ACE_setting_areas(custom_ACE_data(record))
+                    for record in copy.deepcopy(records)]
+
+        self.assertEqual(custom_ACE_records(records), expected)
+
+
+@tag('unit')
+@ddt
+class CanonicalJSONTests(TestSetUp):
+    """Unit Test cases for canonical metadata encoding"""
+
+    def setUp(self):
+        super().setUp()
+        self.record = {"b": [1, 2.5, None], "a": {"d": "\u00e9", "c": True},
+                       "date": timezone.datetime(2017, 2, 28, 4,
+                                                 tzinfo=timezone.utc)}
+        self.encoded = ('{"a":{"c":true,"d":"\u00e9"},"b":[1,2.5,null],'
+                        '"date":"2017-02-28T04:00:00+00:00"}').encode('utf-8')
+
+    def test_dumps_canonical(self):
+        """Test records encode to compact sorted UTF-8 with ISO dates"""
+        self.assertEqual(dumps_canonical(self.record), self.encoded)
+
+    @data([1, 2.5, -0.0, 0.1, 1e15, 123456789.125, 2 ** 63, -2 ** 63],
+          ["", "\u00e9\U0001f600", "\"\\\n\u2028\x7f", True, None],
+          {"b": {"z": 1, "a": [{}]}, "\u00e9": 1, "a": []})
+    def test_dumps_stdlib(self, record):
+        """Test the standard library encoder produces the bytes of orjson
+        for data written without exponents, which only orjson writes
+        unlike Python"""
+        record = {"value": record, "date": self.record["date"]}
+
+        self.assertEqual(dumps_stdlib(record), dumps_canonical(record))
+
+    def test_dumps_canonical_non_finite(self):
+        """Test NaN and infinite floats encode as null with both encoders"""
+        record = {"b": [float('nan'), float('-inf')], "a": float('inf')}
+        encoded = b'{"a":null,"b":[null,null]}'
+
+        self.assertEqual(dumps_canonical(record), encoded)
+        self.assertEqual(dumps_stdlib(record), encoded)
+
+    def test_dumps_canonical_fallback(self):
+        """Test data orjson refuses is left to the standard library
+        encoder"""
+        record = dict(self.record, big=2 ** 64, nan=float('nan'))
+
+        encoded = dumps_canonical(record)
+
+        self.assertEqual(encoded, (
+            '{"a":{"c":true,"d":"\u00e9"},"b":[1,2.5,null],'
+            '"big":18446744073709551616,'
+            '"date":"2017-02-28T04:00:00+00:00","nan":null}').encode('utf-8'))
+        self.assertEqual(loads_canonical(encoded)["big"], 2 ** 64)
+
+    def test_dumps_canonical_key_order(self):
+        """Test insertion order does not change the encoding"""
+        reordered = dict(reversed(list(self.record.items())))
+
+        self.assertEqual(dumps_canonical(reordered), self.encoded)
+
+
+@tag('unit')
+@ddt
+class BenchmarkFeedTests(TestSetUp):
+    """Unit Test cases for the synthetic ACE feeds and the XSR stub"""
+
+    @data(('Course', flatten_ACE_course_records),
+          ('Occupation', flatten_ACE_occupation_records))
+    @unpack
+    def test_write_ace_feed(self, api_type, flatten):
+        """Test feeds flatten into the requested number of distinct
+        records, the same ones for a seed"""
+        feeds = []
+        for seed in (1, 1, 2):
+            file = io.BytesIO()
+            write_ace_feed(file, api_type, 25, seed)
+            feeds.append(file.getvalue())
+
+        path = 'versions' if api_type == 'Course' else 'exhibits'
+        records = flatten(json.loads(feeds[0])['update'][path])
+        self.assertEqual(len(records), 25)
+        self.assertEqual(len({record['Key_val'] for record in records}), 25)
+        self.assertEqual(feeds[0], feeds[1])
+        self.assertNotEqual(feeds[0], feeds[2])
+
+    def test_xsr_stub(self):
+        """Test the stub requires the subscription key and answers
+        conditional requests"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'course.json')
+            with open(path, 'wb') as file:
+                write_ace_feed(file, 'Course', 3)
+            server = XSRStubServer({'course': path}, 'key')
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                url = server.url('course')
+                missing = requests.get(url)
+                invalid = requests.get(
+                    url, headers={'Ocp-Apim-Subscription-Key': 'other'})
+                resp = requests.get(
+                    url, headers={'Ocp-Apim-Subscription-Key': 'key'})
+                cached = requests.get(
+                    url, headers={'Ocp-Apim-Subscription-Key': 'key',
+                                  'If-None-Match': resp.headers['ETag']})
+                unknown = requests.get(
+                    server.url('other'),
+                    headers={'Ocp-Apim-Subscription-Key': 'key'})
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+        self.assertEqual([missing.status_code, invalid.status_code],
+                         [401, 401])
+        self.assertIn('missing subscription key', missing.json()['message'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(flatten_ACE_course_records(
+            resp.json()['update']['versions'])), 3)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(unknown.status_code, 404)
+
+
+@tag('unit')
+class ProfilingTests(TestSetUp):
+    """Unit Test cases for the phase profiler"""
+
+    def test_profile_phase_not_profiling(self):
+        """Test phases outside profiling are not measured"""
+        with profile_phase('fetch'):
+            self.assertFalse(is_profiling())
+
+    def test_profiling(self):
+        """Test each phase gets a pstats file with the time of its own
+        calls and allocation sites in the summary"""
+        with tempfile.TemporaryDirectory() as directory:
+            with profiling(directory, top=5):
+                self.assertTrue(is_profiling())
+                for _ in range(4):
+                    with profile_phase('outer'):
+                        with profile_phase('inner'):
+                            blocks = [bytearray(1024) for _ in range(100)]
+                        json.dumps(blocks[0].decode())
+            self.assertFalse(is_profiling())
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                             [PROFILE_SUMMARY, 'inner.pstats',
+                              'outer.pstats'])
+            inner = pstats.Stats(os.path.join(directory, 'inner.pstats'))
+            outer = pstats.Stats(os.path.join(directory, 'outer.pstats'))
+            with open(os.path.join(directory, PROFILE_SUMMARY)) as file:
+                summary = file.read()
+
+        self.assertNotIn('dumps', {function[2] for function in inner.stats})
+        self.assertIn('dumps', {function[2] for function in outer.stats})
+        self.assertRegex(summary, r'inner\s+4\s')
+        self.assertIn('Top 5 allocation sites of inner (first 3 calls)',
+                      summary)
+        self.assertIn('test_utils_unit.py', summary)
+
+
+@tag('unit')
+class ProgressTests(TestSetUp):
+    """Unit Test cases for the progress reporter"""
+
+    def test_report_progress(self):
+        """Test updates are merged into the progress and published at most
+        once an interval unless forced"""
+        task = MagicMock()
+        task.request.id = 'task'
+        with patch('core.management.utils.progress.time.monotonic') as clock:
+            clock.return_value = 100.0
+            with reporting_progress(task, interval=2, run_id=1):
+                report_progress(stage='extract')
+                report_progress(records_done=10)
+                clock.return_value = 102.0
+                report_progress(records_done=20)
+                report_progress(force=True, stage='load')
+            report_progress(stage='transform')
+
+        self.assertEqual(
+            [update[1]['meta'] for update in task.update_state.call_args_list],
+            [{'run_id': 1, 'stage': 'extract'},
+             {'run_id': 1, 'stage': 'extract', 'records_done': 20},
+             {'run_id': 1, 'stage': 'load', 'records_done': 20}])
+
+    def test_report_progress_without_task_id(self):
+        """Test a task called directly publishes nothing"""
+        task = MagicMock()
+        task.request.id = None
+        with reporting_progress(task):
+            report_progress(force=True, stage='extract')
+
+        task.update_state.assert_not_called()
+
+
+@tag('unit')
+class RunCacheTests(TestSetUp):
+    """Unit Test cases for the run cache"""
+
+    def test_run_cache(self):
+        """Test configuration and schema lookups are fetched once inside a
+        run cache and again once it ended"""
+        XIAConfiguration.objects.bulk_create([XIAConfiguration(
+            publisher='ACE', xss_api='http://xss/',
+            source_metadata_schema='ace')])
+        XSRConfiguration.objects.create(Transcript_API='http://xsr')
+        with patch('openlxp_xia.management.utils.xss_client.requests.get') \
+                as mock_get, \
+                patch('openlxp_xia.management.utils.xss_client.cache') \
+                as mock_cache:
+            mock_cache.get.return_value = None
+            mock_get.return_value.json.return_value = {
+                'schema': {'Course': 'Required'}}
+            with run_cache() as cache, self.assertNumQueries(2):
+                for _ in range(3):
+                    self.assertEqual(get_source_validation_schema(),
+                                     {'Course': 'Required'})
+                    self.assertEqual(xia_internal.get_publisher_detail(),
+                                     'ACE')
+                    self.assertEqual(len(get_xsr_configurations()), 1)
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(cache.misses, {'XIAConfiguration': 1,
+                                        'read_json_data': 1,
+                                        'XSRConfiguration': 1})
+        self.assertEqual(cache.hits, {'XIAConfiguration': 6,
+                                      'read_json_data': 2,
+                                      'XSRConfiguration': 2})
+        self.assertNotIn('first', vars(XIAConfiguration.objects))
+        with self.assertNumQueries(2):
+            xia_internal.get_publisher_detail()
+            get_xsr_configurations()
+
+
+@tag('unit')
+class SnapshotTests(TestSetUp):
+    """Unit Test cases for the snapshots of the XSR responses"""
+
+    def make_runs(self, root, now, runs):
+        """Run directories started the given days before now, finished
+        when flagged, returns their names"""
+        names = []
+        for days, finished in runs:
+            name = (now - timedelta(days=days)).strftime(SNAPSHOT_RUN_FORMAT)
+            os.makedirs(os.path.join(root, name))
+            if finished:
+                with open(os.path.join(root, name, 'manifest.json'),
+                          'w') as file:
+                    file.write('{}')
+            names.append(name)
+        return names
+
+    def test_snapshot_writer_create_prunes(self):
+        """Test creating a writer keeps the newest finished runs, runs
+        still being written and directories that are not runs"""
+        now = timezone.now()
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(XSR_SNAPSHOT_DIR=root,
+                                  XSR_SNAPSHOT_KEEP_RUNS=2,
+                                  XSR_SNAPSHOT_KEEP_DAYS=0):
+            finished, older, oldest, writing, interrupted = self.make_runs(
+                root, now, [(1, True), (3, True), (40, True),
+                            (0.1, False), (2, False)])
+            os.makedirs(os.path.join(root, 'notes'))
+
+            writer = SnapshotWriter.create()
+            writer.close()
+
+            self.assertEqual(sorted(os.listdir(root)), sorted(
+                [finished, older, writing, 'notes',
+                 os.path.basename(writer.path)]))
+
+    def test_snapshot_writer_create_prunes_days(self):
+        """Test creating a writer removes the runs older than
+        XSR_SNAPSHOT_KEEP_DAYS, or none without limits"""
+        now = timezone.now()
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(XSR_SNAPSHOT_DIR=root,
+                                  XSR_SNAPSHOT_KEEP_RUNS=0,
+                                  XSR_SNAPSHOT_KEEP_DAYS=0):
+            runs = self.make_runs(root, now, [(1, True), (3, True),
+                                              (40, True), (2.5, False)])
+            writer = SnapshotWriter.create()
+            writer.close()
+            runs.append(os.path.basename(writer.path))
+            self.assertEqual(sorted(os.listdir(root)), sorted(runs))
+
+            with override_settings(XSR_SNAPSHOT_KEEP_DAYS=2):
+                writer = SnapshotWriter.create()
+                writer.close()
+
+            self.assertEqual(sorted(os.listdir(root)), sorted(
+                [runs[0], runs[-1], os.path.basename(writer.path)]))
@@ -0,0 +1,472 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from celery import current_app
+from celery.result import AsyncResult
+from core.management.utils.profiling import profile_phase, profiling
+from core.management.utils.progress import (PROGRESS_STATE,
+                                            report_progress)
+from core.metrics import STAGE_SECONDS
+from core.models import ConfigurationRun, StageRun, WorkflowRun
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+logger = logging.getLogger('dict_config_logger')
+
+# Stages of the XIA workflow with the stages they depend on, in the order
+# the sequential workflow runs them. Conformance alerts only notify and
+# do not depend on the ledgers; the two loads read the target and the
+# supplemental ledgers and can run side by side.
+WORKFLOW_STAGES = {
+    'conformance_alerts': (),
+    'extract': (),
+    'validate_source': ('extract',),
+    'transform': ('validate_source',),
+    'validate_target': ('transform',),
+    'load': ('validate_target',),
+    'load_supplemental': ('validate_target',),
+}
+
+# Name of the celery task running the XIA workflow, the web processes send
+# it by name so they do not import the task modules
+WORKFLOW_TASK = 'workflow_for_xia'
+
+# Key of the lock held by the celery task of the workflow run in progress
+WORKFLOW_LOCK_KEY = 'xia-workflow-lock'
+# Deletes the lock only when it is still held by the given task
+WORKFLOW_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# Extends the lock only when it is still held by the given task
+WORKFLOW_REFRESH_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def get_workflow_lock_client():
+    """Redis client holding the workflow lock, None when the default cache
+    holds it"""
+    if not settings.XIA_WORKFLOW_LOCK_URL:
+        return None
+    return redis.Redis.from_url(settings.XIA_WORKFLOW_LOCK_URL,
+                                decode_responses=True)
+
+
+def acquire_workflow_lock(task_id):
+    """Take the workflow lock for task_id, return the id of the task
+    holding it instead when another run is in progress"""
+    client = get_workflow_lock_client()
+    timeout = settings.XIA_WORKFLOW_LOCK_TIMEOUT
+    while True:
+        if client is not None:
+            if client.set(WORKFLOW_LOCK_KEY, task_id, nx=True, ex=timeout):
+                return None
+            holder = client.get(WORKFLOW_LOCK_KEY)
+        else:
+            if cache.add(WORKFLOW_LOCK_KEY, task_id, timeout):
+                return None
+            holder = cache.get(WORKFLOW_LOCK_KEY)
+        # the lock expired in between, try again
+        if holder is not None:
+            return holder
+
+
+def release_workflow_lock(task_id):
+    """Release the workflow lock if task_id still holds it"""
+    if task_id is None:
+        return
+    client = get_workflow_lock_client()
+    if client is not None:
+        client.eval(WORKFLOW_UNLOCK_SCRIPT, 1, WORKFLOW_LOCK_KEY, task_id)
+    elif cache.get(WORKFLOW_LOCK_KEY) == task_id:
+        cache.delete(WORKFLOW_LOCK_KEY)
+
+
+def refresh_workflow_lock(task_id):
+    """Hold the workflow lock of task_id for another
+    XIA_WORKFLOW_LOCK_TIMEOUT seconds if it still holds it"""
+    if task_id is None:
+        return
+    client = get_workflow_lock_client()
+    timeout = settings.XIA_WORKFLOW_LOCK_TIMEOUT
+    if client is not None:
+        client.eval(WORKFLOW_REFRESH_SCRIPT, 1, WORKFLOW_LOCK_KEY, task_id,
+                    timeout)
+    elif cache.get(WORKFLOW_LOCK_KEY) == task_id:
+        cache.touch(WORKFLOW_LOCK_KEY, timeout)
+
+
+@contextmanager
+def holding_workflow_lock(task_id):
+    """Refresh the workflow lock of task_id every third of
+    XIA_WORKFLOW_LOCK_TIMEOUT while the block runs, so a run outlasting
+    the timeout does not let a second one start"""
+    stopped = threading.Event()
+
+    def heartbeat():
+        try:
+            while not stopped.wait(settings.XIA_WORKFLOW_LOCK_TIMEOUT / 3):
+                try:
+                    refresh_workflow_lock(task_id)
+                except Exception:
+                    logger.exception('Could not refresh the workflow lock '
+                                     'of task ' + task_id)
+        finally:
+            # the database cache opened a connection for this thread
+            connections.close_all()
+
+    refresh_workflow_lock(task_id)
+    if task_id is None:
+        yield
+        return
+    thread = threading.Thread(target=heartbeat, daemon=True,
+                              name='xia-workflow-lock')
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def get_stage_progress(run, task_id):
+    """Progress published by the stages of run running in a task other
+    than task_id, by stage"""
+    progress = {}
+    for stage, stage_task_id in run.stages.filter(
+            status=StageRun.STATUS.running).exclude(task_id=None).exclude(
+            task_id=task_id).values_list('stage', 'task_id'):
+        stage_result = AsyncResult(stage_task_id)
+        if stage_result.status == PROGRESS_STATE:
+            progress[stage] = stage_result.result
+    return progress
+
+
+def get_task_status(task_id):
+    """JSON status of a celery task, with the progress it published as
+    its task_result and the stages of the workflow run it runs, with the
+    progress of those run by tasks of their own
+
+    The status is kept XIA_STATUS_CACHE_TTL seconds in the status cache,
+    so the watchers of a task served by a process share one read of the
+    result backend.
+    """
+    status_cache = caches['status']
+    key = 'xia-task-status-' + task_id
+    body = status_cache.get(key)
+    if body is not None:
+        return body
+    task_result = AsyncResult(task_id)
+    result = task_result.result
+    if isinstance(result, BaseException):
+        result = repr(result)
+    status = {
+        "task_id": task_id,
+        "task_status": task_result.status,
+        "task_result": result,
+    }
+    run = WorkflowRun.objects.filter(task_id=task_id).only(
+        'pk', 'status').order_by('-pk').first()
+    if run is not None:
+        status["run"] = {
+            "id": run.pk,
+            "status": run.status,
+            "stages": dict(run.stages.values_list('stage', 'status')),
+            "progress": get_stage_progress(run, task_id),
+        }
+    body = json.dumps(status, cls=DjangoJSONEncoder)
+    status_cache.set(key, body, settings.XIA_STATUS_CACHE_TTL)
+    return body
+
+
+def count_queued_workflow_tasks():
+    """Number of workflow runs waiting on the broker for a celery worker,
+    whether the API or celery beat sent them, the stage tasks of the run
+    in progress wait on the default queue and do not count"""
+    with current_app.connection_for_read() as conn:
+        try:
+            return conn.default_channel.queue_declare(
+                queue=settings.XIA_WORKFLOW_QUEUE,
+                passive=True).message_count
+        except conn.channel_errors:
+            # the queue only exists once a task was sent to it
+            return 0
+
+
+def abandon_workflow_run(run):
+    """Mark run failed when its task could not be sent to celery"""
+    run.status = WorkflowRun.STATUS.failed
+    run.finished = timezone.now()
+    run.save(update_fields=['status', 'finished'])
+
+
+def create_workflow_run(task_id=None, profile=False):
+    """Create a workflow run with a pending checkpoint per stage, profiling
+    its stages when profile is set"""
+    run = WorkflowRun.objects.create(task_id=task_id, profile=profile)
+    StageRun.objects.bulk_create([StageRun(workflow_run=run, stage=stage)
+                                  for stage in WORKFLOW_STAGES])
+    return run
+
+
+def get_workflow_run(run_id=None, task_id=None, profile=False):
+    """Workflow run run_id, a new one run by task_id when run_id is None"""
+    if run_id is None:
+        return create_workflow_run(task_id, profile)
+    run = WorkflowRun.objects.get(pk=run_id)
+    if profile and not run.profile:
+        run.profile = True
+        run.save(update_fields=['profile'])
+    return run
+
+
+def resume_workflow_run(run, task_id=None, profile=False):
+    """Reset every stage of run that did not succeed so it runs again in
+    task_id, stages already completed are kept, the stages run again are
+    profiled when profile is set"""
+    reset = run.stages.exclude(status=StageRun.STATUS.succeeded).update(
+        status=StageRun.STATUS.pending, started=None, finished=None,
+        error=None, task_id=None)
+    run.status = WorkflowRun.STATUS.pending
+    run.finished = None
+    run.task_id = task_id or run.task_id
+    run.profile = profile
+    run.save(update_fields=['status', 'finished', 'task_id', 'profile'])
+    logger.info('Resuming workflow run ' + str(run.pk) + ' with ' +
+                str(reset) + ' incomplete stages')
+    return run
+
+
+def claim_ready_stages(run, limit=None):
+    """Queue the pending stages of run whose dependencies all succeeded
+    and return their names
+
+    A stage is only claimed once even when several of its dependencies
+    complete at the same time.
+    """
+    statuses = dict(run.stages.values_list('stage', 'status'))
+    ready = []
+    for stage, dependencies in WORKFLOW_STAGES.items():
+        if limit is not None and len(ready) >= limit:
+            break
+        if statuses.get(stage) != StageRun.STATUS.pending:
+            continue
+        if any(statuses.get(dependency) != StageRun.STATUS.succeeded
+               for dependency in dependencies):
+            continue
+        if run.stages.filter(stage=stage,
+                             status=StageRun.STATUS.pending).update(
+                status=StageRun.STATUS.queued):
+            ready.append(stage)
+    return ready
+
+
+def update_workflow_status(run):
+    """Derive the status of run from the checkpoints of its stages"""
+    statuses = set(run.stages.values_list('status', flat=True))
+    if statuses == {StageRun.STATUS.succeeded}:
+        status = WorkflowRun.STATUS.succeeded
+    elif (StageRun.STATUS.failed in statuses and
+          not statuses & {StageRun.STATUS.queued, StageRun.STATUS.running}):
+        status = WorkflowRun.STATUS.failed
+    else:
+        status = WorkflowRun.STATUS.running
+    if status != run.status:
+        run.status = status
+        finished = status != WorkflowRun.STATUS.running
+        if finished:
+            run.finished = timezone.now()
+        run.save(update_fields=['status', 'finished'])
+        if finished:
+            # let the next trigger start a new run
+            release_workflow_lock(run.task_id)
+    return status
+
+
+def start_stage(run, stage, task_id=None):
+    """Checkpoint stage of run as running in the celery task task_id and
+    report it as the stage in progress"""
+    report_progress(force=True, stage=stage, records_done=None,
+                    records_total=None)
+    run.stages.filter(stage=stage).update(status=StageRun.STATUS.running,
+                                          started=timezone.now(),
+                                          task_id=task_id)
+    if run.status == WorkflowRun.STATUS.pending:
+        run.status = WorkflowRun.STATUS.running
+        run.save(update_fields=['status'])
+    logger.info('Workflow run ' + str(run.pk) + ' starting ' + stage)
+
+
+def finish_stage(run, stage, error=None, metrics=None):
+    """Checkpoint stage of run as succeeded, or failed with error, with the
+    metrics of the resources it used"""
+    metrics = metrics or {}
+    if error is None:
+        status = StageRun.STATUS.succeeded
+        run.stages.filter(stage=stage).update(
+            status=status, finished=timezone.now(), **metrics)
+        logger.info('Workflow run ' + str(run.pk) + ' completed ' + stage)
+    else:
+        status = StageRun.STATUS.failed
+        run.stages.filter(stage=stage).update(
+            status=status, finished=timezone.now(), error=error, **metrics)
+        logger.error('Workflow run ' + str(run.pk) + ' failed at ' + stage)
+    if metrics.get('wall_time') is not None:
+        STAGE_SECONDS.labels(stage, status).observe(metrics['wall_time'])
+
+
+def reset_peak_rss():
+    """Restart the peak resident memory of this process from its current
+    resident memory, returns False where the kernel does not allow it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def get_own_peak_rss():
+    """Peak resident memory in kilobytes of this process since it started,
+    or since reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_peak_rss(children=0):
+    """Peak resident memory in bytes of this process and of its children
+    that already exited, those only when one of them exceeded children,
+    their peak in kilobytes before the measure"""
+    exited = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return 1024 * max(get_own_peak_rss(),
+                      exited if exited > children else 0)
+
+
+@contextmanager
+def measure_resources():
+    """Collect the wall time, database queries and peak RSS of the block
+    into the yielded dict, also when the block raises
+
+    Workers run many blocks, the peak of the process is reset when the
+    block starts so it is that of the block. The peak of exited children
+    only covers the lifetime of the process, it counts when a child of
+    the block raised it.
+    """
+    metrics = {}
+    queries = 0
+
+    def count_query(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    reset_peak_rss()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    started = time.monotonic()
+    try:
+        with connection.execute_wrapper(count_query):
+            yield metrics
+    finally:
+        metrics.update(wall_time=time.monotonic() - started,
+                       query_count=queries, peak_rss=get_peak_rss(children))
+
+
+@contextmanager
+def profile_stage(run, stage, name=None):
+    """Profile the block as the phase stage when run is profiled, saving
+    the profile under XIA_PROFILE_DIR/run-<id>/<name or stage>"""
+    if not run.profile:
+        yield
+        return
+    path = os.path.join(settings.XIA_PROFILE_DIR, 'run-' + str(run.pk),
+                        name or stage)
+    with profiling(path), profile_phase(stage):
+        yield
+
+
+def get_report_metrics(report):
+    """Stage metrics of the report returned by an extraction"""
+    configurations = report['configurations'].values()
+    return {
+        'records_fetched': sum(counters['records_fetched']
+                               for counters in configurations),
+        'records_changed': report['records_changed'],
+        'records_written': report['records_written'],
+        'http_bytes': sum(counters['http_bytes']
+                          for counters in configurations),
+    }
+
+
+def record_configuration_runs(run, stage, report, metrics=None):
+    """Store the counters of every XSR configuration of an extraction
+    report under stage of run, metrics measured for the extraction of a
+    single configuration take precedence"""
+    stage_run = run.stages.get(stage=stage)
+    ConfigurationRun.objects.bulk_create([
+        ConfigurationRun(stage_run=stage_run,
+                         xsr_configuration_id=xsr_obj.pk,
+                         Transcript_API=xsr_obj.Transcript_API,
+                         **dict(counters, **(metrics or {})))
+        for xsr_obj, counters in report['configurations'].items()])
+
+
+def summarize_configuration_runs(run, stage):
+    """Stage metrics adding up the configuration runs of stage, for stages
+    spread over several tasks"""
+    stage_run = run.stages.get(stage=stage)
+    metrics = stage_run.configurations.aggregate(
+        records_fetched=Sum('records_fetched'),
+        records_changed=Sum('records_changed'),
+        records_written=Sum('records_written'),
+        http_bytes=Sum('http_bytes'),
+        query_count=Sum('query_count'),
+        peak_rss=Max('peak_rss'))
+    if stage_run.started is not None:
+        metrics['wall_time'] = \
+            (timezone.now() - stage_run.started).total_seconds()
+    return metrics
+
+
+def run_stage(run, stage, command, task_id=None):
+    """Run the command of a stage of run in the celery task task_id,
+    checkpointing its progress and the resources it used, the exception
+    of a failing command is raised again once recorded
+
+    A command returning an extraction report also records the counters
+    of each XSR configuration.
+    """
+    start_stage(run, stage, task_id)
+    try:
+        with measure_resources() as metrics, \
+                holding_workflow_lock(run.task_id), profile_stage(run, stage):
+            report = command()
+    except (Exception, SystemExit) as err:
+        finish_stage(run, stage, repr(err), metrics)
+        raise
+    if isinstance(report, dict):
+        metrics.update(get_report_metrics(report))
+        record_configuration_runs(run, stage, report)
+    finish_stage(run, stage, metrics=metrics)
@@ -0,0 +1,50 @@
+"""Gunicorn settings of the web tier, selected by XIA_SERVER_MODE
+
+'development' reloads the WSGI application on code changes with three
+sync workers. 'threaded' and 'asgi' are the production modes: the
+application is loaded once in the master process before the workers are
+forked, and served by threaded workers of the WSGI application or by
+uvicorn workers of the ASGI application, as many as the CPUs available
+allow.
+"""
+import os
+
+SERVER_MODES = ('development', 'threaded', 'asgi')
+
+mode = os.environ.get('XIA_SERVER_MODE', 'development')
+if mode not in SERVER_MODES:
+    raise ValueError('XIA_SERVER_MODE must be one of ' +
+                     ', '.join(SERVER_MODES) + ', not ' + mode)
+
+# CPUs this process may run on, which container CPU sets restrict
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+    else os.cpu_count()
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8010')
+
+if mode == 'development':
+    wsgi_app = 'openlxp_xia_ace_project.wsgi:application'
+    workers = 3
+    reload = True
+else:
+    preload_app = True
+    # idle seconds a connection from nginx is kept open for another request
+    keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+    # seconds a worker may spend on a request before it is restarted, and
+    # given to finish its requests on shutdown
+    timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+    graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+    # workers are replaced now and then so memory they leak is returned
+    max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+    max_requests_jitter = max_requests // 10
+
+if mode == 'threaded':
+    wsgi_app = 'openlxp_xia_ace_project.wsgi:application'
+    worker_class = 'gthread'
+    workers = int(os.environ.get('GUNICORN_WORKERS', 2 * cpus + 1))
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+elif mode == 'asgi':
+    wsgi_app = 'openlxp_xia_ace_project.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    # each worker serves its connections from one event loop
+    workers = int(os.environ.get('GUNICORN_WORKERS', cpus))
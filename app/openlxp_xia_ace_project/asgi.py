@@ -2,6 +2,8 @@
 ASGI config for openlxp_xia_ace_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides the Django application it streams the status of workflow tasks as
+Server-Sent Events from api/xia-workflow/events/<task id>/.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -14,4 +16,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE',
                       'openlxp_xia_ace_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# the event stream reads models, it is imported once the apps are loaded
+from api.events import route_task_events  # noqa: E402
+
+application = route_task_events(django_application)
@@ -8,6 +8,10 @@ logger = logging.getLogger('dict_config_logger')
 os.environ.setdefault('DJANGO_SETTINGS_MODULE',
                       'openlxp_xia_ace_project.settings')
 
+# Celery's Django fixup, installed as DJANGO_SETTINGS_MODULE is set, drops
+# the database connections a prefork child inherits from the worker at
+# worker_process_init without closing them on the server, where the parent
+# still uses them, and closes the connections of every task once it ends
 app = Celery('openlxp_xia_ace_project')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
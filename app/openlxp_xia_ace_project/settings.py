@@ -24,8 +24,12 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('SECRET_KEY_VAL')
 
+# Serving mode of gunicorn.conf.py, 'development' or the production modes
+# 'threaded' and 'asgi'
+XIA_SERVER_MODE = os.environ.get('XIA_SERVER_MODE', 'development')
+
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = XIA_SERVER_MODE == 'development'
 
 mimetypes.add_type("text/css", ".css", True)
 
@@ -156,6 +160,68 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Imported once by workers when they start, before forking their pool
+# processes, web processes send tasks by name and never import them
+CELERY_IMPORTS = ['core.tasks']
+# Workflow runs wait for a worker on a queue of their own, so the ones
+# waiting are counted apart from the stage tasks of the run in progress,
+# workers consume it along with the default queue
+XIA_WORKFLOW_QUEUE = 'xia-workflow'
+CELERY_TASK_ROUTES = {'workflow_for_xia': {'queue': XIA_WORKFLOW_QUEUE}}
+# 'sequential' runs every workflow stage inside one task, 'dag' runs each
+# stage as its own task as soon as the stages it depends on completed
+XIA_WORKFLOW_MODE = os.environ.get('XIA_WORKFLOW_MODE', 'sequential')
+# In 'dag' mode, extract every XSR configuration in a task of its own
+XIA_EXTRACT_FANOUT = os.environ.get('XIA_EXTRACT_FANOUT', 'False') == 'True'
+# Redis holding the lock that allows a single workflow run at a time, the
+# default cache holds it when unset
+XIA_WORKFLOW_LOCK_URL = os.environ.get('XIA_WORKFLOW_LOCK_URL')
+# Seconds after which the lock of a run is released once its stages stop
+# refreshing it, they refresh it every third of this while they run
+XIA_WORKFLOW_LOCK_TIMEOUT = int(os.environ.get('XIA_WORKFLOW_LOCK_TIMEOUT',
+                                               6 * 60 * 60))
+# Workflow runs waiting on the broker for a worker before new triggers are
+# refused
+XIA_WORKFLOW_MAX_QUEUED = int(os.environ.get('XIA_WORKFLOW_MAX_QUEUED', 3))
+# Directory receiving the profiles of extractions and workflow runs
+XIA_PROFILE_DIR = os.environ.get('XIA_PROFILE_DIR',
+                                 os.path.join(BASE_DIR, 'profiles'))
+# Seconds between two progress updates of a workflow task
+XIA_PROGRESS_INTERVAL = float(os.environ.get('XIA_PROGRESS_INTERVAL', 2))
+# Seconds the status of a task is served from the status cache
+XIA_STATUS_CACHE_TTL = int(os.environ.get('XIA_STATUS_CACHE_TTL', 2))
+# Seconds between two status reads of an event stream, and between two
+# keep-alive comments of a stream whose status did not change
+XIA_EVENTS_INTERVAL = float(os.environ.get('XIA_EVENTS_INTERVAL', 1))
+XIA_EVENTS_HEARTBEAT = float(os.environ.get('XIA_EVENTS_HEARTBEAT', 15))
+
+# Comma separated PROMETHEUS_MULTIPROC_DIR of every container whose metrics
+# are added up by the metrics endpoint, only that of this process by default
+XIA_METRICS_DIRS = [path for path in os.environ.get(
+    'XIA_METRICS_DIRS', os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')).split(
+    ',') if path]
+
+# Read XSR feeds incrementally instead of loading whole responses
+XSR_STREAMING = os.environ.get('XSR_STREAMING', 'False') == 'True'
+XSR_STREAM_CHUNK_SIZE = int(os.environ.get('XSR_STREAM_CHUNK_SIZE', 500))
+# Maximum number of XSR endpoints requested at the same time
+XSR_FETCH_CONCURRENCY = int(os.environ.get('XSR_FETCH_CONCURRENCY', 4))
+# Number of records written to the metadata ledger at a time
+EXTRACT_BATCH_SIZE = int(os.environ.get('EXTRACT_BATCH_SIZE', 1000))
+# Times a batch is written before a deadlock with another writer fails it
+EXTRACT_WRITE_ATTEMPTS = int(os.environ.get('EXTRACT_WRITE_ATTEMPTS', 5))
+# Query parameter passing the last extraction watermark to the XSR API
+XSR_WATERMARK_PARAMETER = os.environ.get('XSR_WATERMARK_PARAMETER')
+# Processes hashing metadata of chunks of at least EXTRACT_HASH_MIN_RECORDS
+EXTRACT_HASH_WORKERS = int(os.environ.get('EXTRACT_HASH_WORKERS', 1))
+EXTRACT_HASH_MIN_RECORDS = int(os.environ.get('EXTRACT_HASH_MIN_RECORDS',
+                                              2000))
+# Directory receiving a gzip snapshot of the XSR responses of every run
+XSR_SNAPSHOT_DIR = os.environ.get('XSR_SNAPSHOT_DIR')
+# Snapshot runs kept, the newest finished ones and those younger than the
+# given number of days, 0 lifting the limit
+XSR_SNAPSHOT_KEEP_RUNS = int(os.environ.get('XSR_SNAPSHOT_KEEP_RUNS', 30))
+XSR_SNAPSHOT_KEEP_DAYS = int(os.environ.get('XSR_SNAPSHOT_KEEP_DAYS', 0))
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
@@ -164,7 +230,13 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'my_cache_table',
-    }
+    },
+    # task statuses polled by the status endpoints, kept in each server
+    # process
+    'status': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'xia-task-status',
+    },
 }
 EMAIL_BACKEND = 'django_ses.SESBackend'
 LOG_PATH = os.environ.get('LOG_PATH')
@@ -2,6 +2,12 @@
 # start-server.sh
 
 python manage.py waitdb 
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ] ; then
+    # metrics of processes from an earlier start of this container are not
+    # carried over, the celery container has a directory of its own
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+fi
 python manage.py migrate 
 python manage.py createcachetable 
 python manage.py loaddata admin_theme_data.json 
@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+# start-celery.sh
+
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ] ; then
+    # metrics of processes from an earlier start of this container are not
+    # carried over, the app container has a directory of its own
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+fi
+exec celery -A openlxp_xia_ace_project worker -l info -Q celery,xia-workflow --pool=prefork --concurrency=${CELERY_WORKER_CONCURRENCY:-4}
@@ -3,5 +3,9 @@
 if [ -n "$DJANGO_SUPERUSER_USERNAME" ] && [ -n "$DJANGO_SUPERUSER_PASSWORD" ] ; then
     (cd openlxp-xia-ace; python manage.py createsuperuser --no-input)
 fi
-(cd openlxp-xia-ace; gunicorn openlxp_xia_ace_project.wsgi --reload --user www-data --bind 0.0.0.0:8010 --workers 3) &
+# XIA_SERVER_MODE selects the gunicorn settings of gunicorn.conf.py
+(cd openlxp-xia-ace; gunicorn --config gunicorn.conf.py --user www-data) &
+# the workflow event streams are served by the ASGI application, in a
+# uvicorn worker that gunicorn also runs as www-data
+(cd openlxp-xia-ace; gunicorn --config gunicorn.conf.py --user www-data --worker-class uvicorn.workers.UvicornWorker --workers 1 --bind 127.0.0.1:8011 openlxp_xia_ace_project.asgi:application) &
 nginx -g "daemon off;"